@@ -5,9 +5,31 @@ import pandas as pd
 import json
 import sys
 import os
+import tempfile
 import nibabel as nb
 from argparse import ArgumentParser, RawTextHelpFormatter
-from utils_lev1.qa import qa_design_matrix, add_to_html_summary, get_all_contrast_vif
+from utils_lev1.qa import qa_design_matrix, make_qa_record
+from utils_lev1.qa_store import save_qa_record, save_exclusion_record, get_qa_record_file
+from utils_lev1.qa_report import render_missing_figures
+from utils_lev1.lev1_units import (
+    make_session_record,
+    write_unit_manifest,
+    load_unit_manifest,
+    remove_stale_outputs,
+)
+from utils_lev1.glm_outputs import (
+    save_residuals,
+    fit_first_level,
+    get_contrast_matrix,
+    compute_contrasts_batched,
+    save_contrast_estimates,
+    stat_file_labels,
+    get_image_extension,
+)
+from utils_lev1.chunked_glm import fit_first_level_blocks, parse_memory
+
+# TR (s) of all scans (get_tr reads it from a bold json file instead)
+repetition_time = 1.49
 
 
 def get_confounds_tedana(confounds_file, task):
@@ -79,6 +101,7 @@ def make_desmat_contrasts(
     n_scans,
     confounds_file=None,
     regress_rt="no_rt",
+    cache_dir=None,
 ):
     """
     Creates design matrices and contrasts for each task.  Should work for any
@@ -94,20 +117,40 @@ def make_desmat_contrasts(
         n_scans: Number of scans
         confound_file (optional): File path to fmriprep confounds file
         regress_rt: 'no_rt' or 'rt_uncentered' or 'rt_centered'
+        cache_dir (optional): design cache directory.  Designs are looked up by the
+            content of the events/confounds files and the design parameters, on a
+            hit the files are not parsed and no regressors are computed.
     Output:
         design_matrix, contrasts: Full design matrix and contrasts for nilearn model
         percent junk: percentage of trials labeled as "junk".  Used in later QA.
         percent high motion: percentage of time points that are high motion.  Used later in QA.
     """
     from utils_lev1.first_level_designs import make_task_desmat_fcn_dict
+    from utils_lev1.design_cache import get_design_cache_key, load_design, save_design
+
+    #you can use get_tr from above
+    tr = repetition_time
+
+    if cache_dir is not None:
+        cache_key = get_design_cache_key(
+            events_file,
+            confounds_file,
+            task,
+            add_deriv,
+            regress_rt,
+            duration_choice,
+            tr,
+            n_scans,
+        )
+        cached = load_design(cache_dir, cache_key)
+        if cached is not None:
+            design_matrix, contrasts, percent_junk, events_df = cached
+            return design_matrix, contrasts, tr, percent_junk, events_df
 
     if confounds_file is not None:
         confound_regressors = get_confounds_tedana(confounds_file, task)
     else:
         confound_regressors = None
-        
-    #you can use get_tr from above
-    tr = 1.49
 
     design_matrix, contrasts, percent_junk, events_df = make_task_desmat_fcn_dict[task](
         events_file,
@@ -118,9 +161,34 @@ def make_desmat_contrasts(
         tr,
         confound_regressors,
     )
+    if cache_dir is not None:
+        save_design(
+            cache_dir, cache_key, design_matrix, contrasts, percent_junk, events_df
+        )
     return design_matrix, contrasts, tr, percent_junk, events_df
 
 
+def get_session_design_key(
+    task, events_file, confounds_file, add_deriv, regress_rt, duration_choice, n_scans
+):
+    """
+    Design cache key of a session (see design_cache.get_design_cache_key), also
+    recorded in the run manifest to find sessions whose design changed
+    """
+    from utils_lev1.design_cache import get_design_cache_key
+
+    return get_design_cache_key(
+        events_file,
+        confounds_file,
+        task,
+        add_deriv,
+        regress_rt,
+        duration_choice,
+        repetition_time,
+        n_scans,
+    )
+
+
 def check_file(glob_out, task):
     """
     Checks if file exists
@@ -198,6 +266,389 @@ def get_files(root, subid, task):
     return files
 
 
+def get_contrast_filename(
+    contrast_dir, subid, ses, task, con_name, regress_rt, stat_label, extension=".nii.gz"
+):
+    """File name of a single session contrast estimate (stat_label e.g. effect-size)"""
+    return (
+        f"{contrast_dir}/contrast_estimates/sub-{subid}_{ses}_task-{task}_contrast-{con_name}"
+        f"_rtmodel-{regress_rt}_stat"
+        f"-{stat_label}{extension}"
+    )
+
+
+def get_session_contrast_filenames(
+    contrast_dir,
+    subid,
+    ses,
+    task,
+    regress_rt,
+    contrasts,
+    stacked_contrasts=False,
+    uncompressed=False,
+):
+    """
+    Files the contrast estimates of a session are written to, keyed by statistic
+    (see glm_outputs.save_contrast_estimates): one file per contrast, or one
+    multi-volume file per statistic with stacked_contrasts.  uncompressed: .nii
+    instead of .nii.gz (see glm_outputs.get_image_extension)
+    """
+    extension = get_image_extension(uncompressed)
+    if stacked_contrasts:
+        return {
+            stat: f"{contrast_dir}/contrast_estimates/sub-{subid}_{ses}_task-{task}"
+            f"_rtmodel-{regress_rt}_stat-{stat_label}_contrasts{extension}"
+            for stat, stat_label in stat_file_labels.items()
+        }
+    return {
+        stat: [
+            get_contrast_filename(
+                contrast_dir, subid, ses, task, con_name, regress_rt, stat_label, extension
+            )
+            for con_name in contrasts
+        ]
+        for stat, stat_label in stat_file_labels.items()
+    }
+
+
+def load_written_session_outputs(
+    session_outputs,
+    contrast_dir,
+    subid,
+    task,
+    regress_rt,
+    stacked_contrasts=False,
+    uncompressed=False,
+):
+    """
+    Estimates an earlier run wrote for the sessions of session_outputs (to
+    resume the fixed effects of a run that fit no session), looked up by their
+    exact file names (get_session_contrast_filenames).  A session enters with
+    the contrasts whose effect size and variance are both on disk (stacked: all
+    contrasts of its design, if its stacked files hold one volume per contrast).
+    output:
+        list of session outputs with masked estimates, as in run_session()
+    """
+    from utils_lev1.fixed_effects import load_session_estimates
+
+    written_outputs = []
+    for session_output in session_outputs:
+        ses = session_output["ses"]
+        contrast_names = list(session_output["contrasts"])
+        filenames = get_session_contrast_filenames(
+            contrast_dir, subid, ses, task, regress_rt, contrast_names,
+            stacked_contrasts, uncompressed,
+        )
+        stats = ["effect_size", "effect_variance"]
+        if stacked_contrasts:
+            if not all(os.path.exists(filenames[stat]) for stat in stats):
+                continue
+        else:
+            contrast_names = [
+                con_name
+                for con_idx, con_name in enumerate(contrast_names)
+                if all(os.path.exists(filenames[stat][con_idx]) for stat in stats)
+            ]
+            if not contrast_names:
+                continue
+            filenames = get_session_contrast_filenames(
+                contrast_dir, subid, ses, task, regress_rt, contrast_names,
+                uncompressed=uncompressed,
+            )
+        estimates = load_session_estimates(
+            filenames, session_output["mask_file"], stacked_contrasts
+        )
+        if estimates["effect_size"].shape[0] != len(contrast_names):
+            print(f"{ses}: stacked estimates do not match the contrasts, skipping session")
+            continue
+        written_outputs.append(
+            {
+                "ses": ses,
+                "contrasts": contrast_names,
+                "estimates": estimates,
+                "mask_file": session_output["mask_file"],
+            }
+        )
+    return written_outputs
+
+
+def get_session_files(files, data_file):
+    """Picks the events, confounds and mask files matching the session of data_file"""
+    ses = data_file.split("/")[-3]
+    event_file = [i for i in files["events_file"] if ses in i][0]
+    confounds_file = [i for i in files["confounds_file"] if ses in i][0]
+    mask_file = [i for i in files["mask_file"] if ses in i][0]
+    return ses, event_file, confounds_file, mask_file
+
+
+def run_session(
+    data_file,
+    files,
+    root,
+    subid,
+    task,
+    regress_rt,
+    add_deriv,
+    duration_choice,
+    contrast_dir,
+    qa_only=False,
+    simplified_events=False,
+    residuals=False,
+    stacked_contrasts=False,
+    design_cache_dir=None,
+    uncompressed_intermediates=False,
+    bold_cache_dir=None,
+    max_memory=None,
+):
+    """
+    Builds the design, runs QA and (if QA passes) fits the first level model for
+    a single session.  Used both serially and as a process pool worker.
+    input:
+        data_file: path to 4D BOLD data for this session
+        files: dictionary of files from get_files()
+        stacked_contrasts: write one multi-volume file per statistic (volumes in
+            the order of contrasts) instead of one file per contrast
+        design_cache_dir: design cache directory (None to always build the design)
+        uncompressed_intermediates: write the session images (contrast estimates,
+            residuals) as uncompressed, memory mappable .nii files
+        bold_cache_dir: cache directory of the masked, smoothed BOLD runs (None to
+            prepare the data without caching it)
+        max_memory: memory budget of the fit in bytes: the voxels are fit in
+            blocks and the results streamed to disk (chunked_glm.py).  None fits
+            the whole run in memory
+    output:
+        dictionary with ses, contrasts, exclusion and any_fail for this session
+        (its QA record is saved to contrast_dir/qa_records).  If the model was fit it also holds the masked
+        effect sizes/variances (estimates) and mask_file, used for fixed effects.
+        session_record is the run manifest entry of the session (input hashes,
+        design, outputs).
+    """
+    from utils_lev1.bold_cache import get_masked_bold
+
+    ses, event_file, confounds_file, mask_file = get_session_files(files, data_file)
+    n_scans = get_nscans(data_file)
+    output_files = []
+    design_matrix, contrasts, tr, percent_junk, events_df = make_desmat_contrasts(
+        root,
+        task,
+        event_file,
+        duration_choice,
+        add_deriv,
+        n_scans,
+        confounds_file,
+        regress_rt,
+        cache_dir=design_cache_dir,
+    )
+
+    if simplified_events:
+        os.makedirs(f"{contrast_dir}/simplified_events", exist_ok=True)
+        simplified_filename = f"{contrast_dir}/simplified_events/sub-{subid}_{ses}_task-{task}_simplified-events.csv"
+        events_df.to_csv(simplified_filename)
+        output_files.append(simplified_filename)
+
+    exclusion, any_fail = qa_design_matrix(
+        contrast_dir,
+        contrasts,
+        design_matrix,
+        subid,
+        task,
+        ses,
+        percent_junk=percent_junk,
+        update_exclusions=False,
+    )
+    if any_fail:
+        # only this session's record, excluded_subject.csv is rendered from all
+        # records after the sweep (run_lev1_units.py --render_qa, render_qa_summary.py)
+        save_exclusion_record(contrast_dir, subid, task, ses, exclusion)
+
+    qa_record = make_qa_record(
+        subid,
+        contrasts,
+        design_matrix,
+        task,
+        any_fail,
+        exclusion,
+        ses,
+        percent_junk,
+        contrast_dir,
+        regress_rt,
+        duration_choice,
+    )
+    save_qa_record(contrast_dir, qa_record)
+    output_files.append(
+        get_qa_record_file(contrast_dir, subid, ses, duration_choice)
+    )
+
+    if not any_fail and qa_only == False:
+        print(f"Running model for {data_file}")
+        contrast_matrix = get_contrast_matrix(contrasts, design_matrix.columns.tolist())
+        filenames = get_session_contrast_filenames(
+            contrast_dir,
+            subid,
+            ses,
+            task,
+            regress_rt,
+            contrasts,
+            stacked_contrasts,
+            uncompressed_intermediates,
+        )
+        if stacked_contrasts:
+            contrast_names_filename = (
+                f"{contrast_dir}/contrast_estimates/sub-{subid}_{ses}_task-{task}"
+                f"_rtmodel-{regress_rt}_contrasts.json"
+            )
+            with open(contrast_names_filename, "w") as f:
+                json.dump(list(contrasts.keys()), f)
+            output_files += [contrast_names_filename] + list(filenames.values())
+        else:
+            output_files += [
+                filename for stat_filenames in filenames.values() for filename in stat_filenames
+            ]
+        # residuals are saved for Mahalanobis distance analysis
+        residuals_filename = (
+            f"{contrast_dir}/contrast_estimates/sub-{subid}_{ses}_task-{task}_rtmodel-{regress_rt}_residuals"
+            + get_image_extension(uncompressed_intermediates)
+        )
+
+        if max_memory is None:
+            # the BOLD run is masked and smoothed once (cached by content, shared by
+            # all RT models and reruns) and the model is fit from that matrix.  A
+            # single fit provides both the contrast estimates and, if requested, the
+            # residuals (which need the full results: minimize_memory=False)
+            masked_bold = get_masked_bold(
+                data_file, mask_file, tr, smoothing_fwhm=5, cache_dir=bold_cache_dir
+            )
+            labels, results = fit_first_level(
+                masked_bold, design_matrix, minimize_memory=not residuals
+            )
+            del masked_bold
+
+            # all contrasts are computed in one pass over the AR(1) labels
+            estimates = compute_contrasts_batched(labels, results, contrast_matrix)
+            save_contrast_estimates(estimates, mask_file, filenames, stacked=stacked_contrasts)
+            if residuals:
+                save_residuals(labels, results, mask_file, residuals_filename)
+            del labels, results
+        else:
+            # blocks of voxels are fit within the budget and their results are
+            # written to memory mapped arrays in a temporary directory
+            with tempfile.TemporaryDirectory(dir=contrast_dir, prefix=".glm_blocks_") as work_dir:
+                estimates = fit_first_level_blocks(
+                    data_file,
+                    mask_file,
+                    tr,
+                    design_matrix,
+                    contrast_matrix,
+                    max_memory,
+                    work_dir,
+                    bold_cache_dir=bold_cache_dir,
+                    residuals_filename=residuals_filename if residuals else None,
+                )
+                save_contrast_estimates(estimates, mask_file, filenames, stacked=stacked_contrasts)
+                # the fixed effects only need effect sizes and variances
+                estimates = {
+                    stat: np.array(estimates[stat]) for stat in ["effect_size", "effect_variance"]
+                }
+        if residuals:
+            output_files.append(residuals_filename)
+        print(f"Contrast names: {list(contrasts.keys())}")
+    else:
+        estimates = None
+
+    session_record = make_session_record(
+        [data_file, event_file, confounds_file, mask_file],
+        get_session_design_key(
+            task, event_file, confounds_file, add_deriv, regress_rt, duration_choice, n_scans
+        ),
+        {
+            "task": task,
+            "add_deriv": add_deriv,
+            "regress_rt": regress_rt,
+            "duration_choice": duration_choice,
+            "tr": tr,
+            "n_scans": n_scans,
+        },
+        contrasts,
+        estimates is not None,
+        output_files,
+        contrast_dir,
+    )
+    return {
+        "ses": ses,
+        "contrasts": contrasts,
+        "exclusion": exclusion,
+        "any_fail": any_fail,
+        "estimates": None
+        if estimates is None
+        else {
+            "effect_size": estimates["effect_size"],
+            "effect_variance": estimates["effect_variance"],
+        },
+        "mask_file": mask_file,
+        "qa_record": qa_record,
+        "output_files": output_files,
+        "session_record": session_record,
+    }
+
+
+def run_all_sessions(files, n_jobs, render_figures=True, **session_kwargs):
+    """
+    Runs run_session() for every data file, serially (n_jobs=1) or in a process
+    pool of n_jobs workers.  Each worker handles one session at a time and is
+    replaced after it, so peak memory is bounded by n_jobs sessions.  Sessions
+    only write their own QA/exclusion records: the outputs shared across sessions
+    and subjects (html summary, excluded_subject.csv) are rendered from all
+    records once all jobs are done (run_lev1_units.py --render_qa,
+    render_qa_summary.py), so concurrent jobs never overwrite each other's rows.
+    The QA figures of a session are rendered in a background process as soon as
+    the session finishes, while the next sessions are fit.  With render_figures
+    False they are not rendered at all (render_qa_summary.py renders them on
+    demand) and matplotlib is never imported.
+    output:
+        list of run_session() outputs in the order of files["data_file"]
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    contrast_dir = session_kwargs["contrast_dir"]
+    figure_pool = ProcessPoolExecutor(max_workers=1) if render_figures else None
+    figure_futures = []
+
+    def submit_figures(session_output):
+        if figure_pool is not None:
+            figure_futures.append(
+                figure_pool.submit(
+                    render_missing_figures, contrast_dir, [session_output["qa_record"]]
+                )
+            )
+
+    if n_jobs == 1:
+        session_outputs = []
+        for data_file in files["data_file"]:
+            session_output = run_session(data_file, files, **session_kwargs)
+            submit_figures(session_output)
+            session_outputs.append(session_output)
+    else:
+        # split the allocated CPUs between workers so BLAS threads don't oversubscribe
+        threads_per_job = str(max(1, len(os.sched_getaffinity(0)) // n_jobs))
+        for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+            os.environ.setdefault(var, threads_per_job)
+
+        with ProcessPoolExecutor(max_workers=n_jobs, max_tasks_per_child=1) as pool:
+            futures = [
+                pool.submit(run_session, data_file, files, **session_kwargs)
+                for data_file in files["data_file"]
+            ]
+            for future in as_completed(futures):
+                submit_figures(future.result())
+            session_outputs = [future.result() for future in futures]
+
+    if figure_pool is not None:
+        for future in figure_futures:
+            future.result()
+        figure_pool.shutdown()
+    return session_outputs
+
+
 def get_parser():
     """Build parser object"""
     parser = ArgumentParser(
@@ -266,16 +717,104 @@ def get_parser():
     parser.add_argument(
         "--residuals",
         action="store_true",
-        help=("Use this flag to create residual images"),
+        help=(
+            "Use this flag to also save residual images.  Contrast estimates and "
+            "residuals come from the same model fit."
+        ),
+    )
+    parser.add_argument(
+        "--n_jobs",
+        "--n-jobs",
+        action="store",
+        type=int,
+        default=1,
+        help=(
+            "Number of sessions to build, QA and fit concurrently (process pool). "
+            "Peak memory scales with this number."
+        ),
+    )
+    parser.add_argument(
+        "--stacked_contrasts",
+        action="store_true",
+        help=(
+            "Write one multi-volume file per statistic (effect size, variance, "
+            "z score) per session instead of one file per contrast.  Contrast "
+            "order is saved in a _contrasts.json file."
+        ),
+    )
+    parser.add_argument(
+        "--uncompressed_intermediates",
+        action="store_true",
+        help=(
+            "Write the session images (contrast estimates, residuals) as "
+            "uncompressed .nii files, which the fixed effects, level 2 and "
+            "visualization read as memory mapped views instead of inflating gzip. "
+            "The fixed effects maps are always written compressed."
+        ),
+    )
+    parser.add_argument(
+        "--no_design_cache",
+        action="store_true",
+        help=(
+            "Always build design matrices from the events/confounds files instead "
+            "of reusing designs cached (by file content and design parameters) in "
+            "{outdir}/design_cache."
+        ),
+    )
+    parser.add_argument(
+        "--sessions",
+        nargs="+",
+        help=(
+            "Only (re)run these sessions (e.g. ses-01 ses-03).  The other sessions "
+            "keep the outputs recorded in the run manifest of an earlier run with "
+            "the same options and enter the fixed effects with their estimates "
+            "from disk.  Used by run_incremental.py."
+        ),
+    )
+    parser.add_argument(
+        "--no_bold_cache",
+        action="store_true",
+        help=(
+            "Mask and smooth the BOLD runs without caching the result.  By default "
+            "the (time x voxels) matrix is cached in {outdir}/bold_cache, keyed by "
+            "the content of the BOLD and mask files, and reused by the other RT "
+            "models and reruns."
+        ),
+    )
+    parser.add_argument(
+        "--max_memory",
+        "--max-memory",
+        type=parse_memory,
+        help=(
+            "Memory budget of the model fits (e.g. 4G), shared by the --n_jobs "
+            "sessions.  The masked voxels are fit in blocks sized to the budget and "
+            "the results are streamed into memory mapped arrays, so peak memory is "
+            "set by the budget instead of the volume size (plus ~0.5G per process). "
+            "Estimates match the whole run fit to numerical precision.  Default: "
+            "whole runs are fit in memory."
+        ),
+    )
+    parser.add_argument(
+        "--no_figures",
+        action="store_true",
+        help=(
+            "Do not render the QA figures (matplotlib is not imported).  The QA "
+            "arrays are still stored, render_qa_summary.py renders the figures "
+            "when the report is needed."
+        ),
     )
     return parser
 
 
 if __name__ == "__main__":
-    from nilearn.glm.first_level import FirstLevelModel
-    from nilearn.glm.contrasts import compute_fixed_effects
+    from utils_lev1.fixed_effects import (
+        build_fixed_effects_manifest,
+        compute_subject_fixed_effects,
+        load_session_estimates,
+    )
 
-    opts = get_parser().parse_args(sys.argv[1:])
+    parser = get_parser()
+    opts = parser.parse_args(sys.argv[1:])
     qa_only = opts.qa_only
     subid = opts.subid
     regress_rt = opts.regress_rt
@@ -308,132 +847,150 @@ if __name__ == "__main__":
         == total_num_files & len(files["events_file"])
         == total_num_files
     )
-    effect_size_files = {}
-    variance_files = {}
-
-    for data_file in files["data_file"]:
-        ses = data_file.split("/")[-3]
-        event_file = [i for i in files["events_file"] if ses in i][0]
-        confounds_file = [i for i in files["confounds_file"] if ses in i][0]
-        mask_file = [i for i in files["mask_file"] if ses in i][0]
-        n_scans = get_nscans(data_file)
-        design_matrix, contrasts, tr, percent_junk, events_df = make_desmat_contrasts(
-            root,
-            task,
-            event_file,
-            duration_choice,
-            add_deriv,
-            n_scans,
-            confounds_file,
-            regress_rt,
-        )
-
-        if simplified_events:
-            if not os.path.exists(f"{contrast_dir}/simplified_events"):
-                os.makedirs(f"{contrast_dir}/simplified_events")
-            simplified_filename = f"{contrast_dir}/simplified_events/sub-{subid}_{ses}_task-{task}_simplified-events.csv"
-            events_df.to_csv(simplified_filename)
-
-        exclusion, any_fail = qa_design_matrix(
-            contrast_dir,
-            contrasts,
-            design_matrix,
-            subid,
-            task,
-            ses,
-            percent_junk=percent_junk,
-        )
-
-        add_to_html_summary(
-            subid,
-            contrasts,
-            design_matrix,
-            contrast_dir,
-            regress_rt,
-            duration_choice,
-            task,
-            any_fail,
-            exclusion,
-            ses,
-            percent_junk,
-        )
-
-        if not any_fail and qa_only == False:
-            print(f"Running model for {data_file}")
-            if not residuals:
-                fmri_glm = FirstLevelModel(
-                    tr,
-                    subject_label=subid,
-                    mask_img=mask_file,
-                    noise_model="ar1",
-                    standardize=False,
-                    drift_model=None,
-                    smoothing_fwhm=5,
-                    minimize_memory=True,
-                )
-
-                out = fmri_glm.fit(data_file, design_matrices=design_matrix)
-
-                contrast_names = []
-                for con_name, con in contrasts.items():
-                    con_est = out.compute_contrast(con, output_type="all")
-                    contrast_names.append(con_name)
-                    effect_size_filename = (
-                        f"{contrast_dir}/contrast_estimates/sub-{subid}_{ses}_task-{task}_contrast-{con_name}"
-                        f"_rtmodel-{regress_rt}_stat"
-                        f"-effect-size.nii.gz"
-                    )
-                    con_est["effect_size"].to_filename(effect_size_filename)
-                    variance_filename = (
-                        f"{contrast_dir}/contrast_estimates/sub-{subid}_{ses}_task-{task}_contrast-{con_name}"
-                        f"_rtmodel-{regress_rt}_stat"
-                        f"-variance.nii.gz"
-                    )
-                    con_est["effect_variance"].to_filename(variance_filename)
-                    zscore_filename = (
-                        f"{contrast_dir}/contrast_estimates/sub-{subid}_{ses}_task-{task}_contrast-{con_name}"
-                        f"_rtmodel-{regress_rt}_stat"
-                        f"-z_score.nii.gz"
-                    )
-                    con_est["z_score"].to_filename(zscore_filename)
-                print(f"Contrast names: {contrast_names}")
-                contrast_names.remove("task-baseline")
-
-            # saving residuals for Mahalanobis distance analysis
-            if residuals:
-                fmri_glm = FirstLevelModel(
-                    tr,
-                    subject_label=subid,
-                    mask_img=mask_file,
-                    noise_model="ar1",
-                    standardize=False,
-                    drift_model=None,
-                    smoothing_fwhm=5,
-                    minimize_memory=False,
-                )
-                out = fmri_glm.fit(data_file, design_matrices=design_matrix)
-
-                residuals_filename = f"{contrast_dir}/contrast_estimates/sub-{subid}_{ses}_task-{task}_rtmodel-{regress_rt}_residuals.nii.gz"
-                fmri_glm.residuals[0].to_filename(residuals_filename)
-
-    if fixed_effects:
-        for con_name, con in contrasts.items():
-            effect_size_files = sorted(
-                glob.glob(
-                    f"{contrast_dir}/contrast_estimates/sub-{subid}_*contrast-{con_name}*effect-size.nii.gz"
-                )
+    # options recorded in the run manifest (they change the outputs, n_jobs does not)
+    unit_options = {
+        "qa_only": qa_only,
+        "fixed_effects": fixed_effects,
+        "simplified_events": simplified_events,
+        "residuals": residuals,
+        "stacked_contrasts": opts.stacked_contrasts,
+        "omit_deriv": opts.omit_deriv,
+        "uncompressed_intermediates": opts.uncompressed_intermediates,
+    }
+    previous_manifest = load_unit_manifest(contrast_dir, subid, task, regress_rt, qa_only)
+    all_data_files = files["data_file"]
+    if opts.sessions:
+        if not previous_manifest or previous_manifest["options"] != unit_options:
+            parser.error(
+                "--sessions needs the run manifest of an earlier run with the same options"
             )
-            variance_files = sorted(
-                glob.glob(
-                    f"{contrast_dir}/contrast_estimates/sub-{subid}_*contrast-{con_name}*variance.nii.gz"
-                )
+        files["data_file"] = [
+            data_file for data_file in all_data_files if data_file.split("/")[-3] in opts.sessions
+        ]
+        if len(files["data_file"]) != len(set(opts.sessions)):
+            parser.error(f"--sessions {opts.sessions}: not all sessions found for sub-{subid}")
+        if not {
+            data_file.split("/")[-3] for data_file in all_data_files
+        } - set(opts.sessions) <= set(previous_manifest["sessions"]):
+            parser.error("--sessions: the other sessions are not in the run manifest")
+    session_outputs = run_all_sessions(
+        files,
+        opts.n_jobs,
+        root=root,
+        subid=subid,
+        task=task,
+        regress_rt=regress_rt,
+        add_deriv=add_deriv,
+        duration_choice=duration_choice,
+        contrast_dir=contrast_dir,
+        qa_only=qa_only,
+        simplified_events=simplified_events,
+        residuals=residuals,
+        stacked_contrasts=opts.stacked_contrasts,
+        design_cache_dir=None if opts.no_design_cache else f"{outdir}/design_cache",
+        render_figures=not opts.no_figures,
+        uncompressed_intermediates=opts.uncompressed_intermediates,
+        bold_cache_dir=None if opts.no_bold_cache else f"{outdir}/bold_cache",
+        # the budget is shared by the sessions fit concurrently
+        max_memory=None if opts.max_memory is None else opts.max_memory // opts.n_jobs,
+    )
+
+    # sessions that were not rerun keep their run manifest entries
+    session_records = {}
+    if opts.sessions:
+        session_records = {
+            ses: session_record
+            for ses, session_record in previous_manifest["sessions"].items()
+            if ses not in opts.sessions
+        }
+    for session_output in session_outputs:
+        session_records[session_output["ses"]] = session_output["session_record"]
+    session_records = dict(sorted(session_records.items()))
+
+    fixed_effects_outputs = []
+    manifest = None
+    if fixed_effects and opts.sessions:
+        # the sessions that were not rerun enter the fixed effects with their
+        # estimates from disk (float64, identical to the in-memory ones)
+        for data_file in all_data_files:
+            ses, _, _, mask_file = get_session_files(files, data_file)
+            if ses in opts.sessions or not session_records[ses]["fit"]:
+                continue
+            contrast_names = session_records[ses]["contrasts"]
+            session_outputs.append(
+                {
+                    "ses": ses,
+                    "contrasts": contrast_names,
+                    "estimates": load_session_estimates(
+                        get_session_contrast_filenames(
+                            contrast_dir,
+                            subid,
+                            ses,
+                            task,
+                            regress_rt,
+                            contrast_names,
+                            opts.stacked_contrasts,
+                            opts.uncompressed_intermediates,
+                        ),
+                        mask_file,
+                        opts.stacked_contrasts,
+                    ),
+                    "mask_file": mask_file,
+                }
             )
-            fixed_fx_contrast, fixed_fx_variance, fixed_fx_stat = compute_fixed_effects(
-                effect_size_files, variance_files, precision_weighted=True
+        session_outputs.sort(key=lambda session_output: session_output["ses"])
+    if fixed_effects:
+        # sessions (per contrast) whose estimates enter the fixed effects
+        manifest = build_fixed_effects_manifest(session_outputs)
+        if manifest:
+            fixed_fx_stat_imgs = compute_subject_fixed_effects(session_outputs, manifest)
+        else:
+            # nothing was fit in this run (--qa_only or all sessions failed QA):
+            # resume from the session estimates previously written to disk
+            written_outputs = load_written_session_outputs(
+                session_outputs,
+                contrast_dir,
+                subid,
+                task,
+                regress_rt,
+                opts.stacked_contrasts,
+                opts.uncompressed_intermediates,
             )
+            manifest = build_fixed_effects_manifest(written_outputs)
+            if manifest:
+                fixed_fx_stat_imgs = compute_subject_fixed_effects(written_outputs, manifest)
+            else:
+                print("No session estimates found, skipping fixed effects")
+                fixed_fx_stat_imgs = {}
+        manifest_filename = (
+            f"{contrast_dir}/contrast_estimates/sub-{subid}_task-{task}_rtmodel-{regress_rt}"
+            + "_fixed-effects_sessions.json"
+        )
+        with open(manifest_filename, "w") as f:
+            json.dump(manifest, f, indent=1)
+        fixed_effects_outputs.append(
+            (manifest_filename, sorted({ses for sessions in manifest.values() for ses in sessions}))
+        )
+        for con_name, fixed_fx_stat in fixed_fx_stat_imgs.items():
             fixed_effects_filename = (
                 f"{contrast_dir}/contrast_estimates/sub-{subid}_task-{task}_contrast-{con_name}_rtmodel-{regress_rt}"
                 + "_stat-fixed-effects_t-test.nii.gz"
             )
             fixed_fx_stat.to_filename(fixed_effects_filename)
+            fixed_effects_outputs.append((fixed_effects_filename, manifest[con_name]))
+
+    # record the completed run (per output: input hashes, design, code version),
+    # so the schedulers (make_lev1_batch_files.py, run_incremental.py) can skip
+    # it, or rerun only the sessions that changed
+    run_manifest = write_unit_manifest(
+        contrast_dir,
+        subid,
+        task,
+        regress_rt,
+        unit_options,
+        session_records,
+        manifest,
+        fixed_effects_outputs,
+    )
+    remove_stale_outputs(contrast_dir, previous_manifest, run_manifest)
     # -
@@ -10,8 +10,22 @@ from pathlib import Path
 import stat 
 import re
 import sys   
-from argparse import ArgumentParser
+import fnmatch
+from contextlib import contextmanager
+from argparse import ArgumentParser, ArgumentTypeError
 from argparse import RawTextHelpFormatter
+from utils_lev1.run_manifest import write_lev2_manifest
+from utils_lev1.chunked_glm import parse_memory
+from utils_lev1.contrast_catalog import (
+    lev1_maps_root,
+    get_catalog_file,
+    load_contrast_catalog,
+    refresh_contrast_catalog,
+    find_lev1_maps,
+    get_lev1_contrast_dir,
+)
+
+lev2_output_root = '/oak/stanford/groups/russpold/data/uh2/aim1_mumford/output'
   
 rt_subset_dict = {
     'stroop': 'junk == False',
@@ -37,17 +51,18 @@ rt_trial_grouping = {
     'motorSelectiveStop': ['trial_type']
 }
 
+# applied to a (subjects x trial groups) frame of mean RTs, one value per subject
 rt_diff_definition = {
-    'stroop': lambda rt_mean_by_group: float(rt_mean_by_group['incongruent'] - rt_mean_by_group['congruent']),
-    'ANT': lambda rt_mean_by_group: float(((rt_mean_by_group['double_incongruent'] + rt_mean_by_group['spatial_incongruent'])/2  
-            - (rt_mean_by_group['double_congruent'] + rt_mean_by_group['spatial_congruent'])/2)),
+    'stroop': lambda rt_mean_by_group: rt_mean_by_group['incongruent'] - rt_mean_by_group['congruent'],
+    'ANT': lambda rt_mean_by_group: ((rt_mean_by_group['double_incongruent'] + rt_mean_by_group['spatial_incongruent'])/2  
+            - (rt_mean_by_group['double_congruent'] + rt_mean_by_group['spatial_congruent'])/2),
     'CCTHot': lambda rt_mean_by_group: None,
-    'stopSignal': lambda rt_mean_by_group: float(rt_mean_by_group['stop_failure'] - rt_mean_by_group['go']),
-    'twoByTwo': lambda rt_mean_by_group: float(rt_mean_by_group['900_task_switch'] - rt_mean_by_group['900_task_stay_cue_switch']),
+    'stopSignal': lambda rt_mean_by_group: rt_mean_by_group['stop_failure'] - rt_mean_by_group['go'],
+    'twoByTwo': lambda rt_mean_by_group: rt_mean_by_group['900_task_switch'] - rt_mean_by_group['900_task_stay_cue_switch'],
     'WATT3': lambda rt_mean_by_group: None,
-    'discountFix': lambda rt_mean_by_group: float(rt_mean_by_group['larger_later'] - rt_mean_by_group['smaller_sooner']),
-    'DPX': lambda rt_mean_by_group: float(rt_mean_by_group['AY'] - rt_mean_by_group['BY']),
-    'motorSelectiveStop': lambda rt_mean_by_group: float(rt_mean_by_group['crit_go'] - rt_mean_by_group['noncrit_signal'])
+    'discountFix': lambda rt_mean_by_group: rt_mean_by_group['larger_later'] - rt_mean_by_group['smaller_sooner'],
+    'DPX': lambda rt_mean_by_group: rt_mean_by_group['AY'] - rt_mean_by_group['BY'],
+    'motorSelectiveStop': lambda rt_mean_by_group: rt_mean_by_group['crit_go'] - rt_mean_by_group['noncrit_signal']
 }
 
 
@@ -63,86 +78,148 @@ rt_diff_dv_checker = {
     'motorSelectiveStop': 'crit_go-noncrit_nosignal'
 }
 
+confounds_btwn_sub_file = (
+    "/home/groups/russpold/uh2_analysis/Self_Regulation_Ontology_fMRI_2021/"
+    "fmri_analysis/scripts/aim1_2ndlevel_regressors/"
+    "aim1_2ndlevel_confounds_matrix.csv"
+)
+
 contrast_definition_by_model = {
     'one_sampt': [['intercept']], 
     'rt_diff': [['intercept'], ['rt_diff']],
     'rt_diff_w_confounds': [['rt_diff']]
 }
 
-def check_valid_contrasts():
-    """Used to keep potential contrast names up to date in parser
-       Does require subject 497 has been analyzed
+def check_valid_contrast(lev1_task_contrast):
+    """
+    argparse type of lev1_task_contrast: it must be in the level 1 contrast
+    catalog (utils_lev1/contrast_catalog.py), which is refreshed once if it is
+    not there yet
     """
-    import glob
-    possible_task_contrasts_sub_497 = glob.glob(
-        "/oak/stanford/groups/russpold/data/uh2/aim1_mumford/output/"
-        "*_lev1_output/contrast*/*497_*"
+    if (lev1_task_contrast in load_contrast_catalog(lev1_maps_root)['contrasts']
+            or lev1_task_contrast in refresh_contrast_catalog(lev1_maps_root)['contrasts']):
+        return lev1_task_contrast
+    raise ArgumentTypeError(
+        f'{lev1_task_contrast} is not in the level 1 contrast catalog '
+        f'({get_catalog_file(lev1_maps_root)}), see analyze_lev2.py refresh --list'
     )
-    task_con_names = []
-    
-    for contrast in possible_task_contrasts_sub_497:
-        contrast_file = contrast.split('/')[-1]
-        con_name = re.search('_contrast_(.*)_sub_', contrast_file).group(1)
-        task_name = re.search('task_(.*)_contrast_', contrast_file).group(1)
-        rt_model = re.search('_rtmodel_(.*)_duration_', contrast_file).group(1)
-        duration = re.search('_duration_(.*)_stat_', contrast_file).group(1)
-        task_con_names.append(f"{task_name}:{con_name}:{rt_model}:{duration}")
-    return task_con_names        
-
-
-def get_design_mat_row_subject(
-    subid, task, root, rt_subset_dict, rt_trial_grouping, rt_diff_definition,
-    model_lev2, confounds_btwn_sub
-):
-    confounds_this_sub = confounds_btwn_sub.loc[confounds_btwn_sub['index'] == f"s{subid}"]
-    confounds_file = glob.glob(
-        f'{root}/derivatives/fmriprep/sub-s{subid}/ses-[0-9]/func/*{task}*confounds*.tsv'
-    )[0]
-    confounds_within_sub= pd.read_csv(confounds_file, sep = '\t')
-    events_tsv_file = glob.glob(
-        f'{root}/sub-s{subid}/ses-[0-9]/func/*{task}*tsv'
-    )[0]
-    events_tsv = pd.read_csv(events_tsv_file, sep = '\t')
-    if confounds_btwn_sub['index'].str.contains(f's{subid}').any():
-        age = float(confounds_this_sub['age'])
-        sex = int(confounds_this_sub['sex'])
-        meanFD = confounds_within_sub['framewise_displacement'].mean()
-    else:
-        age = sex = meanFD = np.nan
-    
+
+
+def get_first_file_by_subject(file_pattern):
+    """
+    One glob for all subjects (file_pattern with sub-s*): the first file (sorted)
+    of each subject, keyed by subid
+    """
+    files = {}
+    for filename in sorted(glob.glob(file_pattern)):
+        subid = re.search('/sub-s([^/]*)/ses-', filename).group(1)
+        files.setdefault(subid, filename)
+    return files
+
+
+def load_long_table(files_by_subject, sub_list, usecols=None):
+    """
+    The tsv files of the subjects stacked into one table with a subid column
+    (subjects without a file have no rows)
+    """
+    tables = {subid: pd.read_csv(files_by_subject[subid], sep='\t', usecols=usecols)
+              for subid in sub_list if subid in files_by_subject}
+    if not tables:
+        return pd.DataFrame(columns=['subid'] + list(usecols or []))
+    return pd.concat(tables, names=['subid', None]).reset_index(level='subid')
+
+
+def get_rt_means(events, task):
+    """
+    Mean RT per subject and trial group (rt_trial_grouping) of the trials in
+    rt_subset_dict, from the events of all subjects in one grouped aggregation
+    output:
+        (subjects x trial groups) data frame, indexed by subid
+    """
+    grouping = rt_trial_grouping[task]
+    if isinstance(grouping, str):
+        grouping = [grouping]
+    events_for_rt = events.query(rt_subset_dict[task]).copy()
+    # trial groups are labelled by their values as strings (nan included)
+    events_for_rt[grouping] = events_for_rt[grouping].astype(str)
+    rt_mean_by_group = (events_for_rt.groupby(['subid'] + grouping)['response_time']
+                        .mean().unstack(grouping))
+    rt_mean_by_group.columns = \
+        ['_'.join(col) if type(col) is tuple else col for col in rt_mean_by_group.columns.values]
+    if task == 'twoByTwo':
+        rename_dict = {
+            '100.0_nan_switch': '100_task_switch',
+            '100.0_stay_stay': '100_cue_stay',
+            '100.0_switch_stay': '100_task_stay_cue_switch',
+            '900.0_nan_switch': '900_task_switch',
+            '900.0_stay_stay': '900_cue_stay',
+            '900.0_switch_stay': '900_task_stay_cue_switch'
+        }
+        rt_mean_by_group.rename(columns=rename_dict, inplace=True)
+    return rt_mean_by_group
+
+
+def load_behavior_tables(sub_list, task, root, events=True):
+    """
+    The first confounds file (and events file) of every subject, found with one
+    glob per file type and read into one long table with a subid column
+    output:
+        dictionary with confounds_within_sub and events (None if events=False)
+    """
+    confounds_files = get_first_file_by_subject(
+        f'{root}/derivatives/fmriprep/sub-s*/ses-[0-9]/func/*{task}*confounds*.tsv'
+    )
+    behavior_tables = {
+        'confounds_within_sub': load_long_table(confounds_files, sub_list,
+                                                usecols=['framewise_displacement']),
+        'events': None,
+    }
+    if events:
+        events_files = get_first_file_by_subject(f'{root}/sub-s*/ses-[0-9]/func/*{task}*tsv')
+        behavior_tables['events'] = load_long_table(events_files, sub_list)
+    return behavior_tables
+
+
+def build_between_subject_design(sub_list, task, root, model_lev2, confounds_btwn_sub,
+                                 behavior_tables=None):
+    """
+    Between subject design of all subjects at once: mean framewise displacement
+    and mean RTs are grouped aggregations over the long tables of all subjects
+    (load_behavior_tables) and age/sex are looked up by subject in the between
+    subject confounds.  Subjects missing from the between subject confounds get
+    NaN age, sex and meanFD, subjects without files NaN values.
+    input:
+        behavior_tables: load_behavior_tables output covering sub_list (it may
+            have other subjects too), loaded here if None
+    output:
+        desmat_all: (subjects x regressors) array in the order of sub_list, NaN
+            where a value is missing
+        regressor_names: list of regressor names
+    """
+    subject_index = pd.Index([f's{subid}' for subid in sub_list])
+    listed = subject_index.isin(confounds_btwn_sub['index'])
+    covariates = confounds_btwn_sub.set_index('index').reindex(subject_index)
+    age = covariates['age'].to_numpy(dtype=float)
+    sex = covariates['sex'].to_numpy(dtype=float)
+    if 'rt' in model_lev2 and rt_trial_grouping[task] is None:
+        raise ValueError((f"Task {task} is not compatable "
+                            f"with modelling RT"))
+    if behavior_tables is None:
+        behavior_tables = load_behavior_tables(sub_list, task, root, 'rt' in model_lev2)
+    meanFD = (behavior_tables['confounds_within_sub']
+              .groupby('subid')['framewise_displacement'].mean()
+              .reindex(sub_list).to_numpy(dtype=float))
+    meanFD[~listed] = np.nan
+    intercept = np.ones(len(sub_list))
+
     if 'rt' in model_lev2:
-        events_for_rt = events_tsv.query(rt_subset_dict[task])
-        rt_mean = events_for_rt['response_time'].mean()
-        # This avoids setting with copy warning.  Jesus.
-        for val in rt_trial_grouping[task]:
-            new_col = events_for_rt[val].astype(str)
-            events_for_rt = events_for_rt.drop(val, axis = 1)
-            events_for_rt[val] = new_col
-
-        rt_mean_by_group = events_for_rt.groupby(rt_trial_grouping[task])['response_time'].mean()
-        rt_mean_by_group = rt_mean_by_group.to_frame().transpose()
-        rt_mean_by_group.columns = \
-            ['_'.join(col) if type(col) is tuple else col for col in rt_mean_by_group.columns.values]
-        if task == 'twoByTwo':
-            rename_dict = {
-                '100.0_nan_switch': '100_task_switch',
-                '100.0_stay_stay': '100_cue_stay',
-                '100.0_switch_stay': '100_task_stay_cue_switch',
-                '900.0_nan_switch': '900_task_switch',
-                '900.0_stay_stay': '900_cue_stay',
-                '900.0_switch_stay': '900_task_stay_cue_switch'
-            }
-            rt_mean_by_group.rename(columns=rename_dict, inplace=True)
-        rt_diff = rt_diff_definition[task](rt_mean_by_group)
-        if rt_diff == None:
-            raise ValueError((f"Task {task} is not compatable "
-                                f"with modelling RT"))
+        rt_mean_by_group = get_rt_means(behavior_tables['events'], task).reindex(sub_list)
+        rt_diff = rt_diff_definition[task](rt_mean_by_group).to_numpy(dtype=float)
         designs = {
-            'rt_diff': np.array([1, float(rt_diff)]),
-            'rt_diff_w_confounds': np.array([1, float(rt_diff), age, sex, meanFD]),
-            'all_rts_w_confounds': np.array([1] + 
-                                list(rt_mean_by_group.loc['response_time']) + 
-                                [age, sex, meanFD])
+            'rt_diff': np.column_stack([intercept, rt_diff]),
+            'rt_diff_w_confounds': np.column_stack([intercept, rt_diff, age, sex, meanFD]),
+            'all_rts_w_confounds': np.column_stack(
+                [intercept, rt_mean_by_group.to_numpy(dtype=float), age, sex, meanFD]),
         }
         regressor_names = {
             'rt_diff': ['intercept', 'rt_diff'],
@@ -150,50 +227,60 @@ def get_design_mat_row_subject(
             'all_rts_w_confounds': ['intercept'] + list(rt_mean_by_group) + ['age', 'sex', 'meanFD'],
         }
     if 'rt' not in  model_lev2:
-        designs = {'confounds_only': np.array([1, age, sex, meanFD])}
+        designs = {'confounds_only': np.column_stack([intercept, age, sex, meanFD])}
         regressor_names = {'confounds_only': ['intercept', 'age', 'sex', 'meanFD']}
     return designs[model_lev2], regressor_names[model_lev2]
-    
+
 
 def get_bold_and_sublist(lev1_task_contrast):
-    task, lev1_contrast, rtmodel, duration =  lev1_task_contrast.split(':')
-    lev1_out = (f'/oak/stanford/groups/russpold/data/uh2/aim1_mumford/output/'
-                f'{task}_lev1_output/contrasts_task_{task}_rtmodel_{rtmodel}_'
-                f'duration_{duration}')
-    bold_files = sorted(
-    glob.glob(f"{lev1_out}/*_contrast_{lev1_contrast}*rtmodel_{rtmodel}_duration_{duration}*")
-    )
-    sub_list = [re.search('_sub_(.*)_rtmodel_', val).group(1) for val in bold_files]
+    """
+    Subjects and level 1 maps of a contrast (the files the contrast catalog is
+    built from, see contrast_catalog.find_lev1_maps)
+    """
+    return find_lev1_maps(lev1_maps_root, lev1_task_contrast)
+
+
+def get_lev1_maps(lev1_task_contrast):
+    """get_bold_and_sublist, ValueError if the contrast has no maps (e.g. stale catalog)"""
+    sub_list, bold_files = get_bold_and_sublist(lev1_task_contrast)
+    if not bold_files:
+        task, _, rtmodel, duration = lev1_task_contrast.split(':')
+        raise ValueError(
+            f'{lev1_task_contrast} has no level 1 maps in '
+            f'{get_lev1_contrast_dir(lev1_maps_root, task, rtmodel, duration)}, '
+            f'see analyze_lev2.py refresh'
+        )
     return sub_list, bold_files
 
 
 def build_desmat_all(
     lev1_task_contrast, model_lev2, root, rt_subset_dict, rt_trial_grouping, 
-    rt_diff_definition, rt_diff_dv_checker
+    rt_diff_definition, rt_diff_dv_checker, confounds_btwn_sub=None,
+    sub_list_and_files=None, behavior_tables=None
 ):
+    """
+    Level 2 design of a level 1 contrast and the subjects with complete data
+    input:
+        confounds_btwn_sub, sub_list_and_files (get_bold_and_sublist output),
+            behavior_tables (load_behavior_tables output): shared by the models
+            of a batch, loaded here if None
+    """
     task, lev1_contrast, rtmodel, duration =  lev1_task_contrast.split(':')
-    confounds_btwn_sub_file = (
-        "/home/groups/russpold/uh2_analysis/Self_Regulation_Ontology_fMRI_2021/"
-        "fmri_analysis/scripts/aim1_2ndlevel_regressors/"
-        "aim1_2ndlevel_confounds_matrix.csv"
-    )
-    confounds_btwn_sub = pd.read_csv(confounds_btwn_sub_file)
+    if confounds_btwn_sub is None:
+        confounds_btwn_sub = pd.read_csv(confounds_btwn_sub_file)
     if model_lev2 == 'rt_diff' or model_lev2 == 'rt_diff_w_confounds':
         if lev1_contrast != rt_diff_dv_checker[task]:
             raise ValueError((f"Contrast {lev1_contrast} is not compatable "
                               f"with model {model_lev2}.  Only contrast "
                               f"{rt_diff_dv_checker[task]} can be used."))
 
-    sub_list, bold_files = get_bold_and_sublist(lev1_task_contrast)
-    desmat_all = []
+    if sub_list_and_files is None:
+        sub_list_and_files = get_bold_and_sublist(lev1_task_contrast)
+    sub_list, bold_files = sub_list_and_files
     if model_lev2 != 'one_sampt':
-        for subid in sub_list:    
-            design, regressor_names = get_design_mat_row_subject(
-                 subid, task, root, rt_subset_dict, rt_trial_grouping, 
-                 rt_diff_definition, model_lev2, confounds_btwn_sub
-            )
-            desmat_all.append(design)
-        desmat_all = np.array(desmat_all)
+        desmat_all, regressor_names = build_between_subject_design(
+            sub_list, task, root, model_lev2, confounds_btwn_sub, behavior_tables
+        )
         rows_with_missing = np.isnan(desmat_all).any(axis = 1)
         desmat_final = desmat_all[~rows_with_missing, :]
         #desmat_final = desmat_final - desmat_final.mean(axis = 0, keepdims=True)
@@ -218,20 +305,224 @@ def build_desmat_all(
     return desmat_final, bold_files_final, regressor_names, summary_missing
 
   
-def make_4d_data_mask(bold_files_final, outdir, lev1_task_contrast):
-    from nilearn.maskers import NiftiMasker
+def get_lev2_outdir(lev1_task_contrast, model_lev2):
     task, lev1_contrast, rtmodel, duration =  lev1_task_contrast.split(':')
-    data4d = nf.funcs.concat_images(bold_files_final)
-    filename_root = (f'{outdir}/{task}_lev1_contrast_{lev1_contrast}_rtmod_{rtmodel}_'
-              f'duration_{duration}')
-    data4d.to_filename(f'{filename_root}.nii.gz')
+    return Path(f"{lev2_output_root}/"
+              f"{task}_lev2_output/{task}_lev1_contrast_{lev1_contrast}_rtmod_{rtmodel}_"
+              f"duration_{duration}_lev2_model_{model_lev2}/")
 
-    mask = NiftiMasker().fit(data4d).mask_img_
+
+def get_filename_root(outdir, lev1_task_contrast):
+    task, lev1_contrast, rtmodel, duration =  lev1_task_contrast.split(':')
+    return (f'{outdir}/{task}_lev1_contrast_{lev1_contrast}_rtmod_{rtmodel}_'
+            f'duration_{duration}')
+
+
+@contextmanager
+def atomic_output_dir(outdir):
+    """
+    Yields a temporary directory next to outdir for the outputs of a model, that
+    replaces outdir once they are all written: outdir never holds a partial or
+    mixed set of outputs, and a failed model leaves the previous outputs
+    """
+    import os
+    import tempfile
+    outdir = Path(outdir)
+    outdir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=outdir.parent, prefix=f'.{outdir.name}.'))
+    try:
+        yield tmp_dir
+    except BaseException:
+        shutil.rmtree(tmp_dir)
+        raise
+    # mkdtemp creates the directory user only, give it the usual permissions
+    umask = os.umask(0)
+    os.umask(umask)
+    tmp_dir.chmod(0o777 & ~umask)
+    if outdir.exists():
+        old_dir = Path(tempfile.mkdtemp(dir=outdir.parent, prefix=f'.{outdir.name}.old.'))
+        os.replace(outdir, old_dir)
+        os.replace(tmp_dir, outdir)
+        shutil.rmtree(old_dir)
+    else:
+        os.replace(tmp_dir, outdir)
+
+
+def mask_lev1_maps(bold_files, subsets, masked_files, work_dir):
+    """
+    Reads the level 1 maps once and stacks, for each subset of the subjects,
+    its maps into a (subjects in subset x voxels in mask) float32 matrix with
+    the group mask of the subset.  Each volume is appended to a temporary memory
+    mapped stack while the group masks are accumulated from the running sums
+    (same mask as NiftiMasker().fit on the 4D image of the subset: voxels whose
+    mean differs from the background, the median of the mean image border),
+    then the masked columns are copied out a subject at a time.
+    input:
+        subsets: list of boolean arrays over bold_files
+        masked_files: .npy file the matrix of each subset is memory mapped from
+        work_dir: directory of the temporary stack
+    output:
+        list of (data, mask) per subset
+    """
+    import os
+    import tempfile
+    from nilearn.image import new_img_like
+    from nilearn.masking import get_border_data
+
+    first_img = nf.load(bold_files[0])
+    fd, volumes_file = tempfile.mkstemp(dir=work_dir, prefix='.volumes_', suffix='.npy')
+    os.close(fd)
+    try:
+        volumes = np.lib.format.open_memmap(
+            volumes_file, mode='w+', dtype=np.float32,
+            shape=(len(bold_files), int(np.prod(first_img.shape)))
+        )
+        totals = [np.zeros(first_img.shape) for _ in subsets]
+        for idx, bold_file in enumerate(bold_files):
+            img = nf.load(bold_file)
+            if img.shape != first_img.shape or not np.all(img.affine == first_img.affine):
+                raise ValueError(f'{bold_file} does not match the shape/affine of '
+                                 f'{bold_files[0]}')
+            volume = np.asanyarray(img.dataobj)
+            for subset, total in zip(subsets, totals):
+                if subset[idx]:
+                    total += volume
+            volumes[idx] = volume.ravel()
+        masked = []
+        for subset, total, masked_file in zip(subsets, totals, masked_files):
+            rows = np.flatnonzero(subset)
+            mean = total / rows.size
+            if np.isnan(get_border_data(mean, 2)).any():
+                mask_data = np.logical_not(np.isnan(mean))
+            else:
+                mask_data = mean != np.median(get_border_data(mean, 2))
+            mask = new_img_like(first_img, mask_data, first_img.affine)
+            voxels = np.flatnonzero(mask_data)
+            data = np.lib.format.open_memmap(
+                masked_file, mode='w+', dtype=np.float32, shape=(rows.size, voxels.size)
+            )
+            for data_idx, idx in enumerate(rows):
+                data[data_idx] = volumes[idx, voxels]
+            data.flush()
+            masked.append((data, mask))
+        del volumes
+    finally:
+        os.remove(volumes_file)
+    return masked
+
+
+def make_4d_data_mask(bold_files_final, outdir, lev1_task_contrast, write_4d=False):
+    """
+    Stacks the level 1 maps of the subjects into a (subjects x voxels in mask)
+    float32 matrix, memory mapped from {filename_root}_masked.npy, that the html
+    summary and the level 2 model share (see mask_lev1_maps: each map is read
+    once)
+    input:
+        write_4d: also write the 4D image (input of randomise)
+    output:
+        data: (subjects x voxels in mask) float32 memory mapped array
+        mask: group mask image (also written to {filename_root}_mask.nii.gz)
+    """
+    from nilearn.masking import unmask
+    filename_root = get_filename_root(outdir, lev1_task_contrast)
+
+    [(data, mask)] = mask_lev1_maps(
+        bold_files_final, [np.ones(len(bold_files_final), dtype=bool)],
+        [f'{filename_root}_masked.npy'], outdir
+    )
     mask.to_filename(f'{filename_root}_mask.nii.gz')
+    if write_4d:
+        unmask(data, mask).to_filename(f'{filename_root}.nii.gz')
+    return data, mask
 
 
-def make_randomise_files(desmat_final, regressor_names, contrasts, outdir, model_lev2):
+def get_contrast_matrix(regressor_names, contrasts):
     from nilearn.glm.contrasts import expression_to_contrast_vector
+    return np.array([
+        expression_to_contrast_vector(contrast[0], regressor_names)
+        for contrast in contrasts
+    ])
+
+
+def setup_permutation_models(data, desmat_final, regressor_names, contrasts, model_lev2):
+    """
+    Permutation models (utils_lev1/permutation_glm.py) of the contrasts of a
+    level 2 model
+    input:
+        data: subjects x voxels matrix (make_4d_data_mask), rows in the order of
+            the design
+    """
+    from utils_lev1.permutation_glm import setup_contrast_model
+
+    data = np.asarray(data, dtype=np.float64)
+    if model_lev2 == 'one_sampt':
+        desmat_final = np.ones((data.shape[0], 1))
+        regressor_names = ['intercept']
+    contrast_matrix = get_contrast_matrix(regressor_names, contrasts)
+    return [
+        setup_contrast_model(data, desmat_final, contrast) for contrast in contrast_matrix
+    ]
+
+
+def write_permutation_outputs(models, results, contrasts, mask, outdir, model_lev2, seed):
+    """
+    Writes the maps randomise would write (without TFCE), tstat, vox_p_tstat,
+    vox_corrp_tstat, fstat, vox_p_fstat and vox_corrp_fstat for each contrast,
+    with p values stored as 1-p as randomise does, plus a json summary of the
+    tests
+    """
+    from nilearn.masking import unmask
+
+    output_root = f'{outdir}/permutation_output_model_{model_lev2}'
+    summary = []
+    for con_num, (contrast, model, result) in enumerate(
+        zip(contrasts, models, results), start=1
+    ):
+        for stat in ['tstat', 'vox_p_tstat', 'vox_corrp_tstat',
+                     'fstat', 'vox_p_fstat', 'vox_corrp_fstat']:
+            values = result[stat]
+            if stat.startswith('vox_'):
+                values = 1 - values
+            unmask(values.astype(np.float32), mask).to_filename(
+                f'{output_root}_{stat}{con_num}.nii.gz'
+            )
+        summary.append({
+            'contrast': contrast[0],
+            'n_perm': result['n_perm'],
+            'shuffles': 'sign_flip' if model['sign_flip'] else 'freedman_lane',
+            'df': int(model['df']),
+            'min_vox_corrp_tstat': float(result['vox_corrp_tstat'].min()),
+            'min_vox_corrp_fstat': float(result['vox_corrp_fstat'].min()),
+        })
+    n_subjects, n_voxels = models[0]['residuals'].shape
+    with open(f'{output_root}_permutation.json', 'w') as f:
+        json.dump({'n_subjects': n_subjects, 'n_voxels': n_voxels,
+                   'seed': seed, 'contrasts': summary}, f, indent=4)
+
+
+def run_permutation_tests(
+    data, mask, desmat_final, regressor_names, contrasts, outdir, model_lev2,
+    n_perm=5000, n_jobs=1, seed=0, max_memory=2**30
+):
+    """
+    Permutation tests of the level 2 model in this process (replaces randomise):
+    sign flipping for the one sample t-test, Freedman-Lane permutations for the
+    models with covariates (see write_permutation_outputs for the outputs)
+    input:
+        data, mask: subjects x voxels matrix and its mask (make_4d_data_mask)
+    """
+    from utils_lev1.permutation_glm import run_permutations
+
+    models = setup_permutation_models(
+        data, desmat_final, regressor_names, contrasts, model_lev2
+    )
+    results = run_permutations(
+        models, n_perm=n_perm, n_jobs=n_jobs, seed=seed, max_memory=max_memory
+    )
+    write_permutation_outputs(models, results, contrasts, mask, outdir, model_lev2, seed)
+
+
+def make_randomise_files(desmat_final, regressor_names, contrasts, outdir, model_lev2):
     if model_lev2 != 'one_sampt':
         num_input_contrasts = desmat_final.shape[0]
         num_regressors = desmat_final.shape[1]
@@ -247,12 +538,8 @@ def make_randomise_files(desmat_final, regressor_names, contrasts, outdir, model
     if model_lev2 == 'one_sampt':
         regressor_names = ['intercept']  
         num_regressors = 1     
-    contrast_matrix = []
+    contrast_matrix = get_contrast_matrix(regressor_names, contrasts)
     num_contrasts = len(contrasts)
-    for contrast in contrasts:
-        contrast_def = expression_to_contrast_vector(
-            contrast[0], regressor_names)
-        contrast_matrix.append(np.array(contrast_def))
     con_path = f'{outdir}/desmat.con' 
     ppheight_and_reqeff = '\t '.join(str(val) for val in [1]*num_contrasts) 
     with open(con_path, 'w') as f:
@@ -331,16 +618,15 @@ def run_it(outdir, model_lev2, lev1_task_contrast):
 
 def make_html_summary(
     desmat_final, bold_files_final, regressor_names, contrasts, 
-    summary_missing, outdir
+    summary_missing, outdir, data, mask
     ):
     import seaborn as sns
     from matplotlib import pyplot as plt
     from nilearn.glm.contrasts import expression_to_contrast_vector
     import base64
     from io import BytesIO
-    from nilearn.plotting import plot_design_matrix, plot_carpet, plot_stat_map
-    from nilearn import masking
-    from statsmodels.stats.outliers_influence import variance_inflation_factor
+    from nilearn.plotting import plot_design_matrix, plot_stat_map
+    from utils_lev1.vif import get_vifs
 
     total_n = len(bold_files_final)
     if summary_missing is not None:
@@ -362,8 +648,7 @@ def make_html_summary(
         correlation_matrix = cor_desmat.to_html()
         vif_data = pd.DataFrame()
         vif_data["feature"] = desmat_pandas.columns
-        vif_data["VIF"] = [variance_inflation_factor(desmat_pandas.values, i)
-                          for i in range(len(desmat_pandas.columns))]
+        vif_data["VIF"] = get_vifs(desmat_pandas.values)
         vif_table = vif_data.to_html()
 
         pairgrid = sns.PairGrid(data=desmat_pandas)
@@ -417,24 +702,31 @@ def make_html_summary(
         html_desmat = ' '
         html_contrast = ''
 
-    data4d = nf.funcs.concat_images(bold_files_final)
-    data4d_array = data4d.get_fdata()
     sub_list_final = [
         re.search('_sub_(.*)_rtmodel_', val).group(1) for val in bold_files_final
     ] 
     
-    data_nonzero = data4d_array[data4d_array.nonzero()]
+    data_nonzero = data[np.nonzero(data)]
     cutoff = np.quantile(np.abs(data_nonzero), .99)
-    mask_img = masking.compute_epi_mask(data4d)
-    carpet = plot_carpet(data4d, mask_img, t_r=1, title='Raw data for all subjects',
-                         cmap='Greys', vmin = -1*cutoff, vmax = cutoff, detrend=False)
+    # carpet of the (subjects x voxels) matrix, as plot_carpet draws it
+    carpet, carpet_ax = plt.subplots(figsize=(20, 15))
+    carpet_ax.imshow(np.transpose(data), interpolation='nearest', aspect='auto',
+                     cmap='Greys', vmin = -1*cutoff, vmax = cutoff)
+    carpet_ax.set_title('Raw data for all subjects')
+    carpet_ax.set_yticks([])
+    carpet_ax.set_ylabel('voxels')
     plt.xlabel('Subjects')
-    carpet.figure.set_size_inches(20, 15)
     carpet_tmpfile = BytesIO()
     carpet.figure.savefig(carpet_tmpfile, format='png', dpi=80)
     carpet_encoded = base64.b64encode(carpet_tmpfile.getvalue()).decode('utf-8')
     html_carpet = f'<h2>Brain data summary</h2>' + '<img src=\'data:image/png;base64,{}\'>'.format(carpet_encoded) + '<br>'
 
+    # slice 40 of each subject from the mask voxels in it
+    mask_data = np.asarray(mask.dataobj).astype(bool)
+    slice_x, slice_y, slice_z = np.nonzero(mask_data)
+    in_slice = slice_z == 40
+    slice_shape = mask_data.shape[:2]
+
     ncols = 10
     nrows = 10
 
@@ -443,12 +735,14 @@ def make_html_summary(
     for idx, ax in enumerate(axs.ravel()):
         if idx < total_n:
             ax.set_title(f"subject {sub_list_final[idx]}", fontsize=10)
-            ax.imshow(np.flipud(np.transpose(data4d_array[:, :, 40, idx])), cmap='Greys',
+            subject_slice = np.zeros(slice_shape)
+            subject_slice[slice_x[in_slice], slice_y[in_slice]] = data[idx][in_slice]
+            ax.imshow(np.flipud(np.transpose(subject_slice)), cmap='Greys',
                 vmin = -1*cutoff, vmax = cutoff, aspect='auto')
             ax.axis('off')
         if idx >= total_n:
             ax.set_title('blank', fontsize=10)
-            ax.imshow(np.zeros(data4d_array[:, :, 40, 1].shape), cmap='Greys',
+            ax.imshow(np.zeros(slice_shape), cmap='Greys',
                 vmin = -1*cutoff, vmax = cutoff)
             ax.axis('off')
     plt.tight_layout()
@@ -473,22 +767,198 @@ def make_html_summary(
         f.write(html_brain_grid)
   
 
+def expand_lev1_task_contrasts(patterns):
+    """
+    Level 1 contrasts of the catalog matching patterns (task:contrast:rt_model:duration,
+    with shell wildcards, e.g. 'stroop:*:no_rt:constant'), refreshed once if a
+    pattern matches nothing
+    """
+    catalog = load_contrast_catalog(lev1_maps_root)
+    if not all(fnmatch.filter(catalog['contrasts'], pattern) for pattern in patterns):
+        catalog = refresh_contrast_catalog(lev1_maps_root)
+    lev1_task_contrasts = []
+    for pattern in patterns:
+        matches = fnmatch.filter(catalog['contrasts'], pattern)
+        if not matches:
+            raise ValueError(f'{pattern} matches no level 1 contrast of the catalog '
+                             f'({get_catalog_file(lev1_maps_root)})')
+        lev1_task_contrasts += [match for match in matches if match not in lev1_task_contrasts]
+    return lev1_task_contrasts
+
+
+def is_valid_model(lev1_task_contrast, model_lev2):
+    """The rt_diff models only apply to the contrast in rt_diff_dv_checker"""
+    task, lev1_contrast, rtmodel, duration =  lev1_task_contrast.split(':')
+    return model_lev2 == 'one_sampt' or lev1_contrast == rt_diff_dv_checker.get(task)
+
+
+def run_lev2_batch(lev1_task_contrasts, models_lev2, root, n_perm=5000, n_jobs=1,
+                   seed=0, max_memory=2**30, sub_lists_and_files=None):
+    """
+    Fits every (level 1 contrast, level 2 model) pair from shared data: the
+    between subject confounds are read once, the events/confounds of a task
+    once (load_behavior_tables) and the maps of a level 1 contrast once
+    (mask_lev1_maps), giving one subjects x voxels matrix and group mask per
+    distinct set of subjects of its models (models dropping the same subjects
+    share them), and the permutations of all models of a contrast run in one
+    pool.  The outputs of each model are those of a single analyze_lev2.py
+    call (same seed), written atomically (atomic_output_dir).  Pairs of an
+    rt_diff model with another contrast, and models without any subject with
+    complete data, are skipped.
+    input:
+        sub_lists_and_files: dictionary lev1_task_contrast -> get_lev1_maps
+            output, looked up here if None
+    output:
+        list of output directories written
+    """
+    import tempfile
+    from utils_lev1.permutation_glm import run_permutations
+
+    confounds_btwn_sub = pd.read_csv(confounds_btwn_sub_file)
+    if sub_lists_and_files is None:
+        sub_lists_and_files = {
+            lev1_task_contrast: get_lev1_maps(lev1_task_contrast)
+            for lev1_task_contrast in lev1_task_contrasts
+        }
+    behavior_tables = {}
+    outdirs = []
+    for lev1_task_contrast in lev1_task_contrasts:
+        task = lev1_task_contrast.split(':')[0]
+        models = [model_lev2 for model_lev2 in models_lev2
+                  if is_valid_model(lev1_task_contrast, model_lev2)]
+        for model_lev2 in sorted(set(models_lev2) - set(models)):
+            print(f'{lev1_task_contrast} {model_lev2}: skipped, the rt_diff models '
+                  f'only apply to {rt_diff_dv_checker.get(task)}')
+        sub_list, bold_files = sub_lists_and_files[lev1_task_contrast]
+        if not models or not bold_files:
+            continue
+        if task not in behavior_tables and any(model != 'one_sampt' for model in models):
+            # subjects of all the contrasts of the task
+            task_subjects = sorted({
+                subid
+                for key, (key_sub_list, _) in sub_lists_and_files.items()
+                if key.split(':')[0] == task
+                for subid in key_sub_list
+            })
+            behavior_tables[task] = load_behavior_tables(task_subjects, task, root)
+
+        work_root = Path(f'{lev2_output_root}/{task}_lev2_output')
+        work_root.mkdir(parents=True, exist_ok=True)
+        fits = []
+        for model_lev2 in models:
+            desmat_final, bold_files_final, regressor_names, summary_missing = build_desmat_all(
+                lev1_task_contrast, model_lev2, root, rt_subset_dict, rt_trial_grouping,
+                rt_diff_definition, rt_diff_dv_checker, confounds_btwn_sub,
+                (sub_list, bold_files), behavior_tables.get(task)
+            )
+            if not len(bold_files_final):
+                print(f'{lev1_task_contrast} {model_lev2}: skipped, no subject has '
+                      f'complete data')
+                continue
+            fits.append({
+                'model_lev2': model_lev2,
+                'desmat_final': desmat_final,
+                'bold_files_final': bold_files_final,
+                'regressor_names': regressor_names,
+                'summary_missing': summary_missing,
+                'contrasts': contrast_definition_by_model[model_lev2],
+                'subset': tuple(np.isin(bold_files, bold_files_final)),
+            })
+        if not fits:
+            continue
+        # one group mask per distinct set of subjects, as in single calls
+        subsets = list(dict.fromkeys(fit['subset'] for fit in fits))
+        with tempfile.TemporaryDirectory(dir=work_root, prefix='.lev2_batch_') as work_dir:
+            masked = dict(zip(subsets, mask_lev1_maps(
+                bold_files, [np.array(subset) for subset in subsets],
+                [f'{work_dir}/subset_{idx}_masked.npy' for idx in range(len(subsets))],
+                work_dir
+            )))
+            for fit in fits:
+                fit['data'], fit['mask'] = masked[fit['subset']]
+                fit['models'] = setup_permutation_models(
+                    fit['data'], fit['desmat_final'], fit['regressor_names'],
+                    fit['contrasts'], fit['model_lev2']
+                )
+            results = run_permutations(
+                [model for fit in fits for model in fit['models']],
+                n_perm=n_perm, n_jobs=n_jobs, seed=seed, max_memory=max_memory
+            )
+            for fit in fits:
+                fit_results, results = results[:len(fit['models'])], results[len(fit['models']):]
+                outdir = get_lev2_outdir(lev1_task_contrast, fit['model_lev2'])
+                with atomic_output_dir(outdir) as tmp_dir:
+                    filename_root = get_filename_root(tmp_dir, lev1_task_contrast)
+                    fit['mask'].to_filename(f'{filename_root}_mask.nii.gz')
+                    np.save(f'{filename_root}_masked.npy', fit['data'])
+                    make_html_summary(
+                        fit['desmat_final'], fit['bold_files_final'], fit['regressor_names'],
+                        fit['contrasts'], fit['summary_missing'], tmp_dir, fit['data'],
+                        fit['mask']
+                    )
+                    write_permutation_outputs(
+                        fit['models'], fit_results, fit['contrasts'], fit['mask'], tmp_dir,
+                        fit['model_lev2'], seed
+                    )
+                    write_lev2_manifest(tmp_dir, lev1_task_contrast, fit['model_lev2'],
+                                        bold_files)
+                outdirs.append(outdir)
+                print(f'{lev1_task_contrast} {fit["model_lev2"]}: {outdir}')
+            del masked, fits
+    return outdirs
+
+
+def add_permutation_arguments(parser):
+    parser.add_argument(
+        '--n_perm',
+        type=int,
+        default=5000,
+        help='Number of permutations / sign flips (default: 5000)',
+    )
+    parser.add_argument(
+        '--n_jobs',
+        type=int,
+        default=1,
+        help='Number of processes the permutations are run in',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed of the random permutations (results do not depend on --n_jobs)',
+    )
+    parser.add_argument(
+        '--max_memory',
+        type=parse_memory,
+        default='1G',
+        help='Memory per batch of permutations, e.g. 512M (default: 1G)',
+    )
+
+
 def get_parser():
     """Build parser object"""
     parser = ArgumentParser(
-        prog='setup_randomise_lev2',
-        description=('setup_randomise_lev2: Sets up randomise analysis with '
-            'option to run.  Contrast for overall mean is always included. '
+        prog='analyze_lev2',
+        description=('analyze_lev2: Runs the level 2 permutation tests in this job '
+            '(sign flipping for one_sampt, Freedman-Lane for the rt_diff models), '
+            'with voxelwise and max-stat (FWE) corrected p-maps.  Contrast for '
+            'overall mean is always included. '
             'The rt_diff models will also include a contrast for the rt_diff. '
-            'Two-sided t-tests (aka 1DF F-tests) will be run using 5000 permutations.'
+            'One-sided t-tests and two-sided t-tests (aka 1DF F-tests) will be run '
+            'using 5000 permutations.  --randomise sets up an FSL randomise batch '
+            'file instead (TFCE).  analyze_lev2.py refresh updates the level 1 '
+            'contrast catalog (see analyze_lev2.py refresh -h), analyze_lev2.py '
+            'batch fits several contrasts and models in one call (see '
+            'analyze_lev2.py batch -h).'
         ),
         formatter_class=RawTextHelpFormatter,
     )
     parser.add_argument(
         'lev1_task_contrast',
-        choices=check_valid_contrasts(),
+        type=check_valid_contrast,
         action='store',
-        help="Use to specify task and contrast.",
+        help=("Use to specify task and contrast, as task:contrast:rt_model:duration. "
+              "Valid values are listed by analyze_lev2.py refresh --list."),
     )
     parser.add_argument(
         'model_lev2',
@@ -499,38 +969,142 @@ def get_parser():
               "AY-BY, crit_go-noncrit_signal.  Intercept is always included."
         ),
     )
+    add_permutation_arguments(parser)
+    parser.add_argument(
+        '--randomise',
+        action='store_true',
+        help='Write the randomise inputs and batch file (TFCE) instead of running '
+             'the permutation tests',
+    )
+    return parser
+
+
+def get_refresh_parser():
+    """Build parser object of the refresh subcommand"""
+    parser = ArgumentParser(
+        prog='analyze_lev2 refresh',
+        description=('analyze_lev2 refresh: Updates the catalog of level 1 contrasts '
+            'available to level 2 (task:contrast:rt_model:duration and subjects).  '
+            'analyze_lev1.py adds its outputs when it finishes; only the level 1 '
+            'directories that changed since the last refresh are read again.'
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='Rebuild the catalog from all level 1 directories',
+    )
+    parser.add_argument(
+        '--list',
+        action='store_true',
+        help='Print the catalog entries and their number of subjects',
+    )
     return parser
   
  
+def get_batch_parser():
+    """Build parser object of the batch subcommand"""
+    parser = ArgumentParser(
+        prog='analyze_lev2 batch',
+        description=('analyze_lev2 batch: Runs the permutation tests of every level 1 '
+            'contrast x level 2 model in one call, loading each subject map and '
+            'behavioral table once.  Models of a contrast with the same subjects share '
+            'their group mask and their permutations run in one pool.  '
+            'The outputs of each model are those of a single analyze_lev2.py call '
+            'and replace its output directory once complete.'
+        ),
+        formatter_class=RawTextHelpFormatter,
+        fromfile_prefix_chars='@',
+    )
+    parser.add_argument(
+        'lev1_task_contrasts',
+        nargs='+',
+        help=("Level 1 contrasts (task:contrast:rt_model:duration) or patterns, e.g. "
+              "'stroop:*:no_rt:constant', matched against the contrast catalog.  "
+              "@file reads them from a file, one per line."),
+    )
+    parser.add_argument(
+        '--models',
+        nargs='+',
+        choices=['one_sampt', 'rt_diff', 'rt_diff_w_confounds'],
+        default=['one_sampt'],
+        help=("Level 2 models fit to each contrast (default: one_sampt).  The rt_diff "
+              "models are skipped for the contrasts they do not apply to."),
+    )
+    add_permutation_arguments(parser)
+    return parser
+
+
 if __name__ == "__main__":
     argv = sys.argv[1:]
-    opts = get_parser().parse_args(argv)
-    lev1_task_contrast = opts.lev1_task_contrast
-    model_lev2 = opts.model_lev2
-
     batch_stub = '/oak/stanford/groups/russpold/data/uh2/aim1_mumford/code/run_stub.batch'
     root = '/oak/stanford/groups/russpold/data/uh2/aim1/BIDS'
+    if argv[:1] == ['refresh']:
+        refresh_opts = get_refresh_parser().parse_args(argv[1:])
+        catalog = refresh_contrast_catalog(lev1_maps_root, full=refresh_opts.full)
+        if refresh_opts.list:
+            for key, entry in catalog['contrasts'].items():
+                print(f"{key} ({len(entry['subjects'])} subjects)")
+        print(f"{len(catalog['contrasts'])} contrasts in {get_catalog_file(lev1_maps_root)}")
+        sys.exit(0)
+    if argv[:1] == ['batch']:
+        batch_parser = get_batch_parser()
+        batch_opts = batch_parser.parse_args(argv[1:])
+        try:
+            lev1_task_contrasts = expand_lev1_task_contrasts(batch_opts.lev1_task_contrasts)
+            sub_lists_and_files = {
+                lev1_task_contrast: get_lev1_maps(lev1_task_contrast)
+                for lev1_task_contrast in lev1_task_contrasts
+            }
+        except ValueError as err:
+            batch_parser.error(str(err))
+        run_lev2_batch(
+            lev1_task_contrasts, batch_opts.models, root,
+            n_perm=batch_opts.n_perm, n_jobs=batch_opts.n_jobs, seed=batch_opts.seed,
+            max_memory=batch_opts.max_memory, sub_lists_and_files=sub_lists_and_files
+        )
+        sys.exit(0)
+    parser = get_parser()
+    opts = parser.parse_args(argv)
+    lev1_task_contrast = opts.lev1_task_contrast
+    model_lev2 = opts.model_lev2
     task, lev1_contrast, rtmodel, duration =  lev1_task_contrast.split(':')
+    try:
+        sub_list_and_files = get_lev1_maps(lev1_task_contrast)
+    except ValueError as err:
+        parser.error(str(err))
 
-    outdir = Path(f"/oak/stanford/groups/russpold/data/uh2/aim1_mumford/output/"
-              f"{task}_lev2_output/{task}_lev1_contrast_{lev1_contrast}_rtmod_{rtmodel}_"
-              f"duration_{duration}_lev2_model_{model_lev2}/")
+    outdir = get_lev2_outdir(lev1_task_contrast, model_lev2)
     if outdir.exists() and outdir.is_dir():
         shutil.rmtree(outdir)
     outdir.mkdir(parents=True)
 
     desmat_final, bold_files_final, regressor_names, summary_missing = build_desmat_all(
     lev1_task_contrast, model_lev2, root, rt_subset_dict, rt_trial_grouping, 
-    rt_diff_definition, rt_diff_dv_checker
+    rt_diff_definition, rt_diff_dv_checker, sub_list_and_files=sub_list_and_files
     )
     contrasts = contrast_definition_by_model[model_lev2]
+    data, mask = make_4d_data_mask(
+        bold_files_final, outdir, lev1_task_contrast, write_4d=opts.randomise
+    )
     make_html_summary(
         desmat_final, bold_files_final, regressor_names, contrasts, 
-        summary_missing, outdir
+        summary_missing, outdir, data, mask
     )
-    make_4d_data_mask(bold_files_final, outdir, lev1_task_contrast)
-    make_randomise_files(desmat_final, regressor_names, contrasts, outdir, model_lev2)
-    make_batch_file(outdir, model_lev2, lev1_task_contrast, batch_stub)
+    if opts.randomise:
+        make_randomise_files(desmat_final, regressor_names, contrasts, outdir, model_lev2)
+        make_batch_file(outdir, model_lev2, lev1_task_contrast, batch_stub)
+    else:
+        run_permutation_tests(
+            data, mask, desmat_final, regressor_names, contrasts, outdir, model_lev2,
+            n_perm=opts.n_perm, n_jobs=opts.n_jobs, seed=opts.seed,
+            max_memory=opts.max_memory
+        )
+    # level 1 maps (content hashes) this model was set up from, so
+    # run_incremental.py can rerun it when they change
+    _, lev1_files = sub_list_and_files
+    write_lev2_manifest(outdir, lev1_task_contrast, model_lev2, lev1_files)
     #run_it(outdir, model_lev2, lev1_task_contrast)
 
 
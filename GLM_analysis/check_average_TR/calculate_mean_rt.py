@@ -2,34 +2,76 @@ import glob
 import pandas as pd
 import os
 import numpy as np
+from file_index import file_signature, signature_matches, load_json_index, write_json_atomic
 
-def calculate_mean_rt():
-    base_dir = '/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/fitlins_data/*/'
-    tasks = ['cuedTS', 'directedForgetting', 'flanker', 'goNogo',
-                    'nBack', 'stopSignal', 'spatialTS', 'shapeMatching',
-                    'stopSignalWDirectedForgetting', 'stopSignalWFlanker',
-                    'directedForgettingWFlanker']
-    mean_rt_dict = {}
+base_dir = '/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/fitlins_data/*/'
+mean_rt_table_file = '/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/output/mean_rt_table.json'
+tasks = ['cuedTS', 'directedForgetting', 'flanker', 'goNogo',
+                'nBack', 'stopSignal', 'spatialTS', 'shapeMatching',
+                'stopSignalWDirectedForgetting', 'stopSignalWFlanker',
+                'directedForgettingWFlanker']
+
+
+def calculate_file_mean_rt(event_file, task):
+    """
+    Mean RT of the correct, non-junk trials of a single events file
+    """
+    df = pd.read_csv(event_file, sep='\t')
+    df['trial_type'].fillna('n/a', inplace=True)
+    if 'stopSignal' in task:
+        subset = df.query("(trial_type.str.contains('go') and response_time >= 0.2 and key_press == correct_response and junk == 0)" +
+                          "or (trial_type.str.contains('stop_failure') and response_time >= 0.2 and junk == 0)", engine='python')
+    else:
+        subset = df.query("key_press == correct_response and trial_type != 'n/a' and response_time >= 0.2 and junk == 0")
+    return subset['response_time'].mean()
+
+
+def update_mean_rt_table(table_file=mean_rt_table_file, tasks=tasks):
+    """
+    Builds or refreshes the persisted mean RT table.  Each task entry keeps the
+    per file mean RT along with the file size and mtime it was computed from, so
+    only events files that are new or have changed since the last build are read.
+    input:
+        table_file: path to json mean RT table
+        tasks: tasks to refresh (other tasks in the table are left untouched)
+    output:
+        table: dictionary keyed by task with 'mean_rt' and 'files' entries
+    """
+    table = load_json_index(table_file)
+    changed = False
     for task in tasks:
-        mean_rts = []
-        event_files = glob.glob(base_dir+f'/*/func/*{task}_*events.tsv')
-        if 'stopSignal' in task:
-            for event_file in event_files:
-                df = pd.read_csv(event_file, sep='\t')
-                df['trial_type'].fillna('n/a', inplace=True)
-                subset = df.query("(trial_type.str.contains('go') and response_time >= 0.2 and key_press == correct_response and junk == 0)" +
-                                  "or (trial_type.str.contains('stop_failure') and response_time >= 0.2 and junk == 0)", engine='python')
-                mean_rt = subset['response_time'].mean()
-                mean_rts.append(mean_rt)
-            mean_rt_dict[task] = sum(mean_rts)/len(mean_rts)
-        else:
-            for event_file in event_files:
-                df = pd.read_csv(event_file, sep='\t')
-                df['trial_type'].fillna('n/a', inplace=True)
-                subset = df.query("key_press == correct_response and trial_type != 'n/a' and response_time >= 0.2 and junk == 0")
-                mean_rt = subset['response_time'].mean()
-                mean_rts.append(mean_rt)
-            mean_rt_dict[task] = sum(mean_rts)/len(mean_rts)
+        event_files = sorted(glob.glob(base_dir+f'/*/func/*{task}_*events.tsv'))
+        old_files = table.get(task, {}).get('files', {})
+        files = {}
+        for event_file in event_files:
+            signature = file_signature(event_file)
+            if signature_matches(old_files.get(event_file), signature):
+                files[event_file] = old_files[event_file]
+            else:
+                files[event_file] = dict(signature, mean_rt=calculate_file_mean_rt(event_file, task))
+        if files == old_files and task in table:
+            continue
+        mean_rts = [val['mean_rt'] for val in files.values()]
+        table[task] = {'mean_rt': sum(mean_rts)/len(mean_rts), 'files': files}
+        changed = True
+    if changed:
+        write_json_atomic(table_file, table)
+    return table
+
+
+def load_mean_rt_dict(table_file=mean_rt_table_file):
+    """
+    Reads the group mean RT per task from the persisted table (no globbing)
+    """
+    table = load_json_index(table_file)
+    return {task: entry['mean_rt'] for task, entry in table.items()}
+
+
+def calculate_mean_rt():
+    table = update_mean_rt_table()
+    mean_rt_dict = {task: table[task]['mean_rt'] for task in tasks}
     return mean_rt_dict
 
 
+if __name__ == "__main__":
+    print(calculate_mean_rt())
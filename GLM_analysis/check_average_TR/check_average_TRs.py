@@ -1,30 +1,100 @@
 import nibabel as nib
 import glob
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from file_index import file_signature, signature_matches, load_json_index, write_json_atomic
 
-def create_tr_dict(average=True):
-    tr_dict = {}
-    for task in ['cuedTS', 'directedForgetting', 'flanker', 'goNogo',
-            'nBack', 'stopSignal', 'spatialTS', 'shapeMatching',
-            'stopSignalWDirectedForgetting', 'stopSignalWFlanker',
-            'directedForgettingWFlanker']:
-        tr_list = []
-        img_files = glob.glob(f'/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/fitlins_data/*/*/func/*task-{task}_*_bold.nii.gz')
+tr_index_file = '/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/output/tr_count_index.json'
+tasks = ['cuedTS', 'directedForgetting', 'flanker', 'goNogo',
+        'nBack', 'stopSignal', 'spatialTS', 'shapeMatching',
+        'stopSignalWDirectedForgetting', 'stopSignalWFlanker',
+        'directedForgettingWFlanker']
+
+_tr_cutoffs = None
+
+
+def read_n_scans(img_file):
+    """
+    Number of time points of a 4D image, read from the NIfTI header only
+    """
+    return int(nib.load(img_file).header.get_data_shape()[-1])
+
+
+def update_tr_index(index_file=tr_index_file, tasks=tasks, n_workers=8):
+    """
+    Builds or incrementally refreshes the persisted scan count index.  Files are
+    keyed by path and only headers of files that are new, or whose size/mtime
+    changed, are read (in parallel).  Per task averages are stored alongside so
+    QA can look them up without touching the images.
+    input:
+        index_file: path to json index
+        tasks: tasks to refresh
+        n_workers: number of threads used to read headers
+    output:
+        index: dictionary with 'files' (path -> size, mtime, task, n_scans)
+            and 'average' (task -> average number of time points)
+    """
+    index = load_json_index(index_file)
+    old_files = index.get('files', {})
+    files = {path: entry for path, entry in old_files.items() if entry['task'] not in tasks}
+    to_read = []
+    for task in tasks:
+        img_files = sorted(glob.glob(f'/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/fitlins_data/*/*/func/*task-{task}_*_bold.nii.gz'))
         for img in img_files:
-            img = nib.load(img)
-            tr_list.append(img.shape[-1])
-        if average:
-            tr_dict[task] = sum(tr_list)/len(tr_list)
-        else:
-            tr_dict[task] = tr_list
+            signature = file_signature(img)
+            if signature_matches(old_files.get(img), signature):
+                files[img] = old_files[img]
+            else:
+                files[img] = dict(signature, task=task)
+                to_read.append(img)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for img, n_scans in zip(to_read, pool.map(read_n_scans, to_read)):
+            files[img]['n_scans'] = n_scans
+
+    if files == old_files and 'average' in index:
+        return index
+    average = index.get('average', {})
+    for task in tasks:
+        tr_list = [entry['n_scans'] for entry in files.values() if entry['task'] == task]
+        if tr_list:
+            average[task] = sum(tr_list)/len(tr_list)
+    index = {'files': files, 'average': average}
+    write_json_atomic(index_file, index)
+    return index
+
+
+def get_tr_cutoff(task, index_file=tr_index_file):
+    """
+    Average number of time points for a task, looked up from the persisted index.
+    The index is read once per process; it is only rebuilt (for this task) if the
+    task is missing.
+    """
+    global _tr_cutoffs
+    if _tr_cutoffs is None:
+        _tr_cutoffs = load_json_index(index_file).get('average', {})
+    if task not in _tr_cutoffs:
+        _tr_cutoffs[task] = update_tr_index(index_file, tasks=[task])['average'][task]
+    return _tr_cutoffs[task]
+
+
+def create_tr_dict(average=True):
+    index = update_tr_index()
+    if average:
+        return dict(index['average'])
+    tr_dict = {task: [] for task in tasks}
+    for entry in index['files'].values():
+        tr_dict[entry['task']].append(entry['n_scans'])
     return tr_dict
 
 def create_tr_hist():
+    import matplotlib.pyplot as plt
     tr_dict = create_tr_dict(average=False)
-    
+
     for key, value in tr_dict.items():
         plt.clf()
         plt.hist(value, label=key, range=(0, 800))
         plt.legend()
         plt.savefig(f'tr_hist_{key}.png')
 
+
+if __name__ == "__main__":
+    print(update_tr_index()['average'])
@@ -0,0 +1,52 @@
+import json
+import os
+import tempfile
+
+
+def file_signature(path):
+    """
+    Cheap fingerprint of a file used to decide whether cached values are stale
+    input:
+        path: path to file
+    output:
+        dictionary with file size (bytes) and modification time
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def signature_matches(entry, signature):
+    """
+    True if a cached index entry was computed from a file with this signature
+    """
+    return (entry is not None
+            and entry.get('size') == signature['size']
+            and entry.get('mtime') == signature['mtime'])
+
+
+def load_json_index(index_file):
+    """
+    Loads a persisted json index, returns an empty index if it does not exist yet
+    """
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def write_json_atomic(index_file, index):
+    """
+    Writes json index to a temporary file in the same directory and renames it
+    into place, so concurrent jobs never read a partially written index
+    """
+    index_dir = os.path.dirname(os.path.abspath(index_file))
+    os.makedirs(index_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=index_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, index_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
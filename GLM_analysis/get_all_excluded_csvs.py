@@ -1,16 +1,21 @@
 import pandas as pd
 import os
 import glob
+from utils_lev1.qa_store import import_legacy_exclusions, load_exclusions
 
+# read from the per session exclusion records (the same rows as the
+# excluded_subject.csv rendered from them), so the list is complete even if the
+# csv was not rendered again after the last jobs
 main_df = pd.DataFrame()
 for task in ['cuedTS', 'directedForgetting', 'flanker', 'goNogo',
         'nBack', 'stopSignal', 'spatialTS', 'shapeMatching',
         'stopSignalWDirectedForgetting', 'stopSignalWFlanker',
         'directedForgettingWFlanker']:
-    exclusion_file = f'/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/output/{task}_lev1_output/task_{task}_rtmodel_rt_centered/excluded_subject.csv'
-    if os.path.exists(exclusion_file):
-        df = pd.read_csv(exclusion_file, index_col=False)
+    contrast_dir = f'/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/output/{task}_lev1_output/task_{task}_rtmodel_rt_centered'
+    if os.path.exists(contrast_dir):
+        import_legacy_exclusions(contrast_dir)
+        df = load_exclusions(contrast_dir)
         main_df = pd.concat([main_df, df])
         print(main_df)
 
-main_df.to_csv('/home/groups/russpold/network_fmri/analysis_code/network_excluded_subjects.csv', index=False)
\ No newline at end of file
+main_df.to_csv('/home/groups/russpold/network_fmri/analysis_code/network_excluded_subjects.csv', index=False)
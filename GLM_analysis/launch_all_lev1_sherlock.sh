@@ -1,10 +1,13 @@
 #!/usr/bin/bash
 
-all_batch=$(ls /oak/stanford/groups/russpold/data/network_grant/validation_BIDS/derivatives/output/*lev1_output/batch_files/*fixed*)
+# job arrays written by make_lev1_batch_files.py (only units that are not complete yet)
+all_batch=$(ls /oak/stanford/groups/russpold/data/network_grant/validation_BIDS/derivatives/output/*lev1_output/batch_files/*_lev1_array.batch)
 
 for cur_batch in ${all_batch}
 do
-  sbatch ${cur_batch}
+  # the QA summaries (excluded_subject.csv, html) are rendered once the whole array is done
+  array_id=$(sbatch --parsable ${cur_batch})
+  sbatch --dependency=afterany:${array_id} ${cur_batch%.batch}_qa_summary.batch
 done
 
 #all_batch=$(ls /oak/stanford/groups/russpold/data/uh2/aim1_mumford/output/*lev1_output/batch_files/*rtmodel_no*)
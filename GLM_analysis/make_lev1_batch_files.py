@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
 import glob
+import os
 from pathlib import Path
+from utils_lev1.lev1_units import (make_unit, plan_unit, pack_units, write_job_array, get_job_memory,
+                                   get_qa_summary_batch_file)
 
 def get_subids(root):
     subdirs = sorted(glob.glob(f'{root}/s*/'))
@@ -15,17 +18,37 @@ tasks = ['cuedTS', 'directedForgetting', 'flanker', 'goNogo',
 
 batch_stub = '/home/groups/russpold/network_fmri/analysis_code/run_stub.batch'
 root = '/oak/stanford/groups/russpold/data/network_grant/validation_BIDS'
+# inputs and outputs of analyze_lev1.py
+glm_data_root = f'{root}/derivatives/glm_data'
+outdir = f'{root}/derivatives/output'
 
 fixed_effects = True
 qa = False
+# residuals are saved from the same model fit as the contrast estimates
 residuals = False
+# session images as uncompressed .nii (memory mapped by the readers, larger on disk)
+uncompressed_intermediates = False
+# sessions of a subject are fit concurrently within each job (see --n_jobs in analyze_lev1.py)
+n_jobs = 8
+# memory budget of the model fits of each job (--max_memory, shared by its n_jobs
+# sessions): voxels are fit in blocks within it and the jobs request it plus the
+# process overhead instead of the 16 x 8G of run_stub.batch.  None fits whole
+# runs in memory with the allocation of the stub
+max_memory = '8G'
+# units whose outputs are complete and current (run manifest) are left out,
+# the others only rerun their stale sessions
+skip_done = True
+# --qa_only units are short, this many run in one array element
+qa_pack_size = 10
+# maximum number of array elements running at the same time
+max_concurrent = 50
 
 # For Jeanette's study no_rt is studied.  For other studies, use rt_centered unless
 # modeling WATT3 and CCTHot as RT doesn't make sense in those paradigms
 # When in doubt, ask Jeanette first before making changes!
 rt_mapping = {
-    'cuedTS':['rt_centered'], 
-    'directedForgetting':['rt_centered'], 
+    'cuedTS':['rt_centered'],
+    'directedForgetting':['rt_centered'],
     'flanker':['rt_centered'],
     'goNogo':['rt_centered'],
     'nBack':['rt_centered'],
@@ -42,45 +65,29 @@ subids = ['s286', 's295']
 for task in tasks:
     batch_root = Path(f'{root}/derivatives/output/{task}_lev1_output/batch_files/')
     batch_root.mkdir(parents=True, exist_ok=True)
-    rt_options = rt_mapping[task]
-    for rt_inc in rt_options:
-        if fixed_effects:
-            batch_file = (f'{batch_root}/task_{task}_rtmodel_{rt_inc}_fixed-effects.batch')
-            with open(batch_stub) as infile, open(batch_file, 'w') as outfile:
-                for line in infile:
-                    line = line.replace('JOBNAME', f"{task}_fixed-effects")
-                    outfile.write(line)
-                for sub in subids:
-                    outfile.write(
-                        f"echo /home/groups/russpold/network_fmri/analysis_code/analyze_lev1.py {task} {sub} {rt_inc} --fixed_effects --simplified_events \n"
-                        f"/home/groups/russpold/network_fmri/analysis_code/analyze_lev1.py {task} {sub} {rt_inc} --fixed_effects  --simplified_events \n")
-        elif residuals:
-            batch_file = (f'{batch_root}/task_{task}_rtmodel_{rt_inc}_residuals.batch')
-            with open(batch_stub) as infile, open(batch_file, 'w') as outfile:
-                for line in infile:
-                    line = line.replace('JOBNAME', f"{task}_residuals")
-                    outfile.write(line)
-                for sub in subids:
-                    outfile.write(
-                        f"echo /home/groups/russpold/network_fmri/analysis_code/analyze_lev1.py {task} {sub} {rt_inc} --residuals \n"
-                        f"/home/groups/russpold/network_fmri/analysis_code/analyze_lev1.py {task} {sub} {rt_inc} --residuals \n") 
-        else:
-            batch_file = (f'{batch_root}/task_{task}_rtmodel_{rt_inc}.batch')   
-            with open(batch_stub) as infile, open(batch_file, 'w') as outfile:
-                for line in infile:
-                    line = line.replace('JOBNAME', f"{task}_{rt_inc}")
-                    outfile.write(line)
-                for sub in subids:
-                    outfile.write(
-                        f"echo /home/groups/russpold/network_fmri/analysis_code/analyze_lev1.py {task} {sub} {rt_inc}\n"
-                        f"/home/groups/russpold/network_fmri/analysis_code/analyze_lev1.py {task} {sub} {rt_inc}\n")                    
-        if qa:
-            batch_file = (f'{batch_root}/task_{task}_rtmodel_{rt_inc}_qa-only.batch')
-            with open(batch_stub) as infile, open(batch_file, 'w') as outfile:
-                for line in infile:
-                    line = line.replace('JOBNAME', f"{task}_qa")
-                    outfile.write(line)
-                for sub in subids:
-                    outfile.write(
-                        f"echo /home/groups/russpold/network_fmri/analysis_code/analyze_lev1.py {task} {sub} {rt_inc} --qa_only \n"
-                        f"/home/groups/russpold/network_fmri/analysis_code/analyze_lev1.py {task} {sub} {rt_inc} --qa_only \n")
+    # one array element per (task, subject, rt model)
+    units = []
+    for rt_inc in rt_mapping[task]:
+        for sub in subids:
+            units.append(make_unit(task, sub, rt_inc, fixed_effects=fixed_effects,
+                                   simplified_events=fixed_effects, residuals=residuals,
+                                   uncompressed_intermediates=uncompressed_intermediates,
+                                   n_jobs=n_jobs, max_memory=max_memory))
+            if qa:
+                units.append(make_unit(task, sub, rt_inc, qa_only=True, n_jobs=n_jobs))
+    if skip_done:
+        units = [plan_unit(unit, glm_data_root, outdir) for unit in units]
+        units = [unit for unit in units if unit is not None]
+
+    batch_file = f'{batch_root}/task_{task}_lev1_array.batch'
+    if not units:
+        print(f'{task}: all units complete')
+        # no stale array left behind for launch_all_lev1_sherlock.sh
+        for stale_file in [batch_file, get_qa_summary_batch_file(batch_file)]:
+            if os.path.exists(stale_file):
+                os.remove(stale_file)
+        continue
+    elements = pack_units(units, qa_pack_size)
+    write_job_array(elements, batch_stub, batch_file, f'{task}_lev1', max_concurrent,
+                    mem=None if max_memory is None else get_job_memory(max_memory, n_jobs))
+    print(f'{task}: {len(units)} units in {len(elements)} array elements, {batch_file}')
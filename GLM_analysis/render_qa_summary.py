@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import sys
+from argparse import ArgumentParser, RawTextHelpFormatter
+from utils_lev1.qa_store import write_excluded_subject_csv
+from utils_lev1.qa_report import render_html_summary
+
+
+def get_parser():
+    """Build parser object"""
+    parser = ArgumentParser(
+        prog="render_qa_summary",
+        description=(
+            "render_qa_summary: Renders the level 1 model summary html and "
+            "excluded_subject.csv from the per session QA records"
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "task",
+        choices=[
+            "cuedTS",
+            "directedForgetting",
+            "flanker",
+            "goNogo",
+            "nBack",
+            "stopSignal",
+            "spatialTS",
+            "shapeMatching",
+            "stopSignalWDirectedForgetting",
+            "stopSignalWFlanker",
+            "directedForgettingWFlanker",
+        ],
+        help="Use to specify task.",
+    )
+    parser.add_argument(
+        "regress_rt",
+        choices=["no_rt", "rt_uncentered", "rt_centered"],
+        help="RT model of the level 1 analyses",
+    )
+    parser.add_argument(
+        "--duration_choice",
+        default="constant",
+        help="Duration model of the level 1 analyses (default: constant)",
+    )
+    parser.add_argument(
+        "--no_figures",
+        action="store_true",
+        help="Do not render missing or out of date QA figures",
+    )
+    parser.add_argument(
+        "--embed_images",
+        action="store_true",
+        help=(
+            "Embed the figures in the html (self contained, but large) instead "
+            "of linking the png files in qa_figures"
+        ),
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    opts = parser.parse_args(sys.argv[1:])
+    task = opts.task
+    regress_rt = opts.regress_rt
+
+    outdir = f"/oak/stanford/groups/russpold/data/network_grant/validation_BIDS/derivatives/output/{task}_lev1_output"
+    # outdir = f'/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/output/{task}_lev1_output'
+    contrast_dir = f"{outdir}/task_{task}_rtmodel_{regress_rt}"
+
+    write_excluded_subject_csv(contrast_dir)
+    html_file = render_html_summary(
+        contrast_dir,
+        task,
+        regress_rt,
+        opts.duration_choice,
+        embed_images=opts.embed_images,
+        render_figures=not opts.no_figures,
+    )
+    if html_file is None:
+        print(f"No QA records in {contrast_dir}")
+    else:
+        print(f"Wrote {html_file}")
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+from utils_lev1.lev1_units import make_unit, plan_unit
+from utils_lev1.chunked_glm import parse_memory
+from utils_lev1.run_manifest import find_lev2_manifests, is_lev2_current
+from run_lev1_units import root, outdir, run_elements_local, render_qa_summaries
+
+tasks = ['cuedTS', 'directedForgetting', 'flanker', 'goNogo',
+         'nBack', 'stopSignal', 'spatialTS', 'shapeMatching']
+
+analyze_lev2_script = str(Path(__file__).resolve().parent / 'analyze_lev2.py')
+
+
+def get_subids(root):
+    return sorted(os.path.basename(subdir)[4:] for subdir in Path(root).glob('sub-*')
+                  if subdir.is_dir())
+
+
+def plan_lev1(tasks, subids, regress_rt, options):
+    """
+    Level 1 units (one per task and subject) whose outputs are out of date,
+    each restricted to its stale sessions (see lev1_units.plan_unit)
+    """
+    planned = []
+    for task in tasks:
+        for subid in subids:
+            unit = plan_unit(make_unit(task, subid, regress_rt, **options), root, outdir)
+            if unit is not None:
+                planned.append(unit)
+    return planned
+
+
+def plan_lev2(tasks, lev2_output_root):
+    """
+    Level 2 models (from their manifests) whose level 1 maps were added,
+    removed or changed since they were set up
+    output:
+        list of (lev1_task_contrast, model_lev2)
+    """
+    from analyze_lev2 import get_bold_and_sublist
+
+    planned = []
+    for manifest in find_lev2_manifests(lev2_output_root).values():
+        lev1_task_contrast = manifest['lev1_task_contrast']
+        if lev1_task_contrast.split(':')[0] not in tasks:
+            continue
+        _, lev1_files = get_bold_and_sublist(lev1_task_contrast)
+        if not is_lev2_current(manifest, lev1_files):
+            planned.append((lev1_task_contrast, manifest['model_lev2']))
+    return planned
+
+
+def get_parser():
+    """Build parser object"""
+    parser = ArgumentParser(
+        prog='run_incremental',
+        description=(
+            'run_incremental: Reruns the level 1 sessions whose inputs, design or '
+            'outputs changed (run manifests), the fixed effects of those subjects and '
+            'then the level 2 models whose level 1 maps changed (lev2 manifests).  '
+            'Runs on this node.'
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        '--tasks',
+        nargs='+',
+        default=tasks,
+        help='Tasks to update (default: all)',
+    )
+    parser.add_argument(
+        '--subids',
+        nargs='+',
+        help='Subjects to update, without sub- (default: all in the data directory)',
+    )
+    parser.add_argument(
+        '--regress_rt',
+        choices=['no_rt', 'rt_uncentered', 'rt_centered'],
+        default='rt_centered',
+        help='RT model of the level 1 analyses (default: rt_centered)',
+    )
+    for option in ['fixed_effects', 'simplified_events', 'residuals',
+                   'uncompressed_intermediates']:
+        parser.add_argument(
+            f'--{option}',
+            action='store_true',
+            help=f'Level 1 units are run with --{option} (as in analyze_lev1.py)',
+        )
+    parser.add_argument(
+        '--n_jobs',
+        type=int,
+        default=1,
+        help='--n_jobs of each analyze_lev1.py call',
+    )
+    parser.add_argument(
+        '--max_memory',
+        type=parse_memory,
+        help='--max_memory of each analyze_lev1.py call (e.g. 4G, default: whole runs in memory)',
+    )
+    parser.add_argument(
+        '--n_workers',
+        type=int,
+        default=max(1, len(os.sched_getaffinity(0)) // 8),
+        help='Number of analyze_lev1.py calls run concurrently',
+    )
+    parser.add_argument(
+        '--skip_lev2',
+        action='store_true',
+        help='Only update the level 1 outputs',
+    )
+    parser.add_argument(
+        '--dry_run',
+        action='store_true',
+        help='Only print what would be rerun',
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    from analyze_lev2 import lev2_output_root
+
+    opts = get_parser().parse_args(sys.argv[1:])
+    options = {
+        'fixed_effects': opts.fixed_effects,
+        'simplified_events': opts.simplified_events,
+        'residuals': opts.residuals,
+        'uncompressed_intermediates': opts.uncompressed_intermediates,
+        'n_jobs': opts.n_jobs,
+        'max_memory': opts.max_memory,
+    }
+    subids = opts.subids if opts.subids else get_subids(root)
+
+    units = plan_lev1(opts.tasks, subids, opts.regress_rt, options)
+    for unit in units:
+        sessions = 'all sessions' if unit['sessions'] is None else ' '.join(unit['sessions'])
+        print(f"lev1 {unit['task']} {unit['subid']} {unit['regress_rt']}: {sessions}")
+    if not units:
+        print('lev1: all outputs complete and current')
+    if opts.dry_run:
+        if not opts.skip_lev2:
+            # level 2 models also depending on the level 1 units above are not listed yet
+            for lev1_task_contrast, model_lev2 in plan_lev2(opts.tasks, lev2_output_root):
+                print(f'lev2 {lev1_task_contrast} {model_lev2}')
+        sys.exit(0)
+
+    n_failed = run_elements_local([[unit] for unit in units], opts.n_workers, force=True)
+    render_qa_summaries([[unit] for unit in units])
+    if n_failed:
+        print(f'lev1: {n_failed} units failed, level 2 models are not updated')
+        sys.exit(1)
+
+    if not opts.skip_lev2:
+        for lev1_task_contrast, model_lev2 in plan_lev2(opts.tasks, lev2_output_root):
+            command = [sys.executable, analyze_lev2_script, lev1_task_contrast, model_lev2]
+            print(' '.join(command), flush=True)
+            if subprocess.run(command).returncode != 0:
+                print(f'lev2 {lev1_task_contrast} {model_lev2}: failed')
+                n_failed += 1
+    sys.exit(1 if n_failed else 0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+from utils_lev1.lev1_units import (get_unit_command, is_unit_complete, load_units_file,
+                                   get_contrast_dir)
+
+root = '/oak/stanford/groups/russpold/data/network_grant/validation_BIDS/derivatives/glm_data'
+outdir = '/oak/stanford/groups/russpold/data/network_grant/validation_BIDS/derivatives/output'
+# root = '/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/fitlins_data'
+# outdir = '/oak/stanford/groups/russpold/data/network_grant/discovery_BIDS_21.0.1/derivatives/output'
+
+# analyze_lev1.py next to this script, so the SLURM and local backends run the same code
+analyze_lev1_script = str(Path(__file__).resolve().parent / 'analyze_lev1.py')
+
+
+def run_element(units, force=False):
+    """
+    Runs the units of one job array element one after another, skipping units
+    completed since the job array was written (e.g. when an array is resubmitted)
+    output:
+        number of failed units
+    """
+    n_failed = 0
+    for unit in units:
+        unit_label = f"{unit['task']} {unit['subid']} {unit['regress_rt']}"
+        if not force and is_unit_complete(unit, root, outdir):
+            print(f'{unit_label}: outputs complete and current, skipping')
+            continue
+        command = [sys.executable] + get_unit_command(unit, analyze_lev1_script)
+        print(' '.join(command), flush=True)
+        if subprocess.run(command).returncode != 0:
+            print(f'{unit_label}: failed')
+            n_failed += 1
+    return n_failed
+
+
+def run_elements_local(elements, n_workers, force=False):
+    """
+    Local backend: runs all job array elements on this node, n_workers at a time
+    (each unit runs in its own analyze_lev1.py process)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return sum(pool.map(lambda units: run_element(units, force), elements))
+
+
+def render_qa_summaries(elements, duration_choice='constant'):
+    """
+    Renders excluded_subject.csv and the model summary html of every task/RT
+    model of the units from all QA records, once all units are done: the
+    analyze_lev1.py calls only write their own per session records, so
+    concurrent units never overwrite each other's rows
+    """
+    from utils_lev1.qa_store import write_excluded_subject_csv
+    from utils_lev1.qa_report import render_html_summary
+
+    for task, regress_rt in sorted({(unit['task'], unit['regress_rt'])
+                                    for units in elements for unit in units}):
+        contrast_dir = get_contrast_dir(outdir, task, regress_rt)
+        if not os.path.isdir(contrast_dir):
+            continue
+        write_excluded_subject_csv(contrast_dir)
+        html_file = render_html_summary(contrast_dir, task, regress_rt, duration_choice)
+        if html_file is not None:
+            print(f'Wrote {html_file}')
+
+
+def get_parser():
+    """Build parser object"""
+    parser = ArgumentParser(
+        prog='run_lev1_units',
+        description=(
+            'run_lev1_units: Runs the level 1 units of a job array written by '
+            'make_lev1_batch_files.py, one array element (SLURM) or all of them '
+            '(local process pool)'
+        ),
+        formatter_class=RawTextHelpFormatter,
+    )
+    parser.add_argument('units_file', help='_units.json file written with the job array')
+    parser.add_argument(
+        '--index',
+        type=int,
+        help='Array element to run (${SLURM_ARRAY_TASK_ID})',
+    )
+    parser.add_argument(
+        '--local',
+        action='store_true',
+        help='Run all array elements on this node',
+    )
+    parser.add_argument(
+        '--n_workers',
+        type=int,
+        default=max(1, len(os.sched_getaffinity(0)) // 8),
+        help='Number of units run concurrently with --local',
+    )
+    parser.add_argument(
+        '--render_qa',
+        action='store_true',
+        help=('Only render the QA summaries (excluded_subject.csv, html) of the units, '
+              'after the array is done (done at the end of --local)'),
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Run units even if their outputs are complete and current',
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    opts = parser.parse_args(sys.argv[1:])
+    elements = load_units_file(opts.units_file)
+    if opts.render_qa:
+        render_qa_summaries(elements)
+        n_failed = 0
+    elif opts.local:
+        n_failed = run_elements_local(elements, opts.n_workers, opts.force)
+        render_qa_summaries(elements)
+    elif opts.index is not None:
+        n_failed = run_element(elements[opts.index], opts.force)
+    else:
+        parser.error('use --index, --local or --render_qa')
+    sys.exit(1 if n_failed else 0)
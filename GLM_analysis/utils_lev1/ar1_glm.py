@@ -0,0 +1,144 @@
+import numpy as np
+from scipy import linalg
+
+# AR(1) GLM of one run and one design, the arithmetic of nilearn's run_glm with
+# the whitening done for all voxels at once.  Design variants of a run (RT
+# models, derivatives) are not fit together: each analyze_lev1.py call fits one
+# RT model (the batch files only run rt_centered), and the masked, smoothed BOLD
+# matrix is what the calls share (bold_cache.py).
+
+
+class AR1BinResults:
+    """
+    Fit of the voxels of one AR(1) bin, with the attributes of nilearn's
+    (Simple)RegressionResults that the contrasts and residuals use
+    """
+
+    def __init__(self, theta, cov, dispersion, df_residuals, Y=None, whitened_design=None):
+        self.theta = theta
+        self.cov = cov
+        self.dispersion = dispersion
+        self.df_residuals = df_residuals
+        # only kept for the residuals (minimize_memory=False)
+        self.Y = Y
+        self.whitened_design = whitened_design
+
+
+def get_ols_residuals(Y, X):
+    beta = np.dot(linalg.pinv(X), Y)
+    return Y - np.dot(X, beta)
+
+
+def estimate_ar1(Y, X, bins=100, residual_mean=None):
+    """
+    Binned AR(1) coefficient of each voxel from the OLS residuals, as
+    nilearn.glm.first_level.run_glm (Yule-Walker, truncated to 1/bins)
+    input:
+        Y: (time x voxels) mean scaled data
+        X: (time x regressors) design array
+        residual_mean: mean of the OLS residuals over all time points and voxels
+            of the run, that Yule-Walker centers them with (computed from Y if
+            None, give it when Y is a block of the voxels)
+    output:
+        (voxels,) array of binned AR(1) coefficients
+    """
+    residuals = get_ols_residuals(Y, X)
+    # _yule_walker(residuals.T, 1) in nilearn
+    x = residuals.T
+    n_time = x.shape[-1]
+    y = x - (x.mean() if residual_mean is None else residual_mean)
+    r0 = (y[:, np.newaxis, :] @ y[:, :, np.newaxis])[:, 0, 0] / (n_time * n_time)
+    r1 = (y[:, np.newaxis, 0:-1] @ y[:, 1:, np.newaxis])[:, 0, 0] / ((n_time - 1) * n_time)
+    # batched 1 x 1 solve, not r1 / r0, to round exactly like nilearn
+    ar1 = np.linalg.solve(r0[:, np.newaxis, np.newaxis], r1[:, np.newaxis])[:, 0]
+    return (ar1 * bins).astype(int) * 1.0 / bins
+
+
+def get_bin_design(X, value, bin_designs=None):
+    """
+    Whitened design of one AR(1) bin, its pseudo inverse and unscaled covariance
+    (as ARModel), looked up in / added to bin_designs if given
+    """
+    if bin_designs is not None and value in bin_designs:
+        return bin_designs[value]
+    whitened_design = X.copy()
+    whitened_design[1:] = whitened_design[1:] - value * X[:-1]
+    calc_beta = linalg.pinv(whitened_design)
+    bin_design = (whitened_design, calc_beta, np.dot(calc_beta, np.transpose(calc_beta)))
+    if bin_designs is not None:
+        bin_designs[value] = bin_design
+    return bin_design
+
+
+def fit_ar1_bins(Y, X, ar1, minimize_memory=True, bin_designs=None):
+    """
+    Prewhitened fit of one design for all voxels, grouped by AR(1) bin.  The
+    data are whitened for all voxels at once (each voxel with its own
+    coefficient) and each bin is refit with the pseudo inverse of its whitened
+    design, with the arithmetic of nilearn's ARModel.fit.
+    input:
+        Y: (time x voxels) mean scaled data
+        X: (time x regressors) design array (float64)
+        ar1: binned AR(1) coefficient per voxel (estimate_ar1)
+        bin_designs: dictionary bin -> get_bin_design() output of this design,
+            to reuse the bin designs across calls (voxel blocks of one run)
+    output:
+        labels: ar1 (AR(1) bin of each voxel)
+        results: dictionary bin -> AR1BinResults
+    """
+    wY = np.empty(Y.shape)
+    wY[0] = Y[0]
+    wY[1:] = Y[1:] - ar1 * Y[:-1]
+    n_time, n_regressors = X.shape
+    eps = np.abs(X).sum() * np.finfo(np.float64).eps
+    df_residuals = n_time - np.linalg.matrix_rank(X, eps)
+
+    values, bin_index = np.unique(ar1, return_inverse=True)
+    order = np.argsort(bin_index, kind="stable")
+    bin_voxels = np.split(order, np.cumsum(np.bincount(bin_index))[:-1])
+    results = {}
+    for value, voxels in zip(values, bin_voxels):
+        whitened_design, calc_beta, cov = get_bin_design(X, value, bin_designs)
+        wY_bin = wY[:, voxels]
+        theta = np.dot(calc_beta, wY_bin)
+        wresid = wY_bin - np.dot(whitened_design, theta)
+        dispersion = np.sum(wresid**2, 0) / (n_time - n_regressors)
+        results[value] = AR1BinResults(
+            theta,
+            cov,
+            dispersion,
+            df_residuals,
+            Y=None if minimize_memory else Y[:, voxels],
+            whitened_design=None if minimize_memory else whitened_design,
+        )
+    return ar1, results
+
+
+def fit_ar1_glm(
+    masked_bold,
+    design_matrix,
+    bins=100,
+    minimize_memory=True,
+    bin_designs=None,
+    residual_mean=None,
+):
+    """
+    AR(1) GLM of one BOLD run, numerically consistent with FirstLevelModel.fit
+    (signal_scaling=0, noise_model='ar1'): the results equal nilearn's.
+    input:
+        masked_bold: (time x voxels) array (see bold_cache.get_masked_bold)
+        design_matrix: design matrix data frame
+        minimize_memory: False keeps what the residuals need (Y, whitened design)
+        bin_designs: dictionary of the bin designs (see fit_ar1_bins), kept by
+            the caller when the run is fit in voxel blocks
+        residual_mean: OLS residual mean of the run (see estimate_ar1), needed
+            when masked_bold is a block of the voxels
+    output:
+        labels, results: see fit_ar1_bins
+    """
+    from nilearn.glm.first_level.first_level import mean_scaling
+
+    Y, _ = mean_scaling(masked_bold, 0)
+    X = np.asarray(design_matrix.values, np.float64)
+    ar1 = estimate_ar1(Y, X, bins, residual_mean)
+    return fit_ar1_bins(Y, X, ar1, minimize_memory, bin_designs)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from utils_lev1.design_cache import hash_file
+
+# bump when the data preparation changes (masking, smoothing)
+bold_cache_version = 1
+
+
+def get_bold_cache_key(data_file, mask_file, smoothing_fwhm):
+    """
+    Content address of a prepared BOLD run: hash of the BOLD and mask file
+    contents and the smoothing kernel
+    """
+    key_items = {
+        "version": bold_cache_version,
+        "bold": hash_file(data_file),
+        "mask": hash_file(mask_file),
+        "smoothing_fwhm": smoothing_fwhm,
+    }
+    return hashlib.sha256(json.dumps(key_items, sort_keys=True).encode()).hexdigest()
+
+
+def get_bold_cache_file(cache_dir, key):
+    return f"{cache_dir}/{key[:2]}/{key}.npy"
+
+
+def mask_and_smooth(data_file, mask_file, smoothing_fwhm, tr):
+    """
+    (time x voxels) matrix of a BOLD run in the brain mask, smoothed.  Same
+    masker settings as FirstLevelModel.fit (mask_img, smoothing_fwhm, no
+    standardization), so models fit from it equal models fit from the image.
+    The matrix has the dtype of the data (float32 for the denoised BOLD).
+    """
+    from nilearn.maskers import NiftiMasker
+
+    masker = NiftiMasker(
+        mask_img=mask_file,
+        smoothing_fwhm=smoothing_fwhm,
+        standardize=False,
+        mask_strategy="epi",
+        t_r=tr,
+    )
+    return masker.fit(data_file).transform(data_file)
+
+
+def write_masked_bold_blocks(data_file, mask_file, smoothing_fwhm, tr, filename, max_memory):
+    """
+    Writes the matrix of mask_and_smooth to a .npy file, preparing a block of
+    volumes at a time (smoothing is within volumes, so the result is the same)
+    with the block size set by max_memory (bytes).  The BOLD file is read
+    sequentially and kept open, so a gzipped file is decompressed once.
+    """
+    import nibabel as nb
+
+    img = nb.load(data_file, keep_file_open=True)
+    n_scans = img.shape[3]
+    # raw block, the masker's copy and smoothing buffers
+    bytes_per_volume = 4 * int(np.prod(img.shape[:3])) * img.get_data_dtype().itemsize
+    block_size = int(min(n_scans, max(1, max_memory // bytes_per_volume)))
+    masked_bold = None
+    for start in range(0, n_scans, block_size):
+        block_img = nb.Nifti1Image(
+            np.asanyarray(img.dataobj[..., start : start + block_size]),
+            img.affine,
+            img.header,
+        )
+        block = mask_and_smooth(block_img, mask_file, smoothing_fwhm, tr)
+        if masked_bold is None:
+            masked_bold = np.lib.format.open_memmap(
+                filename, mode="w+", dtype=block.dtype, shape=(n_scans, block.shape[1])
+            )
+        masked_bold[start : start + block.shape[0]] = block
+    masked_bold.flush()
+    del masked_bold
+
+
+def get_masked_bold(data_file, mask_file, tr, smoothing_fwhm=5, cache_dir=None, max_memory=None):
+    """
+    Loads, masks and smooths a BOLD run once: the (time x voxels) matrix is
+    stored uncompressed in cache_dir, keyed by the content of the BOLD and mask
+    files and the smoothing kernel, and later calls (other RT models, residuals,
+    reruns) get a read only memory mapped view of it.  Written to a temporary
+    file and renamed, so concurrent jobs never read a partial entry.
+    input:
+        cache_dir: BOLD cache directory (None to always prepare the data, without
+            caching it)
+        max_memory: if given (bytes), a missing cache entry is prepared in blocks
+            of volumes within this budget (see write_masked_bold_blocks)
+    output:
+        (time x voxels in mask) array, voxels in the order of the mask
+    """
+    if cache_dir is None:
+        return mask_and_smooth(data_file, mask_file, smoothing_fwhm, tr)
+    cache_file = get_bold_cache_file(
+        cache_dir, get_bold_cache_key(data_file, mask_file, smoothing_fwhm)
+    )
+    if not os.path.exists(cache_file):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+        try:
+            if max_memory is None:
+                masked_bold = mask_and_smooth(data_file, mask_file, smoothing_fwhm, tr)
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, masked_bold)
+                del masked_bold
+            else:
+                os.close(fd)
+                write_masked_bold_blocks(
+                    data_file, mask_file, smoothing_fwhm, tr, tmp_file, max_memory
+                )
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+    return np.load(cache_file, mmap_mode="r")
@@ -0,0 +1,158 @@
+from argparse import ArgumentTypeError
+
+import numpy as np
+import nibabel as nb
+
+from utils_lev1.ar1_glm import fit_ar1_glm, get_ols_residuals
+from utils_lev1.bold_cache import get_masked_bold
+from utils_lev1.glm_outputs import (
+    compute_contrasts_batched,
+    iter_residual_chunks,
+    write_masked_timeseries,
+)
+
+# Bounded memory first level fit: the masked BOLD matrix is memory mapped from
+# disk, the voxels are fit in blocks sized to a memory budget and the results
+# of each block are written into memory mapped arrays preallocated for the
+# whole run, so peak memory no longer depends on the size of the volumes.
+
+memory_units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_memory(value):
+    """Memory size in bytes from a number of bytes or e.g. 512M, 4G (argparse type)"""
+    size = str(value).strip().upper().rstrip("B")
+    try:
+        if size[-1:] in memory_units:
+            return int(float(size[:-1]) * memory_units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise ArgumentTypeError(f"invalid memory size: {value}")
+
+
+def get_block_size(n_items, bytes_per_item, max_memory):
+    """Number of items (voxels, time points) of bytes_per_item that fit in max_memory"""
+    return int(min(n_items, max(1, max_memory // bytes_per_item)))
+
+
+def get_voxel_block_size(n_voxels, n_scans, n_contrasts, max_memory, residuals=False):
+    """
+    Voxels per block of the fit: per voxel, the data block (float32 and mean
+    scaled float64), the OLS residuals, the whitened data and the per-bin copies,
+    plus the fitted data and residuals with residuals, and the statistics of
+    each contrast
+    """
+    bytes_per_voxel = 8 * n_scans * (5 + 2 * residuals) + 8 * 6 * n_contrasts
+    return get_block_size(n_voxels, bytes_per_voxel, max_memory)
+
+
+def fit_first_level_blocks(
+    data_file,
+    mask_file,
+    tr,
+    design_matrix,
+    contrast_matrix,
+    max_memory,
+    work_dir,
+    bold_cache_dir=None,
+    residuals_filename=None,
+):
+    """
+    Fits the first level model of a run one block of voxels at a time and
+    computes its contrasts, with the model of glm_outputs.fit_first_level.
+    Mean scaling, AR(1) estimates and fits are per voxel, except that the AR(1)
+    estimate centers the OLS residuals with their mean over the whole run: a
+    first pass over the blocks computes it.  Equal to the whole run fit to
+    numerical precision.
+    input:
+        max_memory: memory budget in bytes, sets the number of volumes prepared
+            at a time (if the BOLD run is not cached yet), the number of voxels
+            per block and the number of residual volumes written at a time
+        work_dir: directory of the preallocated (memory mapped) outputs, and of
+            the masked BOLD matrix if bold_cache_dir is None
+        bold_cache_dir: BOLD cache directory (see bold_cache.get_masked_bold)
+        residuals_filename: if given, the residuals are written to this file
+    output:
+        dictionary with effect_size, effect_variance and z_score arrays of shape
+        (contrasts x voxels in mask), memory mapped from work_dir
+    """
+    from nilearn.glm.first_level.first_level import mean_scaling
+
+    masked_bold = get_masked_bold(
+        data_file,
+        mask_file,
+        tr,
+        smoothing_fwhm=5,
+        cache_dir=work_dir if bold_cache_dir is None else bold_cache_dir,
+        max_memory=max_memory,
+    )
+    n_scans, n_voxels = masked_bold.shape
+    n_contrasts = contrast_matrix.shape[0]
+    residuals = residuals_filename is not None
+
+    estimates = {
+        stat: np.lib.format.open_memmap(
+            f"{work_dir}/{stat}.npy", mode="w+", shape=(n_contrasts, n_voxels)
+        )
+        for stat in ["effect_size", "effect_variance", "z_score"]
+    }
+    if residuals:
+        residual_matrix = np.lib.format.open_memmap(
+            f"{work_dir}/residuals.npy", mode="w+", shape=(n_scans, n_voxels)
+        )
+
+    block_size = get_voxel_block_size(
+        n_voxels, n_scans, n_contrasts, max_memory, residuals
+    )
+    blocks = [
+        (start, min(start + block_size, n_voxels))
+        for start in range(0, n_voxels, block_size)
+    ]
+    X = np.asarray(design_matrix.values, np.float64)
+    residual_sum = 0.0
+    for start, stop in blocks:
+        Y, _ = mean_scaling(np.array(masked_bold[:, start:stop]), 0)
+        residual_sum += get_ols_residuals(Y, X).sum()
+        del Y
+    residual_mean = residual_sum / (n_scans * n_voxels)
+
+    # whitened designs of the AR(1) bins, shared by the blocks
+    bin_designs = {}
+    for start, stop in blocks:
+        labels, results = fit_ar1_glm(
+            np.array(masked_bold[:, start:stop]),
+            design_matrix,
+            minimize_memory=not residuals,
+            bin_designs=bin_designs,
+            residual_mean=residual_mean,
+        )
+        block_estimates = compute_contrasts_batched(labels, results, contrast_matrix)
+        for stat, values in block_estimates.items():
+            estimates[stat][:, start:stop] = values
+        if residuals:
+            residual_matrix[:, start:stop] = next(
+                iter_residual_chunks(labels, results, n_scans, chunk_size=n_scans)
+            )
+        del labels, results, block_estimates
+    del masked_bold
+
+    if residuals:
+        residual_matrix.flush()
+        mask_img = nb.load(mask_file)
+        # volume, its bytes and the masked rows of each time point
+        chunk_size = get_block_size(
+            n_scans, 8 * (2 * int(np.prod(mask_img.shape)) + n_voxels), max_memory
+        )
+        write_masked_timeseries(
+            (
+                residual_matrix[start : start + chunk_size]
+                for start in range(0, n_scans, chunk_size)
+            ),
+            mask_img,
+            n_scans,
+            residuals_filename,
+        )
+        del residual_matrix
+    for stat in estimates:
+        estimates[stat].flush()
+    return estimates
@@ -0,0 +1,136 @@
+import glob
+import os
+import re
+from file_index import load_json_index, write_json_atomic
+
+# Catalog of the level 1 contrast maps available to level 2, keyed by
+# task:contrast:rt_model:duration (the analyze_lev2.py argument) with the
+# subjects that have them.  It is built from the directories analyze_lev2.py
+# reads the maps from ({output_root}/{task}_lev1_output/contrasts_task_*, see
+# find_lev1_maps), parsed from the file names with the same rule
+# (parse_lev1_map_file), so every catalog entry has maps.  analyze_lev1.py
+# writes its maps elsewhere (task_*_rtmodel_*/contrast_estimates, BIDS style
+# names) and does not update the catalog: it is refreshed by analyze_lev2.py
+# (refresh subcommand, or once when a contrast is not found).  A directory is
+# only parsed again when its mtime changed, so a refresh is a stat per directory.
+
+# root of the level 1 maps analyze_lev2.py reads (and of their catalog)
+lev1_maps_root = '/oak/stanford/groups/russpold/data/uh2/aim1_mumford/output'
+
+# bump when the catalog format or the parsing of its sources changes
+catalog_version = 2
+
+
+def get_catalog_file(output_root):
+    return f'{output_root}/lev1_contrast_catalog.json'
+
+
+def get_catalog_key(task, contrast, rt_model, duration):
+    return f'{task}:{contrast}:{rt_model}:{duration}'
+
+
+def get_lev1_contrast_dir(output_root, task, rt_model, duration):
+    return (f'{output_root}/{task}_lev1_output/contrasts_task_{task}_rtmodel_{rt_model}_'
+            f'duration_{duration}')
+
+
+def find_source_dirs(output_root):
+    """Directories below output_root the level 1 maps are read from"""
+    return sorted(glob.glob(f'{output_root}/*_lev1_output/contrasts_task_*'))
+
+
+def parse_lev1_map_file(filename):
+    """
+    Catalog key and subject of a level 1 map, from file names like
+    task_{task}_contrast_{contrast}_sub_{subid}_rtmodel_{rt_model}_duration_{duration}_stat_...
+    output:
+        (key, subid), None if filename is not a level 1 map
+    """
+    match = re.search('task_(.*)_contrast_(.*)_sub_(.*)_rtmodel_(.*)_duration_(.*)_stat_',
+                      os.path.basename(filename))
+    if match is None:
+        return None
+    task, contrast, subid, rt_model, duration = match.groups()
+    return get_catalog_key(task, contrast, rt_model, duration), subid
+
+
+def find_lev1_maps(output_root, lev1_task_contrast):
+    """
+    Level 1 maps of one catalog key (task:contrast:rt_model:duration)
+    output:
+        sub_list: subjects, in the order of lev1_files
+        lev1_files: sorted list of files (empty if there are none)
+    """
+    task, _, rt_model, duration = lev1_task_contrast.split(':')
+    contrast_dir = get_lev1_contrast_dir(output_root, task, rt_model, duration)
+    sub_list, lev1_files = [], []
+    for filename in sorted(glob.glob(f'{contrast_dir}/*')):
+        parsed = parse_lev1_map_file(filename)
+        if parsed is not None and parsed[0] == lev1_task_contrast:
+            sub_list.append(parsed[1])
+            lev1_files.append(filename)
+    return sub_list, lev1_files
+
+
+def parse_source_dir(contrast_dir):
+    """Catalog entries of one level 1 directory: key -> sorted list of subjects"""
+    entries = {}
+    for filename in os.listdir(contrast_dir):
+        parsed = parse_lev1_map_file(filename)
+        if parsed is not None:
+            entries.setdefault(parsed[0], set()).add(parsed[1])
+    return {key: sorted(subjects) for key, subjects in entries.items()}
+
+
+def merge_sources(sources):
+    """Catalog entries (task, contrast, rt_model, duration, subjects) of all sources"""
+    subjects = {}
+    for source in sources.values():
+        for key, source_subjects in source['entries'].items():
+            subjects.setdefault(key, set()).update(source_subjects)
+    contrasts = {}
+    for key in sorted(subjects):
+        task, contrast, rt_model, duration = key.split(':')
+        contrasts[key] = {'task': task, 'contrast': contrast, 'rt_model': rt_model,
+                          'duration': duration, 'subjects': sorted(subjects[key])}
+    return contrasts
+
+
+def load_contrast_catalog(output_root):
+    """Persisted catalog (empty if there is none yet, or it has an older version)"""
+    catalog = load_json_index(get_catalog_file(output_root))
+    if catalog.get('version') != catalog_version:
+        return {'version': catalog_version, 'sources': {}, 'contrasts': {}}
+    return catalog
+
+
+def refresh_contrast_catalog(output_root, source_dirs=None, full=False):
+    """
+    Updates the catalog from the directories whose mtime changed since they were
+    parsed, and writes it (atomically) if anything changed.  The mtime is read
+    before a directory is parsed, so a file added meanwhile triggers another
+    parse on the next refresh: a catalog written by a concurrent job that missed
+    an update is repaired by the next refresh.
+    input:
+        source_dirs: only check these directories, None for all of them
+        full: parse all directories again
+    output:
+        the catalog
+    """
+    catalog = load_contrast_catalog(output_root)
+    sources = {} if full else dict(catalog['sources'])
+    if source_dirs is None:
+        source_dirs = find_source_dirs(output_root)
+        sources = {source_dir: source for source_dir, source in sources.items()
+                   if source_dir in source_dirs}
+    for source_dir in source_dirs:
+        mtime_ns = os.stat(source_dir).st_mtime_ns
+        if source_dir in sources and sources[source_dir]['mtime_ns'] == mtime_ns:
+            continue
+        sources[source_dir] = {'mtime_ns': mtime_ns, 'entries': parse_source_dir(source_dir)}
+    if sources != catalog['sources']:
+        catalog = {'version': catalog_version, 'sources': sources,
+                   'contrasts': merge_sources(sources)}
+        write_json_atomic(get_catalog_file(output_root), catalog)
+    return catalog
+
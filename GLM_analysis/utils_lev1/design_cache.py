@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# bump when the design construction changes in a way that is not captured by
+# the task design spec (e.g. confound selection, hrf model)
+design_cache_version = 3
+
+# hashes computed in this process, keyed by file, size and mtime, so a file used
+# by several steps (design cache, BOLD cache, run manifest) is read once
+_file_hashes = {}
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """sha256 of the content of a file"""
+    stat = os.stat(path)
+    hash_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if hash_key not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha.update(chunk)
+        _file_hashes[hash_key] = sha.hexdigest()
+    return _file_hashes[hash_key]
+
+
+def get_design_cache_key(
+    events_file,
+    confounds_file,
+    task,
+    add_deriv,
+    regress_rt,
+    duration_choice,
+    tr,
+    n_scans,
+):
+    """
+    Content address of a design: hash of the events and confounds file
+    contents, the design parameters and the task design spec.  For rt_centered
+    models the group mean RT the RT regressor is centered on is included too.
+    """
+    from utils_lev1.first_level_designs import get_mean_rt
+    from utils_lev1.task_design_specs import task_design_specs
+
+    key_items = {
+        "version": design_cache_version,
+        "events": hash_file(events_file),
+        "confounds": None if confounds_file is None else hash_file(confounds_file),
+        "task": task,
+        "add_deriv": add_deriv,
+        "regress_rt": regress_rt,
+        "duration_choice": duration_choice,
+        "tr": float(tr),
+        "n_scans": int(n_scans),
+        "spec": task_design_specs[task],
+        "mean_rt": get_mean_rt(task) if regress_rt == "rt_centered" else None,
+    }
+    return hashlib.sha256(json.dumps(key_items, sort_keys=True).encode()).hexdigest()
+
+
+def get_design_cache_file(cache_dir, key):
+    return f"{cache_dir}/{key[:2]}/{key}.npz"
+
+
+def _is_text(values):
+    """whether every value is a string or NaN"""
+    return all(
+        isinstance(value, str) or (isinstance(value, float) and np.isnan(value))
+        for value in values
+    )
+
+
+def save_design(cache_dir, key, design_matrix, contrasts, percent_junk, events_df):
+    """
+    Stores a design (output of make_task_desmat) column by column in an
+    uncompressed .npz file: the design matrix as a single float array and each
+    events column as its own array (text and categorical columns as category
+    codes, categorical columns keep their categories and order).  Other object
+    columns (e.g. True/False/NaN) are pickled into a byte array so their values
+    keep their types.  Written to a temporary file and renamed, so concurrent
+    jobs never read a partial entry.
+    """
+    arrays = {
+        "design_matrix": design_matrix.to_numpy(),
+        "design_columns": np.array(design_matrix.columns, dtype=str),
+    }
+    events_columns = []
+    for idx, column in enumerate(events_df.columns):
+        values = events_df[column]
+        is_category = isinstance(values.dtype, pd.CategoricalDtype)
+        if is_category:
+            categories = values.cat.categories
+            as_codes = categories.dtype != object or _is_text(categories)
+        else:
+            as_codes = values.dtype == object and _is_text(values)
+        if as_codes:
+            categorical = pd.Categorical(values)
+            categories = categorical.categories
+            arrays[f"events_{idx}_codes"] = categorical.codes
+            arrays[f"events_{idx}_categories"] = (
+                np.array(categories, dtype=str)
+                if categories.dtype == object
+                else categories.to_numpy()
+            )
+            events_columns.append(
+                [column, "category" if is_category else "categorical"]
+            )
+        elif values.dtype == object or is_category:
+            pickled = pickle.dumps(values.values, protocol=pickle.HIGHEST_PROTOCOL)
+            arrays[f"events_{idx}_pickle"] = np.frombuffer(pickled, dtype=np.uint8)
+            events_columns.append([column, "pickle"])
+        else:
+            arrays[f"events_{idx}"] = values.to_numpy()
+            events_columns.append([column, "array"])
+    meta = {
+        "contrasts": list(contrasts.items()),
+        "percent_junk": float(percent_junk),
+        "events_columns": events_columns,
+    }
+    arrays["meta"] = np.array(json.dumps(meta))
+
+    cache_file = get_design_cache_file(cache_dir, key)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def load_design(cache_dir, key):
+    """
+    Loads a cached design
+    output:
+        design_matrix, contrasts, percent_junk, events_df or None if the design
+        is not in the cache
+    """
+    cache_file = get_design_cache_file(cache_dir, key)
+    if not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file, allow_pickle=False) as arrays:
+        meta = json.loads(arrays["meta"].item())
+        design_matrix = pd.DataFrame(
+            arrays["design_matrix"], columns=arrays["design_columns"].tolist()
+        )
+        events = {}
+        for idx, (column, kind) in enumerate(meta["events_columns"]):
+            if kind in ["categorical", "category"]:
+                events[column] = pd.Categorical.from_codes(
+                    arrays[f"events_{idx}_codes"],
+                    arrays[f"events_{idx}_categories"].tolist(),
+                )
+                # text columns are restored as text
+                if kind == "categorical":
+                    events[column] = events[column].astype(object)
+            elif kind == "pickle":
+                events[column] = pickle.loads(arrays[f"events_{idx}_pickle"].tobytes())
+            else:
+                events[column] = arrays[f"events_{idx}"]
+    events_df = pd.DataFrame(events)
+    contrasts = dict(meta["contrasts"])
+    return design_matrix, contrasts, np.float64(meta["percent_junk"]), events_df
@@ -0,0 +1,129 @@
+import numpy as np
+import nibabel as nb
+
+
+def build_fixed_effects_manifest(session_outputs):
+    """
+    Lists, for each contrast, the sessions whose estimates enter the fixed effects
+    input:
+        session_outputs: list of run_session() outputs
+    output:
+        manifest: dictionary contrast name -> list of session labels, in session
+            order.  Sessions that were not fit (QA failure, --qa_only) are left out.
+    """
+    manifest = {}
+    for session_output in session_outputs:
+        if session_output.get("estimates") is None:
+            continue
+        for con_name in session_output["contrasts"]:
+            manifest.setdefault(con_name, []).append(session_output["ses"])
+    return manifest
+
+
+def compute_fixed_effects_masked(effects, variances, session_masks):
+    """
+    Precision weighted fixed effects t statistic from masked (voxel vector) session
+    estimates.  Follows nilearn's compute_fixed_effects(precision_weighted=True)
+    (variance floor, weights, dof): estimates are combined over the union of the
+    session masks and a session contributes zero effect/variance where it is
+    outside its own mask.  Unlike compute_fixed_effects in nilearn 0.10, the
+    effects are not broadcast against the variances of the other sessions.
+    input:
+        effects: list of effect size vectors (one per session, voxels in session mask)
+        variances: list of variance vectors, same layout as effects
+        session_masks: list of boolean 3D session masks
+    output:
+        fixed_fx_contrast, fixed_fx_variance, fixed_fx_stat: vectors over the union
+            mask
+        union_mask: boolean 3D mask the vectors are defined on
+    """
+    from nilearn.glm.contrasts import Contrast
+
+    tiny = 1.0e-16
+    union_mask = np.logical_or.reduce(session_masks)
+    n_voxels = union_mask.sum()
+    contrasts = np.zeros((len(effects), n_voxels))
+    all_variances = np.zeros((len(effects), n_voxels))
+    for idx, (effect, variance, session_mask) in enumerate(
+        zip(effects, variances, session_masks)
+    ):
+        in_session = session_mask[union_mask]
+        contrasts[idx, in_session] = effect
+        all_variances[idx, in_session] = variance
+    all_variances = np.maximum(all_variances, tiny)
+    weights = 1.0 / all_variances
+    fixed_fx_variance = 1.0 / np.sum(weights, 0)
+    fixed_fx_contrast = np.sum(contrasts * weights, 0) * fixed_fx_variance
+    fixed_fx_stat = Contrast(
+        effect=fixed_fx_contrast[np.newaxis],
+        variance=fixed_fx_variance,
+        dim=1,
+        dof=100 * len(effects),
+    ).stat()
+    return fixed_fx_contrast, fixed_fx_variance, fixed_fx_stat, union_mask
+
+
+def compute_subject_fixed_effects(session_outputs, manifest):
+    """
+    Fixed effects t maps for every contrast in the manifest, computed directly from
+    the in-memory session estimates (no reloading of the written session images)
+    input:
+        session_outputs: list of run_session() outputs including masked estimates
+        manifest: output of build_fixed_effects_manifest()
+    output:
+        dictionary contrast name -> fixed effects t statistic Nifti1Image
+    """
+    by_session = {
+        session_output["ses"]: session_output
+        for session_output in session_outputs
+        if session_output.get("estimates") is not None
+    }
+    mask_imgs = {ses: nb.load(by_session[ses]["mask_file"]) for ses in by_session}
+    masks = {ses: np.asarray(img.dataobj) != 0 for ses, img in mask_imgs.items()}
+    fixed_fx_stat_imgs = {}
+    for con_name, sessions in manifest.items():
+        effects, variances = [], []
+        for ses in sessions:
+            con_idx = list(by_session[ses]["contrasts"]).index(con_name)
+            effects.append(by_session[ses]["estimates"]["effect_size"][con_idx])
+            variances.append(by_session[ses]["estimates"]["effect_variance"][con_idx])
+        _, _, fixed_fx_stat, union_mask = compute_fixed_effects_masked(
+            effects, variances, [masks[ses] for ses in sessions]
+        )
+        stat_volume = np.zeros(union_mask.shape)
+        stat_volume[union_mask] = fixed_fx_stat
+        fixed_fx_stat_imgs[con_name] = nb.Nifti1Image(
+            stat_volume, mask_imgs[sessions[0]].affine
+        )
+    return fixed_fx_stat_imgs
+
+
+def load_session_estimates(filenames, mask_file, stacked=False):
+    """
+    Masked effect sizes/variances of a session read back from the images written
+    by glm_outputs.save_contrast_estimates (memory mapped if they were written
+    uncompressed).  They are written as float64, so these
+    equal the in-memory estimates of the run that wrote them (used when only some
+    sessions of a subject are rerun).
+    input:
+        filenames: dictionary statistic -> filename(s), as passed to
+            save_contrast_estimates
+        mask_file: mask image the session model was fit with
+        stacked: whether filenames are multi-volume files (one volume per contrast)
+    output:
+        dictionary effect_size / effect_variance -> (contrasts x voxels) arrays,
+        same layout as the estimates in run_session() outputs
+    """
+    mask = np.asarray(nb.load(mask_file).dataobj) != 0
+    estimates = {}
+    for stat in ["effect_size", "effect_variance"]:
+        if stacked:
+            estimates[stat] = np.asarray(nb.load(filenames[stat]).dataobj)[mask].T
+        else:
+            estimates[stat] = np.stack(
+                [
+                    np.asarray(nb.load(filename).dataobj).reshape(mask.shape)[mask]
+                    for filename in filenames[stat]
+                ]
+            )
+    return estimates
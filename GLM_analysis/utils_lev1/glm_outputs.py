@@ -0,0 +1,202 @@
+import numpy as np
+import nibabel as nb
+from nibabel.openers import ImageOpener
+
+# names used for each statistic in the output file names
+stat_file_labels = {
+    "effect_size": "effect-size",
+    "effect_variance": "variance",
+    "z_score": "z_score",
+}
+
+
+def get_image_extension(uncompressed=False):
+    """
+    Extension of the intermediate (session level) images.  Uncompressed NIfTI is
+    memory mapped by nibabel, so the readers (fixed effects, level 2,
+    visualization) take views of the file instead of inflating it on every read.
+    Final deliverables (fixed effects maps) are always compressed.
+    """
+    return ".nii" if uncompressed else ".nii.gz"
+
+
+def iter_residual_chunks(labels, results, n_scans, chunk_size=50):
+    """
+    Yields the (masked) residual time series of a fitted first level model a few
+    time points at a time, so the full residual matrix is never held in memory.
+    input:
+        labels: AR(1) label of each voxel (see fit_first_level)
+        results: dictionary of fits per label (ar1_glm.AR1BinResults),
+            requires the model was fit with minimize_memory=False
+        n_scans: number of time points
+        chunk_size: number of time points per chunk
+    output:
+        arrays of shape (time points in chunk, voxels in mask)
+    """
+    label_masks = {label: labels == label for label in results}
+    for start in range(0, n_scans, chunk_size):
+        stop = min(start + chunk_size, n_scans)
+        chunk = np.zeros((stop - start, labels.size))
+        for label, result in results.items():
+            # same as nilearn RegressionResults.residuals, without caching the full matrix
+            chunk[:, label_masks[label]] = (
+                result.Y[start:stop] - result.whitened_design[start:stop] @ result.theta
+            )
+        yield chunk
+
+
+def write_masked_timeseries(chunks, mask_img, n_scans, filename, dtype=np.float64):
+    """
+    Streams masked time series chunks into a 4D NIfTI file (gzipped if filename
+    ends in .gz).  NIfTI stores volumes contiguously, so each chunk of time points
+    is unmasked and appended to the file on its own and only one chunk of
+    volumes is in memory at a time.
+    input:
+        chunks: iterable of (time points x voxels in mask) arrays, in time order
+        mask_img: mask image the time series were extracted with
+        n_scans: total number of time points
+        filename: output file name
+    """
+    mask_img = nb.load(mask_img) if isinstance(mask_img, str) else mask_img
+    mask = np.asarray(mask_img.dataobj) != 0
+    header = nb.Nifti1Header()
+    header.set_data_shape(mask.shape + (n_scans,))
+    header.set_data_dtype(dtype)
+    header.set_qform(mask_img.affine, code=1)
+    header.set_sform(mask_img.affine, code=1)
+    header.set_xyzt_units("mm", "sec")
+    header.set_data_offset(352)
+    n_written = 0
+    with ImageOpener(filename, "wb") as fobj:
+        # writes the header and (empty) extension block, up to vox_offset
+        header.write_to(fobj)
+        for chunk in chunks:
+            volumes = np.zeros(mask.shape + (chunk.shape[0],), dtype=dtype)
+            volumes[mask] = chunk.T
+            fobj.write(volumes.tobytes(order="F"))
+            n_written += chunk.shape[0]
+    if n_written != n_scans:
+        raise ValueError(f"Wrote {n_written} time points to {filename}, expected {n_scans}")
+
+
+def fit_first_level(masked_bold, design_matrix, minimize_memory=True):
+    """
+    Fits a first level model to a masked BOLD run (see bold_cache.get_masked_bold),
+    with the results of FirstLevelModel.fit (signal_scaling=0, noise_model="ar1",
+    100 AR(1) bins), using the AR(1) engine in ar1_glm.py
+    input:
+        masked_bold: (time x voxels) array
+        design_matrix: design matrix data frame
+        minimize_memory: keep only what the contrasts need, False also keeps what
+            the residuals need
+    output:
+        labels, results: AR(1) bin of each voxel and dictionary bin -> fit
+            (ar1_glm.AR1BinResults), as fmri_glm.labels_[0], fmri_glm.results_[0]
+    """
+    from utils_lev1.ar1_glm import fit_ar1_glm
+
+    return fit_ar1_glm(masked_bold, design_matrix, minimize_memory=minimize_memory)
+
+
+def save_residuals(labels, results, mask_img, filename, chunk_size=50):
+    """
+    Writes the residuals of a fitted first level model (fit_first_level with
+    minimize_memory=False) to filename, streaming them chunk by chunk instead of
+    building the full 4D residual image in memory.
+    """
+    n_scans = next(iter(results.values())).Y.shape[0]
+    write_masked_timeseries(
+        iter_residual_chunks(labels, results, n_scans, chunk_size),
+        mask_img,
+        n_scans,
+        filename,
+    )
+
+
+def get_contrast_matrix(contrasts, design_columns):
+    """
+    Stacks the contrast vectors of all contrasts (dictionary of nilearn contrast
+    expressions) into a (contrasts x regressors) matrix
+    """
+    from nilearn.glm.contrasts import expression_to_contrast_vector
+
+    return np.array(
+        [
+            expression_to_contrast_vector(con, design_columns)
+            for con in contrasts.values()
+        ]
+    )
+
+
+def compute_contrasts_batched(labels, results, contrast_matrix):
+    """
+    Computes effect sizes, variances and z scores of every t contrast in one pass
+    over the AR(1) labels of a fitted model, instead of one
+    FirstLevelModel.compute_contrast call (and label loop) per contrast.  Matches
+    compute_contrast(..., output_type="all") to numerical precision.
+    input:
+        labels: AR(1) label of each voxel (see fit_first_level)
+        results: dictionary of fits per label (ar1_glm.AR1BinResults)
+        contrast_matrix: (contrasts x regressors) array, see get_contrast_matrix()
+    output:
+        dictionary with effect_size, effect_variance and z_score arrays of shape
+        (contrasts x voxels in mask)
+    """
+    from nilearn.glm.contrasts import Contrast
+
+    n_contrasts = contrast_matrix.shape[0]
+    effect = np.zeros((n_contrasts, labels.size))
+    variance = np.zeros((n_contrasts, labels.size))
+    for label, result in results.items():
+        label_mask = labels == label
+        effect[:, label_mask] = contrast_matrix @ result.theta
+        # c (X'X)^-1 c' for all contrasts, scaled by the voxelwise dispersion
+        contrast_cov = np.einsum(
+            "ij,jk,ik->i", contrast_matrix, result.cov, contrast_matrix
+        )
+        variance[:, label_mask] = contrast_cov[:, np.newaxis] * result.dispersion
+    dof = result.df_residuals
+    # t is the default contrast type
+    z_score = Contrast(
+        effect=effect.reshape(1, -1),
+        variance=variance.ravel(),
+        dim=1,
+        dof=dof,
+    ).z_score()
+    return {
+        "effect_size": effect,
+        "effect_variance": variance,
+        "z_score": z_score.reshape(effect.shape),
+    }
+
+
+def save_contrast_estimates(estimates, mask_img, filenames, stacked=False):
+    """
+    Unmasks the statistics and writes them out, one statistic (stacked) or one
+    contrast at a time so only the volumes being written are in memory.
+    input:
+        estimates: output of compute_contrasts_batched() (arrays may be memory
+            mapped, see chunked_glm.fit_first_level_blocks)
+        mask_img: mask image the model was fit with
+        filenames: dictionary keyed by statistic.  If stacked is False each value
+            is a list with one filename per contrast, if stacked is True each value
+            is a single filename for a multi-volume file (one volume per contrast)
+        stacked: whether to write one multi-volume file per statistic
+    """
+    mask_img = nb.load(mask_img) if isinstance(mask_img, str) else mask_img
+    mask = np.asarray(mask_img.dataobj) != 0
+    for stat, stat_filenames in filenames.items():
+        if stacked:
+            stat_volumes = np.zeros(mask.shape + (estimates[stat].shape[0],))
+            stat_volumes[mask] = estimates[stat].T
+            nb.Nifti1Image(stat_volumes, mask_img.affine).to_filename(stat_filenames)
+            del stat_volumes
+        else:
+            for con_idx, filename in enumerate(stat_filenames):
+                con_volume = np.zeros(mask.shape)
+                con_volume[mask] = estimates[stat][con_idx]
+                # FirstLevelModel.compute_contrast returns effect sizes as single
+                # volume 4D images, kept that way so existing outputs are unchanged
+                if stat == "effect_size":
+                    con_volume = con_volume[..., np.newaxis]
+                nb.Nifti1Image(con_volume, mask_img.affine).to_filename(filename)
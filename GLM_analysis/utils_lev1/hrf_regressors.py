@@ -0,0 +1,156 @@
+import warnings
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+def _get_hrf_kernels(hrf_model, tr, oversampling):
+    """
+    HRF (and derivative) kernels sampled at the oversampled resolution, stacked
+    into a (kernels x time) array.  Computed once per hrf model/TR.
+    """
+    return _hrf_kernels(hrf_model, float(tr), int(oversampling))
+
+
+@lru_cache(maxsize=None)
+def _hrf_kernels(hrf_model, tr, oversampling):
+    from nilearn.glm.first_level import (
+        spm_hrf,
+        spm_time_derivative,
+        glover_hrf,
+        glover_time_derivative,
+    )
+
+    kernel_fcns = {
+        "spm": [spm_hrf],
+        "spm + derivative": [spm_hrf, spm_time_derivative],
+        "glover": [glover_hrf],
+        "glover + derivative": [glover_hrf, glover_time_derivative],
+    }
+    if hrf_model not in kernel_fcns:
+        raise ValueError(
+            f'"{hrf_model}" is not supported, use one of {list(kernel_fcns)}'
+        )
+    kernels = np.array([fcn(tr, oversampling) for fcn in kernel_fcns[hrf_model]])
+    kernels.setflags(write=False)
+    return kernels
+
+
+def get_regressor_names(cond_id, hrf_model):
+    """Regressor names for a condition, same as nilearn's compute_regressor"""
+    if "derivative" in hrf_model:
+        return [cond_id, f"{cond_id}_derivative"]
+    return [cond_id]
+
+
+def get_high_res_frame_times(frame_times, oversampling=50, min_onset=-24):
+    """
+    Oversampled time grid used by nilearn's compute_regressor for frame_times
+    """
+    n_frames = frame_times.size
+    mini, maxi = frame_times.min(), frame_times.max()
+    n_frames_high_res = (n_frames - 1) * 1.0 / (maxi - mini)
+    n_frames_high_res *= (maxi * (1 + 1.0 / (n_frames - 1)) - mini - min_onset) * oversampling
+    n_frames_high_res += 1
+    return np.linspace(
+        mini + min_onset,
+        maxi * (1 + 1.0 / (n_frames - 1)),
+        np.rint(n_frames_high_res).astype(int),
+    )
+
+
+def sample_conditions(events, conditions, frame_times_high_res):
+    """
+    Boxcar time courses of all conditions on the oversampled grid
+    input:
+        events: data frame with onset, duration, modulation and condition columns
+        conditions: condition names, in output order (a condition without
+            events gets an all zero time course)
+        frame_times_high_res: output of get_high_res_frame_times()
+    output:
+        (conditions x oversampled time points) array
+    """
+    tmax = len(frame_times_high_res)
+    cond_idx = pd.Categorical(events["condition"], categories=conditions).codes
+    if (cond_idx < 0).any():
+        missing = set(events["condition"][cond_idx < 0])
+        raise ValueError(f"Events for conditions {missing} not in conditions")
+    onsets = events["onset"].to_numpy(dtype=float)
+    durations = events["duration"].to_numpy(dtype=float)
+    values = events["modulation"].to_numpy(dtype=float)
+
+    t_onset = np.minimum(np.searchsorted(frame_times_high_res, onsets), tmax - 1)
+    t_offset = np.minimum(
+        np.searchsorted(frame_times_high_res, onsets + durations), tmax - 1
+    )
+    # events with zero duration are offset at t + 1
+    t_offset[(t_offset < tmax - 1) & (t_offset == t_onset)] += 1
+
+    hr_regressors = np.zeros((len(conditions), tmax))
+    np.add.at(hr_regressors, (cond_idx, t_onset), values)
+    np.add.at(hr_regressors, (cond_idx, t_offset), -values)
+    return np.cumsum(hr_regressors, axis=1)
+
+
+def compute_regressors(
+    events, conditions, hrf_model, frame_times, oversampling=50, min_onset=-24
+):
+    """
+    Batched version of nilearn's compute_regressor: builds the regressors (and
+    derivatives) of all conditions with a single FFT convolution of the stacked
+    oversampled condition time courses, one interpolation and one (batched)
+    orthogonalization.  Matches compute_regressor, called per condition, to
+    numerical precision.
+    input:
+        events: data frame with onset, duration, modulation and condition columns
+        conditions: condition names, in output order
+        hrf_model: 'spm', 'spm + derivative', 'glover' or 'glover + derivative'
+        frame_times: sampling times of the scans
+    output:
+        regressors: data frame (scans x regressors), each condition is followed
+            by its derivative if requested
+    """
+    from scipy.interpolate import interp1d
+    from scipy.signal import fftconvolve
+
+    frame_times = np.asarray(frame_times, dtype=float)
+    tr = np.min(np.diff(frame_times))
+    if (events["onset"] < frame_times[0] + min_onset).any():
+        warnings.warn(
+            (
+                "Some stimulus onsets are earlier "
+                f"than {frame_times[0] + min_onset} in the"
+                " experiment and are thus not considered in the model."
+            ),
+            UserWarning,
+        )
+    frame_times_high_res = get_high_res_frame_times(frame_times, oversampling, min_onset)
+    hr_regressors = sample_conditions(events, conditions, frame_times_high_res)
+
+    # (conditions x kernels x oversampled time points)
+    kernels = _get_hrf_kernels(hrf_model, tr, oversampling)
+    conv_regressors = fftconvolve(
+        hr_regressors[:, np.newaxis, :], kernels[np.newaxis], axes=-1
+    )[..., : hr_regressors.shape[1]]
+    # (conditions x scans x kernels)
+    regressors = np.moveaxis(
+        interp1d(frame_times_high_res, conv_regressors)(frame_times), 1, 2
+    )
+
+    # orthogonalize each derivative with respect to the preceding regressors of
+    # the same condition
+    for i in range(1, regressors.shape[2]):
+        previous = regressors[:, :, :i]
+        coef = np.einsum("cs,csj->cj", regressors[:, :, i], previous)
+        regressors[:, :, i] -= np.einsum(
+            "cj,cjs->cs", coef, np.linalg.pinv(previous)
+        )
+
+    names = [name for cond in conditions for name in get_regressor_names(cond, hrf_model)]
+    return pd.DataFrame(
+        regressors.reshape(len(conditions), len(frame_times), -1)
+        .transpose(1, 0, 2)
+        .reshape(len(frame_times), -1),
+        columns=names,
+    )
@@ -0,0 +1,292 @@
+import json
+import os
+from file_index import load_json_index, write_json_atomic
+from utils_lev1.run_manifest import file_record, files_unchanged, get_code_version, lev1_code_version
+from utils_lev1.chunked_glm import parse_memory
+
+# A unit of level 1 work is one analyze_lev1.py call: one (task, subject, rt
+# model) with its options.  Each completed call leaves a run manifest (options,
+# code version and, per session, input file hashes, design and outputs) that the
+# scheduler checks to skip units whose outputs are complete and current, or to
+# rerun only the sessions that changed.
+
+analysis_code_dir = '/home/groups/russpold/network_fmri/analysis_code'
+
+# analyze_lev1.py options that change the outputs (n_jobs, max_memory do not)
+output_options = ['qa_only', 'fixed_effects', 'simplified_events', 'residuals',
+                  'stacked_contrasts', 'omit_deriv', 'uncompressed_intermediates']
+
+# memory of an analyze_lev1.py process (interpreter, nilearn, masks) on top of
+# the --max_memory budget of its model fits
+process_memory = '512M'
+
+
+def make_unit(task, subid, regress_rt, qa_only=False, fixed_effects=False,
+              simplified_events=False, residuals=False, uncompressed_intermediates=False,
+              n_jobs=1, max_memory=None, sessions=None):
+    return {
+        'task': task,
+        'subid': subid,
+        'regress_rt': regress_rt,
+        # None: all sessions, otherwise only these are rerun (--sessions)
+        'sessions': sessions,
+        'options': {
+            'qa_only': qa_only,
+            'fixed_effects': fixed_effects,
+            'simplified_events': simplified_events,
+            'residuals': residuals,
+            'uncompressed_intermediates': uncompressed_intermediates,
+            'n_jobs': n_jobs,
+            'max_memory': max_memory,
+        },
+    }
+
+
+def get_unit_command(unit, analyze_lev1_script=f'{analysis_code_dir}/analyze_lev1.py'):
+    """analyze_lev1.py command line (list of arguments) of a unit"""
+    command = [analyze_lev1_script, unit['task'], unit['subid'], unit['regress_rt']]
+    for option, value in unit['options'].items():
+        if option == 'n_jobs':
+            command += ['--n_jobs', str(value)]
+        elif option == 'max_memory':
+            if value:
+                command += ['--max_memory', str(value)]
+        elif value:
+            command.append(f'--{option}')
+    if unit.get('sessions'):
+        command += ['--sessions'] + unit['sessions']
+    return command
+
+
+def get_contrast_dir(outdir, task, regress_rt):
+    return f'{outdir}/{task}_lev1_output/task_{task}_rtmodel_{regress_rt}'
+
+
+def get_unit_manifest_file(contrast_dir, subid, task, regress_rt, qa_only=False):
+    # --qa_only runs have their own manifest so they do not replace the record of a full run
+    suffix = 'lev1-qa' if qa_only else 'lev1'
+    return f'{contrast_dir}/unit_manifests/sub-{subid}_task-{task}_rtmodel-{regress_rt}_{suffix}.json'
+
+
+def make_session_record(input_files, design_key, design_params, contrasts, fit, output_files,
+                        contrast_dir):
+    """
+    Run manifest entry of one session: content hashes of its input files, its
+    design (cache key and parameters), the contrasts and whether the model was
+    fit (False for --qa_only or a QA failure) and its outputs (relative to
+    contrast_dir)
+    """
+    return {
+        'inputs': {input_file: file_record(input_file) for input_file in input_files},
+        'design': {'key': design_key, 'params': design_params},
+        'contrasts': list(contrasts),
+        'fit': fit,
+        'outputs': sorted(os.path.relpath(output_file, contrast_dir)
+                          for output_file in output_files),
+    }
+
+
+def write_unit_manifest(contrast_dir, subid, task, regress_rt, options, session_records,
+                        fixed_effects_sessions=None, fixed_effects_outputs=()):
+    """
+    Records a completed analyze_lev1.py call: its options, the code version, one
+    entry per session (see make_session_record) and the fixed effects (sessions
+    per contrast and outputs).  'outputs' maps every output (relative to
+    contrast_dir) to the sessions it was computed from.
+    input:
+        session_records: dictionary session -> session record.  With --sessions
+            the records of the other sessions are carried over from the
+            previous manifest by the caller.
+        fixed_effects_outputs: list of (output file, sessions) pairs
+    output:
+        the manifest written
+    """
+    outputs = {}
+    for ses, session_record in session_records.items():
+        for output_file in session_record['outputs']:
+            outputs[output_file] = [ses]
+    for output_file, sessions in fixed_effects_outputs:
+        outputs[os.path.relpath(output_file, contrast_dir)] = sorted(sessions)
+    manifest = {
+        'options': {option: options[option] for option in output_options},
+        'code_version': get_code_version(),
+        'sessions': session_records,
+        'fixed_effects': fixed_effects_sessions,
+        'outputs': outputs,
+    }
+    write_json_atomic(
+        get_unit_manifest_file(contrast_dir, subid, task, regress_rt, options['qa_only']), manifest)
+    return manifest
+
+
+def remove_stale_outputs(contrast_dir, previous_manifest, manifest):
+    """
+    Removes the outputs of the previous run of a unit (same options) that the new
+    run did not write again, e.g. the contrast estimates of a session that now
+    fails QA, so they cannot be picked up downstream
+    """
+    if not previous_manifest or previous_manifest['options'] != manifest['options']:
+        return
+    for output_file in set(previous_manifest['outputs']) - set(manifest['outputs']):
+        if os.path.exists(f'{contrast_dir}/{output_file}'):
+            os.remove(f'{contrast_dir}/{output_file}')
+
+
+def load_unit_manifest(contrast_dir, subid, task, regress_rt, qa_only=False):
+    """Run manifest of a unit ({} if there is none, or it predates session records)"""
+    manifest = load_json_index(
+        get_unit_manifest_file(contrast_dir, subid, task, regress_rt, qa_only))
+    return manifest if 'sessions' in manifest else {}
+
+
+def get_stale_sessions(manifest, root, subid, task, contrast_dir):
+    """
+    Sessions whose outputs are out of date: new sessions, sessions whose input
+    files or design (cache key: events/confounds content, design parameters,
+    task design spec, group mean RT) changed and sessions with missing outputs.
+    All sessions are stale if there is no manifest, the manifest was written by
+    an older lev1_code_version, a recorded session is gone or a fixed effects
+    output is missing.
+    output:
+        list of session labels (e.g. ['ses-01']), in session order
+    """
+    from analyze_lev1 import get_files, get_session_files, get_nscans, get_session_design_key
+
+    files = get_files(root, subid, task)
+    sessions = {data_file.split('/')[-3]: data_file for data_file in files['data_file']}
+    if (not manifest or manifest['code_version']['lev1'] != lev1_code_version
+            or not set(manifest['sessions']) <= set(sessions)):
+        return list(sessions)
+    session_outputs = [output_file for session_record in manifest['sessions'].values()
+                       for output_file in session_record['outputs']]
+    if not all(os.path.exists(f'{contrast_dir}/{output_file}')
+               for output_file in manifest['outputs'] if output_file not in session_outputs):
+        return list(sessions)
+
+    stale = []
+    for ses, data_file in sessions.items():
+        session_record = manifest['sessions'].get(ses)
+        if session_record is None:
+            stale.append(ses)
+            continue
+        _, event_file, confounds_file, mask_file = get_session_files(files, data_file)
+        if not files_unchanged(session_record['inputs'],
+                               [data_file, event_file, confounds_file, mask_file]):
+            stale.append(ses)
+            continue
+        params = session_record['design']['params']
+        design_key = get_session_design_key(
+            task, event_file, confounds_file, params['add_deriv'], params['regress_rt'],
+            params['duration_choice'], get_nscans(data_file))
+        if design_key != session_record['design']['key']:
+            stale.append(ses)
+        elif not all(os.path.exists(f'{contrast_dir}/{output_file}')
+                     for output_file in session_record['outputs']):
+            stale.append(ses)
+    return stale
+
+
+def plan_unit(unit, root, outdir):
+    """
+    Decides what is left to do for a unit.  A full run also completes a
+    --qa_only unit with the same design (omit_deriv).
+    output:
+        None if the outputs of the unit are complete and current, otherwise the
+        unit restricted to its stale sessions (unit['sessions'], None to run all
+        sessions)
+    """
+    task, subid, regress_rt = unit['task'], unit['subid'], unit['regress_rt']
+    contrast_dir = get_contrast_dir(outdir, task, regress_rt)
+    unit_options = {option: unit['options'].get(option, False) for option in output_options}
+    manifest = load_unit_manifest(contrast_dir, subid, task, regress_rt)
+    if unit_options['qa_only']:
+        if (manifest and manifest['options']['omit_deriv'] == unit_options['omit_deriv']
+                and not get_stale_sessions(manifest, root, subid, task, contrast_dir)):
+            return None
+        manifest = load_unit_manifest(contrast_dir, subid, task, regress_rt, qa_only=True)
+    if manifest and manifest['options'] != unit_options:
+        manifest = {}
+    stale = get_stale_sessions(manifest, root, subid, task, contrast_dir)
+    if not stale:
+        return None
+    all_sessions = get_stale_sessions({}, root, subid, task, contrast_dir)
+    return dict(unit, sessions=None if stale == all_sessions else stale)
+
+
+def is_unit_complete(unit, root, outdir):
+    """True if the outputs of the unit are complete and current (see plan_unit)"""
+    return plan_unit(unit, root, outdir) is None
+
+
+def pack_units(units, qa_pack_size=10):
+    """
+    Groups units into job array elements: one element per full model unit and
+    --qa_only units (short) packed qa_pack_size per element
+    output:
+        list of elements, each a list of units
+    """
+    full_units = [unit for unit in units if not unit['options']['qa_only']]
+    qa_units = [unit for unit in units if unit['options']['qa_only']]
+    elements = [[unit] for unit in full_units]
+    elements += [qa_units[start:start + qa_pack_size]
+                 for start in range(0, len(qa_units), qa_pack_size)]
+    return elements
+
+
+def get_job_memory(max_memory, n_jobs):
+    """
+    SLURM --mem of an array element running analyze_lev1.py with --max_memory
+    and --n_jobs: the budget plus the main, session and figure processes
+    """
+    memory = parse_memory(max_memory) + (n_jobs + 2) * parse_memory(process_memory)
+    return f'{-(-memory // 2**20)}M'
+
+
+def write_batch_file(batch_stub, batch_file, job_name, command, n_elements=None,
+                     max_concurrent=50, mem=None):
+    """SLURM script running command (from the batch stub), a job array if n_elements"""
+    with open(batch_stub) as infile, open(batch_file, 'w') as outfile:
+        for line in infile:
+            # one log file per array element
+            if n_elements is not None:
+                line = line.replace('JOBNAME.out', f'{job_name}_%A_%a.out')
+                line = line.replace('JOBNAME.err', f'{job_name}_%A_%a.err')
+            line = line.replace('JOBNAME', job_name)
+            if mem is not None and line.startswith('#SBATCH --mem'):
+                line = f'#SBATCH --mem={mem}\n'
+            outfile.write(line)
+            if n_elements is not None and line.startswith('#SBATCH --job-name'):
+                outfile.write(f'#SBATCH --array=0-{n_elements - 1}%{max_concurrent}\n')
+        outfile.write(command + '\n')
+
+
+def get_qa_summary_batch_file(batch_file):
+    return batch_file.replace('.batch', '_qa_summary.batch')
+
+
+def write_job_array(elements, batch_stub, batch_file, job_name, max_concurrent=50, mem=None):
+    """
+    Writes a SLURM job array script (from the batch stub) with one array element
+    per element of units, and the units file it reads (same name, .json).  Each
+    array element runs run_lev1_units.py on its units, skipping the ones that
+    were completed in the meantime.  mem (e.g. get_job_memory()) replaces the
+    memory request of the stub.  A second script (get_qa_summary_batch_file),
+    to be run once the array is done (launch_all_lev1_sherlock.sh), renders the
+    QA summaries of the units from their per session records: the array
+    elements only write their own records.
+    """
+    units_file = batch_file.replace('.batch', '_units.json')
+    write_json_atomic(units_file, elements)
+    write_batch_file(batch_stub, batch_file, job_name,
+                     f'{analysis_code_dir}/run_lev1_units.py {units_file} '
+                     '--index ${SLURM_ARRAY_TASK_ID}',
+                     n_elements=len(elements), max_concurrent=max_concurrent, mem=mem)
+    write_batch_file(batch_stub, get_qa_summary_batch_file(batch_file), f'{job_name}_qa_summary',
+                     f'{analysis_code_dir}/run_lev1_units.py {units_file} --render_qa',
+                     mem='8G')
+    return units_file
+
+
+def load_units_file(units_file):
+    with open(units_file) as f:
+        return json.load(f)
@@ -0,0 +1,261 @@
+import itertools
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import linalg
+
+# Permutation inference for the level 2 models, in process (instead of FSL
+# randomise): a mass univariate GLM on the (subjects x voxels) matrix, tested
+# with sign flips (one sample t-tests) or Freedman-Lane permutations (models
+# with covariates).  Each batch of shuffles is applied to all voxels with one
+# matrix product and batches are spread over a process pool.
+
+# contrast models of the running analysis, set before the pool is forked so the
+# workers share the data matrices instead of receiving a copy with every batch
+_models = None
+
+
+def partition_design(X, contrast):
+    """
+    Splits a design into the effect of a (1 row) contrast and nuisance
+    regressors spanning the rest of the design (Beckmann partitioning, as in
+    randomise; the nuisance contrasts are made orthogonal to the contrast in the
+    metric of (X'X)^-1, Winkler et al. 2014, appendix A).  The model
+    [X_effect, Z] fits the data exactly as X does and the contrast is the
+    coefficient of X_effect.
+    output:
+        X_effect: (subjects,) regressor of interest
+        Z: (subjects x nuisance regressors) array, no columns for a one sample
+            t-test
+    """
+    contrast = np.atleast_2d(np.asarray(contrast, dtype=np.float64))
+    xtx_inv = linalg.pinv(X.T @ X)
+    X_effect = X @ xtx_inv @ contrast.T @ linalg.pinv(contrast @ xtx_inv @ contrast.T)
+    contrast_null = linalg.null_space(contrast)
+    if contrast_null.shape[1] == 0:
+        return X_effect[:, 0], np.zeros((X.shape[0], 0))
+    contrast_null = contrast_null - contrast.T @ linalg.pinv(
+        contrast @ xtx_inv @ contrast.T
+    ) @ contrast @ xtx_inv @ contrast_null
+    Z = (
+        X
+        @ xtx_inv
+        @ contrast_null
+        @ linalg.pinv(contrast_null.T @ xtx_inv @ contrast_null)
+    )
+    return X_effect[:, 0], Z
+
+
+def setup_contrast_model(Y, X, contrast):
+    """
+    Everything the permutations of one contrast need.  Freedman-Lane: the
+    residuals of the nuisance model are shuffled and the full model is refit,
+    which is a projection of the shuffled residuals (the nuisance fit does not
+    change the effect or the residuals of the full model).  If the effect of
+    interest is constant (e.g. the intercept), permutations leave it unchanged
+    and the residuals are sign flipped instead (symmetric errors).
+    input:
+        Y: (subjects x voxels) data
+        X: (subjects x regressors) design
+        contrast: contrast vector
+    output:
+        dictionary with the shuffled data (residuals), the weights giving the
+        effect and model fit of shuffled data, degrees of freedom, shuffle type
+        and observed t statistics
+    """
+    X_effect, Z = partition_design(X, contrast)
+    M = np.column_stack([X_effect, Z])
+    pinv_M = linalg.pinv(M)
+    if Z.shape[1]:
+        residuals = Y - Z @ (linalg.pinv(Z) @ Y)
+    else:
+        residuals = np.array(Y, dtype=np.float64)
+    model = {
+        "residuals": residuals,
+        "sum_squares": np.sum(residuals**2, axis=0),
+        # effect estimate and orthonormal basis of the model space, stacked so
+        # both come out of one product with the shuffled data
+        "weights": np.vstack([pinv_M[0], linalg.orth(M).T]),
+        "variance_factor": pinv_M[0] @ pinv_M[0],
+        "df": M.shape[0] - np.linalg.matrix_rank(M),
+        "sign_flip": bool(np.ptp(X_effect) <= 1e-10 * np.abs(X_effect).max()),
+    }
+    model["t"] = permuted_t(model, make_identity(M.shape[0], model["sign_flip"]))[0]
+    return model
+
+
+def make_identity(n_subjects, sign_flip):
+    if sign_flip:
+        return np.ones((1, n_subjects))
+    return np.arange(n_subjects)[np.newaxis]
+
+
+def make_shuffles(n_subjects, n_perm, sign_flip, rng):
+    """
+    (shuffles x subjects) array of sign flips (+-1) or permutations (indices),
+    the first one is the identity.  All possible shuffles if there are no more
+    than n_perm of them (as randomise).
+    """
+    if sign_flip:
+        if 2**n_subjects <= n_perm:
+            return np.array(list(itertools.product([1.0, -1.0], repeat=n_subjects)))
+        shuffles = rng.choice([1.0, -1.0], size=(n_perm, n_subjects))
+    else:
+        if math.factorial(n_subjects) <= n_perm:
+            return np.array(list(itertools.permutations(range(n_subjects))))
+        shuffles = rng.permuted(np.tile(np.arange(n_subjects), (n_perm, 1)), axis=1)
+    shuffles[0] = make_identity(n_subjects, sign_flip)
+    return shuffles
+
+
+def permuted_t(model, shuffles):
+    """t statistics of a batch of shuffles of the data: (shuffles x voxels)"""
+    residuals = model["residuals"]
+    weights = model["weights"]
+    n_shuffles, n_subjects = shuffles.shape
+    # weights applied to the shuffled data = shuffled weights applied to the data
+    if model["sign_flip"]:
+        shuffled_weights = weights[np.newaxis] * shuffles[:, np.newaxis, :]
+    else:
+        shuffled_weights = np.empty((n_shuffles,) + weights.shape)
+        for idx, permutation in enumerate(shuffles):
+            shuffled_weights[idx][:, permutation] = weights
+    projections = (shuffled_weights.reshape(-1, n_subjects) @ residuals).reshape(
+        n_shuffles, weights.shape[0], -1
+    )
+    # shuffles keep the sum of squares, the residual sum of squares is what
+    # the model space does not explain
+    rss = model["sum_squares"] - np.sum(projections[:, 1:] ** 2, axis=1)
+    variance = np.maximum(rss, 0) / model["df"] * model["variance_factor"]
+    return np.divide(
+        projections[:, 0],
+        np.sqrt(variance),
+        out=np.zeros_like(variance),
+        where=variance > 0,
+    )
+
+
+def get_batch_size(model, n_shuffles, max_memory=2**30):
+    """Number of shuffles whose projections and t statistics fit in max_memory"""
+    n_weights, n_subjects = model["weights"].shape
+    n_voxels = model["residuals"].shape[1]
+    bytes_per_shuffle = 8 * (n_voxels * (n_weights + 4) + n_weights * n_subjects)
+    return int(min(n_shuffles, max(1, max_memory // bytes_per_shuffle)))
+
+
+def _limit_threads(n_threads):
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(n_threads)
+
+
+def _run_batch(model_idx, shuffles):
+    """Maximum statistics over voxels and exceedance counts per voxel of a batch"""
+    model = _models[model_idx]
+    t = permuted_t(model, shuffles)
+    t_obs = model["t"]
+    tolerance = 1e-10 * (1 + np.abs(t_obs))
+    return (
+        t.max(axis=1),
+        np.abs(t).max(axis=1),
+        np.sum(t >= t_obs - tolerance, axis=0),
+        np.sum(np.abs(t) >= np.abs(t_obs) - tolerance, axis=0),
+    )
+
+
+def get_fwe_p(max_null, stat):
+    """Proportion of the maximum statistic null distribution at or above stat"""
+    max_null = np.sort(max_null)
+    tolerance = 1e-10 * (1 + np.abs(stat))
+    exceed = max_null.size - np.searchsorted(max_null, stat - tolerance, side="left")
+    return exceed / max_null.size
+
+
+def run_permutations(models, n_perm=5000, n_jobs=1, seed=0, max_memory=2**30):
+    """
+    Permutation tests of several contrast models (setup_contrast_model): one
+    sided t (effect > 0) and two sided F (t squared, 1 DF) tests, voxelwise and
+    family wise error corrected with the maximum statistic over voxels
+    input:
+        n_perm: number of shuffles, including the identity (fewer if all
+            possible shuffles are fewer)
+        n_jobs: number of worker processes the batches of shuffles are run in
+        seed: seed of the random shuffles of each model (results do not depend
+            on n_jobs)
+        max_memory: memory per batch of shuffles (bytes)
+    output:
+        list of dictionaries, one per model, with the masked maps tstat,
+        vox_p_tstat, vox_corrp_tstat, fstat, vox_p_fstat, vox_corrp_fstat
+        (p values) and n_perm (number of shuffles done)
+    """
+    global _models
+    _models = models
+    batches = []
+    n_shuffles = []
+    for model_idx, model in enumerate(models):
+        # each model draws from its own generator: the contrasts of a model get
+        # the same shuffles (as randomise) and the results of a model do not
+        # depend on the other models run with it
+        shuffles = make_shuffles(
+            model["residuals"].shape[0],
+            n_perm,
+            model["sign_flip"],
+            np.random.default_rng(seed),
+        )
+        n_shuffles.append(len(shuffles))
+        batch_size = get_batch_size(model, len(shuffles), max_memory)
+        for start in range(0, len(shuffles), batch_size):
+            batches.append((model_idx, shuffles[start : start + batch_size]))
+
+    try:
+        if n_jobs == 1:
+            batch_results = [_run_batch(*batch) for batch in batches]
+        else:
+            # fork: the workers see the models without pickling them; the CPUs
+            # are split between workers so BLAS threads don't oversubscribe
+            n_threads = max(1, len(os.sched_getaffinity(0)) // n_jobs)
+            with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_limit_threads,
+                initargs=(n_threads,),
+            ) as pool:
+                batch_results = list(
+                    pool.map(
+                        _run_batch,
+                        [model_idx for model_idx, _ in batches],
+                        [shuffles for _, shuffles in batches],
+                    )
+                )
+    finally:
+        _models = None
+
+    results = []
+    for model_idx, model in enumerate(models):
+        model_results = [
+            result
+            for (batch_model_idx, _), result in zip(batches, batch_results)
+            if batch_model_idx == model_idx
+        ]
+        max_t, max_f = (
+            np.concatenate([result[idx] for result in model_results]) for idx in [0, 1]
+        )
+        count_t, count_f = (
+            np.sum([result[idx] for result in model_results], axis=0) for idx in [2, 3]
+        )
+        t = model["t"]
+        results.append(
+            {
+                "tstat": t,
+                "vox_p_tstat": count_t / n_shuffles[model_idx],
+                "vox_corrp_tstat": get_fwe_p(max_t, t),
+                "fstat": t**2,
+                "vox_p_fstat": count_f / n_shuffles[model_idx],
+                "vox_corrp_fstat": get_fwe_p(max_f, np.abs(t)),
+                "n_perm": n_shuffles[model_idx],
+            }
+        )
+    return results
@@ -0,0 +1,81 @@
+import os
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import seaborn as sns
+from nilearn.plotting import plot_design_matrix
+from utils_lev1.qa_store import load_qa_arrays
+
+# Plotting of the QA figures.  Only imported when figures are rendered (in the
+# background figure worker of analyze_lev1.py or by render_qa_summary.py), so
+# the level 1 jobs themselves never import matplotlib.
+
+
+def plot_design_figures(desmat, contrast_matrix, contrast_names, corr_matrix, figure_files):
+    """
+    Saves the design matrix, contrast matrix and regressor correlation figures
+    to the png files in figure_files (keys design_matrix, contrasts, correlation)
+    """
+    desmat_fig = plot_design_matrix(desmat)
+    desmat_fig.figure.savefig(figure_files['design_matrix'], format='png', dpi=60)
+
+    design_column_names = desmat.columns.tolist()
+    contrast_matrix = np.asmatrix(contrast_matrix)
+    #maxval = np.max(np.abs(contrast_def))
+    maxval = 1
+    max_len = np.max([len(str(name)) for name in design_column_names])
+
+    plt.figure(figsize=(.4 * len(design_column_names),
+                            1 + .5 * contrast_matrix.shape[0] + .1 * max_len))
+    contrast_fig = plt.gca()
+    mat = contrast_fig.matshow(contrast_matrix, aspect='equal',
+                     cmap='gray', vmin=-maxval, vmax=maxval)
+    contrast_fig.set_label('conditions')
+    contrast_fig.set_ylabel('')
+    contrast_fig.set_yticks(list(range(len(contrast_names))), contrast_names)
+    contrast_fig.xaxis.set(ticks=np.arange(len(design_column_names)))
+    contrast_fig.set_xticklabels(design_column_names, rotation=50, ha='left')
+    plt.colorbar(mat, fraction=0.025, pad=0.08, shrink=.5)
+    plt.tight_layout()
+    contrast_fig.figure.savefig(figure_files['contrasts'], format='png', dpi=75)
+
+    f,  heatmap= plt.subplots(figsize=(20,20))
+    heatmap = sns.heatmap(corr_matrix,
+                      square = True,
+                      vmin=-1, vmax=1, center=0,
+                      cmap="coolwarm")
+    heatmap.set_xticklabels(
+        heatmap.get_xticklabels(),
+        rotation=45,
+        horizontalalignment='right'
+    )
+    heatmap.figure.savefig(figure_files['correlation'], format='png', dpi=60)
+    plt.close('all')
+
+
+def render_qa_figures(contrast_dir, record, overwrite=False):
+    """
+    Renders the QA figures of one session from its stored QA arrays.  Figures
+    that are newer than the arrays are kept unless overwrite is set.
+    input:
+        contrast_dir: output contrast directory
+        record: QA record of the session (see qa.make_qa_record)
+    output:
+        True if the figures were (re)rendered
+    """
+    arrays_file = f"{contrast_dir}/{record['qa_arrays']}"
+    figure_files = {figure: f'{contrast_dir}/{figure_file}'
+                    for figure, figure_file in record['figures'].items()}
+    arrays_mtime = os.path.getmtime(arrays_file)
+    up_to_date = all(os.path.exists(figure_file) and
+                     os.path.getmtime(figure_file) >= arrays_mtime
+                     for figure_file in figure_files.values())
+    if up_to_date and not overwrite:
+        return False
+    for figure_file in figure_files.values():
+        os.makedirs(os.path.dirname(figure_file), exist_ok=True)
+    arrays = load_qa_arrays(arrays_file)
+    plot_design_figures(arrays['design_matrix'], arrays['contrast_matrix'],
+                        arrays['contrast_names'], arrays['correlation'], figure_files)
+    return True
@@ -0,0 +1,96 @@
+import base64
+import os
+
+from utils_lev1.qa_store import frame_from_dict, load_qa_records, write_text_atomic
+
+# regressors left out of the VIF table of the report
+vif_table_exclude_regex = r'(?:reject|trans|rot|comp_cor|non_steady)'
+
+
+def get_html_summary_file(contrast_dir, task, regress_rt, duration_choice):
+    return (f'{contrast_dir}/contrasts_task_{task}_rtmodel_{regress_rt}_'
+            f'duration_{duration_choice}_model_summary.html')
+
+
+def render_missing_figures(contrast_dir, records, overwrite=False):
+    """
+    Renders the QA figures of the sessions in records that are missing or out of
+    date.  matplotlib is only imported here, when figures are actually drawn, so
+    it can run in a background worker (analyze_lev1.py) or on demand
+    (render_qa_summary.py).
+    """
+    from utils_lev1.qa_figures import render_qa_figures
+
+    for record in records:
+        render_qa_figures(contrast_dir, record, overwrite=overwrite)
+
+
+def html_image(contrast_dir, figure_file, embed_images=False):
+    """
+    img tag for a QA figure (path relative to contrast_dir).  Figures are linked
+    by default, embed_images inlines them (base64) for a self contained report.
+    """
+    if not os.path.exists(f'{contrast_dir}/{figure_file}'):
+        return f'<p>{figure_file} not rendered yet, run render_qa_summary.py</p>'
+    if not embed_images:
+        return f'<img src=\'{figure_file}\'>'
+    with open(f'{contrast_dir}/{figure_file}', 'rb') as f:
+        encoded = base64.b64encode(f.read()).decode('utf-8')
+    return '<img src=\'data:image/png;base64,{}\'>'.format(encoded)
+
+
+def render_html_summary_entry(record, contrast_dir, embed_images=False):
+    """
+    Html summary of one session from its QA record (see qa.make_qa_record)
+    """
+    subid, task, session = record['subid'], record['task'], record['ses']
+    desmat_img = html_image(contrast_dir, record['figures']['design_matrix'], embed_images)
+    if not record['any_fail']:
+        html_desmat = f'<h2>{task} design for subject {subid} {session}</h2>' + desmat_img + '<br>'
+    else:
+        exclusion = frame_from_dict(record['exclusion'])
+        html_desmat = f'<h2>Check details <br> {exclusion.T.to_html()} <br> {task} design for subject {subid} {session}</h2>' + desmat_img + '<br>'
+    html_contrast = (f'<h2>{task} contrasts for subject {subid} {session} </h2>' +
+                     html_image(contrast_dir, record['figures']['contrasts'], embed_images) + '<br>')
+
+    vif_data = frame_from_dict(record['regressor_vif'])
+    vif_data_table = vif_data[~vif_data.regressor.str.contains(vif_table_exclude_regex)]
+    vif_contrasts = frame_from_dict(record['contrast_vif'])
+    inestimable_contrasts = record.get('inestimable_contrasts', [])
+    html_inestimable = (f'<h3>Inestimable contrasts: {", ".join(inestimable_contrasts)}</h3>'
+                        if inestimable_contrasts else '')
+    html_cormat = html_image(contrast_dir, record['figures']['correlation'], embed_images) + '<br>'
+    return ''.join([
+        '<hr>',
+        f'<h2>Subject {subid} {session}</h2><br>',
+        f'<h3>Percent Junk: {record["percent_junk"]}</h3>',
+        html_desmat,
+        html_contrast,
+        f'<h2>Variance inflation factors subject {subid} {session}</h2><br>',
+        vif_data_table.to_html(index=False),
+        vif_contrasts.to_html(index=False),
+        html_inestimable,
+        html_cormat,
+    ])
+
+
+def render_html_summary(contrast_dir, task, regress_rt, duration_choice, embed_images=False,
+                        render_figures=False):
+    """
+    (Re)writes the model summary html of a task/model from the QA records of all
+    sessions in contrast_dir, one entry per session, ordered by subject and session.
+    With render_figures, missing or out of date figures are rendered first,
+    otherwise figures that were not rendered yet are left out of the html.
+    output:
+        html_file: the summary file written (None if there are no QA records)
+    """
+    records = [record for record in load_qa_records(contrast_dir, duration_choice)
+               if record['task'] == task and record['regress_rt'] == regress_rt]
+    if not records:
+        return None
+    if render_figures:
+        render_missing_figures(contrast_dir, records)
+    html_file = get_html_summary_file(contrast_dir, task, regress_rt, duration_choice)
+    write_text_atomic(html_file, ''.join(
+        render_html_summary_entry(record, contrast_dir, embed_images) for record in records))
+    return html_file
@@ -0,0 +1,202 @@
+import glob
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Per session QA records and exclusions are stored as one small json file per
+# session, each written atomically, so concurrent jobs never interleave or lose
+# each other's output.  The html report and excluded_subject.csv are rendered
+# from these files.
+
+
+def write_text_atomic(filename, text, exclusive=False):
+    """
+    input:
+        exclusive: only write the file if it does not exist yet (the first of
+            concurrent writers wins)
+    """
+    out_dir = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        # mkstemp creates the file user only, give it the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_file, 0o666 & ~umask)
+        if exclusive:
+            try:
+                os.link(tmp_file, filename)
+            except FileExistsError:
+                pass
+            os.remove(tmp_file)
+        else:
+            os.replace(tmp_file, filename)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def get_qa_record_file(contrast_dir, subid, ses, duration_choice):
+    return f'{contrast_dir}/qa_records/sub-{subid}_{ses}_duration-{duration_choice}_qa.json'
+
+
+def get_exclusion_file(contrast_dir, subid, task, ses):
+    return f'{contrast_dir}/exclusions/sub-{subid}_task-{task}_{ses}_exclusion.json'
+
+
+def get_qa_arrays_file(contrast_dir, subid, ses, duration_choice):
+    return f'{contrast_dir}/qa_arrays/sub-{subid}_{ses}_duration-{duration_choice}_qa.npz'
+
+
+def save_qa_arrays(arrays_file, desmat, contrast_matrix, contrast_names):
+    """
+    Stores the numeric artifacts the QA figures are drawn from (design matrix,
+    contrast matrix and regressor correlation matrix) in an uncompressed .npz
+    file, written atomically, so the figures can be rendered later and off the
+    critical path (see qa_figures.render_qa_figures)
+    """
+    out_dir = os.path.dirname(os.path.abspath(arrays_file))
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f,
+                     design_matrix=desmat.to_numpy(dtype=float),
+                     design_columns=np.array(desmat.columns, dtype=str),
+                     contrast_matrix=np.asarray(contrast_matrix, dtype=float),
+                     contrast_names=np.array(contrast_names, dtype=str),
+                     correlation=desmat.corr().to_numpy())
+        os.replace(tmp_file, arrays_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def load_qa_arrays(arrays_file):
+    """
+    output:
+        dictionary with the design matrix and correlation matrix (data frames),
+        the contrast matrix and the contrast names
+    """
+    with np.load(arrays_file, allow_pickle=False) as arrays:
+        design_columns = arrays['design_columns'].tolist()
+        return {
+            'design_matrix': pd.DataFrame(arrays['design_matrix'], columns=design_columns),
+            'contrast_matrix': arrays['contrast_matrix'],
+            'contrast_names': arrays['contrast_names'].tolist(),
+            'correlation': pd.DataFrame(arrays['correlation'], index=design_columns,
+                                        columns=design_columns),
+        }
+
+
+def save_qa_record(contrast_dir, record):
+    """
+    Writes the QA record of one session (see qa.make_qa_record), replacing the
+    record of a previous run of the same session
+    """
+    record_file = get_qa_record_file(
+        contrast_dir, record['subid'], record['ses'], record['duration_choice'])
+    write_text_atomic(record_file, json.dumps(record, indent=1))
+
+
+def load_qa_records(contrast_dir, duration_choice=None):
+    """
+    QA records of all sessions in contrast_dir, sorted by subject and session
+    """
+    pattern = f'duration-{duration_choice}' if duration_choice is not None else 'duration-*'
+    records = []
+    for record_file in glob.glob(f'{contrast_dir}/qa_records/sub-*_{pattern}_qa.json'):
+        with open(record_file) as f:
+            records.append(json.load(f))
+    return sorted(records, key=lambda record: (record['subid'], record['ses']))
+
+
+def frame_to_dict(df):
+    """json friendly version of a (small) data frame, e.g. an exclusion or VIF table"""
+    return json.loads(df.to_json(orient='split', index=False))
+
+
+def frame_from_dict(frame_dict):
+    return pd.DataFrame(frame_dict['data'], columns=frame_dict['columns'])
+
+
+def get_legacy_exclusion_file(contrast_dir):
+    return f'{contrast_dir}/exclusions/legacy_exclusion.json'
+
+
+def save_exclusion_record(contrast_dir, subid, task, ses, exclusion):
+    """
+    Records a QA failure of one session.  Like the rows of excluded_subject.csv,
+    exclusion records are kept until they are removed by hand.
+    """
+    import_legacy_exclusions(contrast_dir)
+    write_text_atomic(get_exclusion_file(contrast_dir, subid, task, ses),
+                      json.dumps(frame_to_dict(exclusion)))
+
+
+def import_legacy_exclusions(contrast_dir):
+    """
+    Keeps the rows of an excluded_subject.csv written before exclusion records
+    existed: the first time exclusions are stored in contrast_dir, the csv is
+    stored as an exclusion record of its own (legacy_exclusion.json, empty if
+    there is no csv).  The file also marks the directory as migrated, so a csv
+    rendered from the records is never imported.
+    """
+    csv_file = f'{contrast_dir}/excluded_subject.csv'
+    legacy_file = get_legacy_exclusion_file(contrast_dir)
+    if os.path.exists(legacy_file):
+        return
+    # every record is written after this import, so records without the
+    # marker (e.g. a hand made directory) mean the csv was rendered from them
+    has_records = bool(glob.glob(f'{contrast_dir}/exclusions/sub-*_exclusion.json'))
+    if os.path.exists(csv_file) and not has_records:
+        legacy_exclusion = pd.read_csv(csv_file)
+    else:
+        legacy_exclusion = pd.DataFrame()
+    write_text_atomic(legacy_file, json.dumps(frame_to_dict(legacy_exclusion)), exclusive=True)
+
+
+def load_exclusions(contrast_dir):
+    """
+    All exclusion records in contrast_dir as one data frame, in the format of
+    excluded_subject.csv (missing failure columns are 0).  Legacy rows of
+    sessions that have a record of their own are replaced by the record.
+    """
+    exclusions = []
+    for exclusion_file in sorted(glob.glob(f'{contrast_dir}/exclusions/sub-*_exclusion.json')):
+        with open(exclusion_file) as f:
+            exclusions.append(frame_from_dict(json.load(f)))
+    legacy_file = get_legacy_exclusion_file(contrast_dir)
+    if os.path.exists(legacy_file):
+        with open(legacy_file) as f:
+            legacy_exclusion = frame_from_dict(json.load(f))
+        if not legacy_exclusion.empty and 'subid_task' in legacy_exclusion:
+            recorded = set().union(*[exclusion['subid_task'] for exclusion in exclusions])
+            legacy_exclusion = legacy_exclusion[~legacy_exclusion['subid_task'].isin(recorded)]
+        if not legacy_exclusion.empty:
+            exclusions.insert(0, legacy_exclusion)
+    if not exclusions:
+        return pd.DataFrame()
+    return pd.concat(exclusions, axis=0).fillna(0).drop_duplicates()
+
+
+def write_excluded_subject_csv(contrast_dir):
+    """
+    (Re)writes excluded_subject.csv from the exclusion records, atomically
+    (removes it if there are none left)
+    """
+    import_legacy_exclusions(contrast_dir)
+    exclusions = load_exclusions(contrast_dir)
+    csv_file = f'{contrast_dir}/excluded_subject.csv'
+    if exclusions.empty:
+        if os.path.exists(csv_file):
+            os.remove(csv_file)
+        return
+    write_text_atomic(csv_file, exclusions.to_csv(index=False))
@@ -0,0 +1,93 @@
+import glob
+import os
+import subprocess
+from file_index import file_signature, signature_matches, load_json_index, write_json_atomic
+from utils_lev1.design_cache import hash_file
+
+# Provenance of the level 1 / level 2 outputs: the content hash of every input
+# file, the code version and (level 1) the design parameters.  A file is
+# compared by size/mtime first and only hashed when those differ, so checking a
+# manifest is cheap while touched but unchanged files do not trigger a rerun.
+
+# bump when the model fit or the written outputs change in a way that is not
+# captured by the design (e.g. noise model, smoothing, fixed effects): all
+# level 1 outputs recorded with an older version are recomputed
+lev1_code_version = 1
+
+code_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_code_commit():
+    """git commit of the analysis code (None if it is not a git checkout)"""
+    try:
+        return subprocess.run(['git', '-C', code_dir, 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_code_version():
+    """
+    Code version recorded in the manifests.  Only lev1_code_version decides
+    whether outputs are out of date, the git commit is kept for provenance.
+    """
+    return {'lev1': lev1_code_version, 'git_commit': get_code_commit()}
+
+
+def file_record(path):
+    """size, mtime and sha256 of a file"""
+    record = file_signature(path)
+    record['sha256'] = hash_file(path)
+    return record
+
+
+def file_unchanged(record, path):
+    """
+    True if path still has the content recorded in record (see file_record).
+    Only hashed if its size/mtime changed.
+    """
+    if record is None or not os.path.exists(path):
+        return False
+    signature = file_signature(path)
+    if signature_matches(record, signature):
+        return True
+    return signature['size'] == record.get('size') and hash_file(path) == record.get('sha256')
+
+
+def files_unchanged(records, input_files):
+    """True if input_files are exactly the recorded files, with unchanged content"""
+    if sorted(records) != sorted(input_files):
+        return False
+    return all(file_unchanged(records[input_file], input_file) for input_file in input_files)
+
+
+def get_lev2_manifest_file(outdir):
+    return f'{outdir}/lev2_manifest.json'
+
+
+def write_lev2_manifest(outdir, lev1_task_contrast, model_lev2, lev1_files):
+    """
+    Records a completed analyze_lev2.py call: its arguments, the level 1 maps it
+    was run on (content hashes) and the code version
+    """
+    write_json_atomic(get_lev2_manifest_file(outdir), {
+        'lev1_task_contrast': lev1_task_contrast,
+        'model_lev2': model_lev2,
+        'code_version': get_code_version(),
+        'inputs': {lev1_file: file_record(lev1_file) for lev1_file in lev1_files},
+    })
+
+
+def find_lev2_manifests(lev2_output_root):
+    """All level 2 manifests below lev2_output_root, keyed by output directory"""
+    manifest_files = sorted(glob.glob(f'{lev2_output_root}/*_lev2_output/*/lev2_manifest.json'))
+    return {os.path.dirname(manifest_file): load_json_index(manifest_file)
+            for manifest_file in manifest_files}
+
+
+def is_lev2_current(manifest, lev1_files):
+    """
+    True if the level 2 model was run on exactly lev1_files (the level 1 maps
+    found now) and none of them changed since
+    """
+    return bool(manifest) and files_unchanged(manifest['inputs'], lev1_files)
@@ -0,0 +1,626 @@
+"""
+Declarative first level design specifications, one entry per task.  Compiled
+into design matrices by first_level_designs.make_task_desmat.
+
+regressors: task and nuisance regressors, keyed by regressor name
+    amplitude: events column used as amplitude (default constant_1_column)
+    duration: events column used as duration (default constant_column, which is
+        1s or the mean RT of the rt_subset trials, depending on duration_choice)
+    subset: trials included, all conditions must hold
+        correct: key_press == correct_response
+        min_rt: response_time >= 0.2
+        trial_type: trial type (or list of trial types)
+        not_trial_type: trial type to leave out
+        responded: key_press != -1
+        trial_class: trial class (or list of classes), see
+            first_level_designs.trial_classes
+        any other key: events column that must equal the value
+design: order of the regressors in the design matrix, "confounds" marks where
+    the fmriprep confound regressors go.  The RT regressor (if any) is last.
+response_subset: trials that call for a response, the only ones classified as
+    omission, commission or rt_fast (see first_level_designs.define_nuisance_trials)
+rt_subset: trials used for the RT regressor and mean RT duration
+contrasts: contrasts in nilearn friendly format
+"""
+
+task_design_specs = {
+    "cuedTS": {
+        "regressors": {
+            "task_stay_cue_switch": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "tstay_cswitch", "junk": 0},
+            },
+            "task_stay_cue_stay": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "tstay_cstay", "junk": 0},
+            },
+            "task_switch_cue_switch": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "tswitch_cswitch", "junk": 0},
+            },
+            "omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "na", "junk": 0},
+            },
+            "commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "na", "junk": 0},
+            },
+            "rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "na", "junk": 0},
+            },
+            "na_trials": {
+                "amplitude": "na_trials",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+            "junk": {
+                "amplitude": "junk",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "na"},
+            },
+        },
+        "design": [
+            "task_stay_cue_switch",
+            "task_stay_cue_stay",
+            "task_switch_cue_switch",
+            "omission",
+            "commission",
+            "rt_fast",
+            "na_trials",
+            "confounds",
+            "junk",
+        ],
+        "response_subset": {},
+        "rt_subset": {"correct": True, "min_rt": True, "na_trials": 0, "junk": 0},
+        "contrasts": {
+            "task_switch_cost": "task_switch_cue_switch-task_stay_cue_switch",
+            "cue_switch_cost": "task_stay_cue_switch-task_stay_cue_stay",
+            "task-baseline": "1/3*(task_stay_cue_switch+task_stay_cue_stay+task_switch_cue_switch)",
+        },
+    },
+    "directedForgetting": {
+        "regressors": {
+            "con": {"subset": {"correct": True, "min_rt": True, "trial_type": "con"}},
+            "pos": {"subset": {"correct": True, "min_rt": True, "trial_type": "pos"}},
+            "neg": {"subset": {"correct": True, "min_rt": True, "trial_type": "neg"}},
+            "omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "memory_cue"},
+            },
+            "commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "memory_cue"},
+            },
+            "rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "memory_cue"},
+            },
+            "memory_and_cue": {
+                "duration": "duration",
+                "subset": {"trial_type": "memory_cue"},
+            },
+        },
+        "design": [
+            "con",
+            "pos",
+            "neg",
+            "omission",
+            "commission",
+            "rt_fast",
+            "confounds",
+            "memory_and_cue",
+        ],
+        "response_subset": {"not_trial_type": "memory_cue"},
+        "rt_subset": {"correct": True, "min_rt": True},
+        "contrasts": {
+            "neg-con": "neg-con",
+            "task-baseline": "1/4*(con+pos+neg+memory_and_cue)",
+        },
+    },
+    "flanker": {
+        "regressors": {
+            "congruent": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "congruent"},
+            },
+            "incongruent": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "incongruent"},
+            },
+            "omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+            "commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+            "rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+        },
+        "design": [
+            "congruent",
+            "incongruent",
+            "omission",
+            "commission",
+            "rt_fast",
+            "confounds",
+        ],
+        "response_subset": {},
+        "rt_subset": {"correct": True, "min_rt": True},
+        "contrasts": {
+            "incongruent - congruent": "incongruent - congruent",
+            "task-baseline": ".5*congruent + .5*incongruent",
+        },
+    },
+    "goNogo": {
+        "regressors": {
+            "go": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "go", "junk": 0},
+            },
+            "nogo_success": {"subset": {"trial_type": "nogo_success", "junk": 0}},
+            "nogo_failure": {
+                "duration": "constant_1_column",
+                "subset": {"trial_type": "nogo_failure", "junk": 0},
+            },
+            "go_omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {"junk": 0},
+            },
+            "go_commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {"junk": 0},
+            },
+            "go_rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {"junk": 0},
+            },
+            "junk": {
+                "amplitude": "junk",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+        },
+        "design": [
+            "go",
+            "nogo_success",
+            "nogo_failure",
+            "go_omission",
+            "go_commission",
+            "go_rt_fast",
+            "confounds",
+            "junk",
+        ],
+        "response_subset": {"trial_type": "go"},
+        "rt_subset": {"correct": True, "trial_type": "go", "junk": 0},
+        "contrasts": {
+            "go": "go",
+            "nogo_success": "nogo_success",
+            "nogo_success-go": "nogo_success-go",
+            "task-baseline": ".5*go + .5*nogo_success",
+        },
+    },
+    "nBack": {
+        "regressors": {
+            "mismatch_1back": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "mismatch", "delay": 1},
+            },
+            "match_1back": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "match", "delay": 1},
+            },
+            "mismatch_2back": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "mismatch", "delay": 2},
+            },
+            "match_2back": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "match", "delay": 2},
+            },
+            "omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {"na_trials": 0},
+            },
+            "commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {"na_trials": 0},
+            },
+            "rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {"na_trials": 0},
+            },
+            "na_trials": {
+                "amplitude": "na_trials",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+        },
+        "design": [
+            "mismatch_1back",
+            "match_1back",
+            "mismatch_2back",
+            "match_2back",
+            "omission",
+            "commission",
+            "rt_fast",
+            "na_trials",
+            "confounds",
+        ],
+        "response_subset": {},
+        "rt_subset": {"correct": True, "na_trials": 0},
+        "contrasts": {
+            "twoBack-oneBack": "mismatch_2back + match_2back - mismatch_1back - match_1back",
+            "match - mismatch": "match_2back + match_1back - mismatch_2back - mismatch_1back",
+            "task-baseline": "1/4*(mismatch_1back + match_1back + mismatch_2back + match_2back)",
+        },
+    },
+    "stopSignal": {
+        "regressors": {
+            "go": {"subset": {"correct": True, "min_rt": True, "trial_type": "go"}},
+            "stop_success": {"subset": {"trial_type": "stop_success"}},
+            "stop_failure": {"subset": {"trial_type": "stop_failure"}},
+            "go_omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+            "go_commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+            "go_rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+        },
+        "design": [
+            "go",
+            "stop_success",
+            "stop_failure",
+            "go_omission",
+            "go_commission",
+            "go_rt_fast",
+            "confounds",
+        ],
+        "response_subset": {"trial_type": "go"},
+        "rt_subset": {"correct": True, "trial_type": "go", "min_rt": True},
+        "contrasts": {
+            "go": "go",
+            "stop_success": "stop_success",
+            "stop_failure": "stop_failure",
+            "stop_success-go": "stop_success-go",
+            "stop_failure-go": "stop_failure-go",
+            "stop_success-stop_failure": "stop_success-stop_failure",
+            "stop_failure-stop_success": "stop_failure-stop_success",
+            "task-baseline": "1/3*go + 1/3*stop_failure + 1/3*stop_success",
+        },
+    },
+    "shapeMatching": {
+        "regressors": {
+            "SSS": {"subset": {"correct": True, "min_rt": True, "trial_type": "SSS"}},
+            "SDD": {"subset": {"correct": True, "min_rt": True, "trial_type": "SDD"}},
+            "SNN": {"subset": {"correct": True, "min_rt": True, "trial_type": "SNN"}},
+            "DSD": {"subset": {"correct": True, "min_rt": True, "trial_type": "DSD"}},
+            "DDD": {"subset": {"correct": True, "min_rt": True, "trial_type": "DDD"}},
+            "DDS": {"subset": {"correct": True, "min_rt": True, "trial_type": "DDS"}},
+            "DNN": {"subset": {"correct": True, "min_rt": True, "trial_type": "DNN"}},
+            "omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+            "commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+            "rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+        },
+        "design": [
+            "SSS",
+            "SDD",
+            "SNN",
+            "DSD",
+            "DDD",
+            "DDS",
+            "DNN",
+            "omission",
+            "commission",
+            "rt_fast",
+            "confounds",
+        ],
+        "response_subset": {},
+        "rt_subset": {"correct": True, "min_rt": True},
+        "contrasts": {
+            "task-baseline": "1/7*(SSS+SDD+SNN+DSD+DDD+DDS+DNN)",
+            "main_vars": "1/3*(SDD+DDD+DDS)-1/2*(SNN+DNN)",
+            "SSS": "SSS",
+            "SDD": "SDD",
+            "SNN": "SNN",
+            "DSD": "DSD",
+            "DDD": "DDD",
+            "DDS": "DDS",
+            "DNN": "DNN",
+        },
+    },
+    "spatialTS": {
+        "regressors": {
+            "task_stay_cue_switch": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "tstay_cswitch"},
+            },
+            "task_stay_cue_stay": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "tstay_cstay"},
+            },
+            "task_switch_cue_switch": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "tswitch_cswitch"},
+            },
+            "omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "na"},
+            },
+            "commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "na"},
+            },
+            "rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "na"},
+            },
+            "na_trials": {
+                "duration": "constant_1_column",
+                "subset": {"trial_type": "na"},
+            },
+        },
+        "design": [
+            "task_stay_cue_switch",
+            "task_stay_cue_stay",
+            "task_switch_cue_switch",
+            "omission",
+            "commission",
+            "rt_fast",
+            "na_trials",
+            "confounds",
+        ],
+        "response_subset": {},
+        "rt_subset": {"correct": True, "min_rt": True, "not_trial_type": "na"},
+        "contrasts": {
+            "task_switch_cost": "task_switch_cue_switch-task_stay_cue_switch",
+            "cue_switch_cost": "task_stay_cue_switch-task_stay_cue_stay",
+            "task-baseline": "1/3*(task_stay_cue_switch+task_stay_cue_stay+task_switch_cue_switch)",
+        },
+    },
+    "directedForgettingWFlanker": {
+        "regressors": {
+            "incongruent_con": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "incongruent_con"},
+            },
+            "incongruent_pos": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "incongruent_pos"},
+            },
+            "incongruent_neg": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "incongruent_neg"},
+            },
+            "congruent_con": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "congruent_con"},
+            },
+            "congruent_pos": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "congruent_pos"},
+            },
+            "congruent_neg": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "congruent_neg"},
+            },
+            "omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "memory_cue"},
+            },
+            "commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "memory_cue"},
+            },
+            "rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "memory_cue"},
+            },
+            "memory_and_cue": {
+                "duration": "duration",
+                "subset": {"trial_type": "memory_cue"},
+            },
+        },
+        "design": [
+            "incongruent_con",
+            "incongruent_pos",
+            "incongruent_neg",
+            "congruent_con",
+            "congruent_pos",
+            "congruent_neg",
+            "omission",
+            "commission",
+            "rt_fast",
+            "confounds",
+            "memory_and_cue",
+        ],
+        "response_subset": {"not_trial_type": "memory_cue"},
+        "rt_subset": {"correct": True, "min_rt": True},
+        "contrasts": {
+            "congruent_neg-congruent_con": "congruent_neg-congruent_con",
+            "incongruent_con-congruent_con": "incongruent_con-congruent_con",
+            "(incongruent_neg-incongruent_con)-(congruent_neg-congruent_con)": "(incongruent_neg+congruent_con) -(incongruent_con+congruent_neg)",
+            "congruent_pos": "congruent_pos",
+            "congruent_neg": "congruent_neg",
+            "congruent_con": "congruent_con",
+            "incongruent_pos": "incongruent_pos",
+            "incongruent_neg": "incongruent_neg",
+            "incongruent_con": "incongruent_con",
+            "task-baseline": "1/7*(congruent_pos+congruent_neg+congruent_con+incongruent_pos+incongruent_neg+incongruent_con+memory_and_cue)",
+        },
+    },
+    "stopSignalWDirectedForgetting": {
+        "regressors": {
+            "go_pos": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "go_pos"},
+            },
+            "go_neg": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "go_neg"},
+            },
+            "go_con": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "go_con"},
+            },
+            "stop_success_pos": {"subset": {"trial_type": "stop_success_pos"}},
+            "stop_success_neg": {"subset": {"trial_type": "stop_success_neg"}},
+            "stop_success_con": {"subset": {"trial_type": "stop_success_con"}},
+            "stop_failure_pos": {"subset": {"trial_type": "stop_failure_pos"}},
+            "stop_failure_neg": {"subset": {"trial_type": "stop_failure_neg"}},
+            "stop_failure_con": {"subset": {"trial_type": "stop_failure_con"}},
+            "go_omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "memory_cue"},
+            },
+            "go_commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "memory_cue"},
+            },
+            "go_rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {"not_trial_type": "memory_cue"},
+            },
+            "memory_and_cue": {
+                "duration": "duration",
+                "subset": {"trial_type": "memory_cue"},
+            },
+        },
+        "design": [
+            "go_pos",
+            "go_neg",
+            "go_con",
+            "stop_success_pos",
+            "stop_success_neg",
+            "stop_success_con",
+            "stop_failure_pos",
+            "stop_failure_neg",
+            "stop_failure_con",
+            "go_omission",
+            "go_commission",
+            "go_rt_fast",
+            "confounds",
+            "memory_and_cue",
+        ],
+        "response_subset": {"trial_type": ["go_pos", "go_neg", "go_con"]},
+        "rt_subset": {
+            "correct": True,
+            "trial_type": ["go_pos", "go_neg", "go_con"],
+            "min_rt": True,
+        },
+        "contrasts": {
+            "(stop_success_con+stop_success_pos+stop_success_neg)-(go_con+go_pos_+go_neg)": "(stop_success_con+stop_success_pos+stop_success_neg) - (go_con+go_pos+go_neg)",
+            "(stop_failure_con+stop_failure_pos+stop_failure_neg)-(go_con+go_pos_+go_neg)": "(stop_failure_con+stop_failure_pos+stop_failure_neg) - (go_con+go_pos+go_neg)",
+            "(stop_success_neg-go_neg)-(stop_success_con-go_con)": "(stop_success_neg-go_neg)-(stop_success_con-go_con)",
+            "(stop_failure_neg-go_neg)-(stop_failure_con-go_con)": "(stop_failure_neg-go_neg)-(stop_failure_con-go_con)",
+            "go_neg-go_con": "go_neg-go_con",
+            "go_pos": "go_pos",
+            "go_neg": "go_neg",
+            "go_con": "go_con",
+            "stop_success_pos": "stop_success_pos",
+            "stop_success_neg": "stop_success_neg",
+            "stop_success_con": "stop_success_con",
+            "stop_failure_pos": "stop_failure_pos",
+            "stop_failure_neg": "stop_failure_neg",
+            "stop_failure_con": "stop_failure_con",
+            "task-baseline": "1/10*(go_pos+go_neg+go_con+stop_success_pos+stop_success_neg+stop_success_con+stop_failure_pos+stop_failure_neg+stop_failure_con+memory_and_cue)",
+        },
+    },
+    "stopSignalWFlanker": {
+        "regressors": {
+            "go_incongruent": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "go_incongruent"},
+            },
+            "go_congruent": {
+                "subset": {"correct": True, "min_rt": True, "trial_type": "go_congruent"},
+            },
+            "stop_success_incongruent": {
+                "subset": {"trial_type": "stop_success_incongruent"},
+            },
+            "stop_success_congruent": {
+                "subset": {"trial_type": "stop_success_congruent"},
+            },
+            "stop_failure_incongruent": {
+                "subset": {"trial_type": "stop_failure_incongruent"},
+            },
+            "stop_failure_congruent": {
+                "subset": {"trial_type": "stop_failure_congruent"},
+            },
+            "go_omission": {
+                "amplitude": "omission",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+            "go_commission": {
+                "amplitude": "commission",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+            "go_rt_fast": {
+                "amplitude": "rt_fast",
+                "duration": "constant_1_column",
+                "subset": {},
+            },
+        },
+        "design": [
+            "go_incongruent",
+            "go_congruent",
+            "stop_success_incongruent",
+            "stop_success_congruent",
+            "stop_failure_incongruent",
+            "stop_failure_congruent",
+            "go_omission",
+            "go_commission",
+            "go_rt_fast",
+            "confounds",
+        ],
+        "response_subset": {"trial_type": ["go_incongruent", "go_congruent"]},
+        "rt_subset": {
+            "correct": True,
+            "trial_type": ["go_congruent", "go_incongruent"],
+            "min_rt": True,
+        },
+        "contrasts": {
+            "(stop_success_congruent+stop_success_incongruent)-(go_congruent+go_incongruent)": "(stop_success_congruent+stop_success_incongruent)-(go_congruent+go_incongruent)",
+            "(stop_failure_congruent+stop_failure_incongruent)-(go_congruent+go_incongruent)": "(stop_failure_congruent+stop_failure_incongruent)-(go_congruent+go_incongruent)",
+            "(stop_success_incongruent-go_incongruent)-(stop_success_congruent-go_congruent)": "(stop_success_incongruent-go_incongruent)-(stop_success_congruent-go_congruent)",
+            "(stop_failure_incongruent-go_incongruent)-(stop_failure_congruent-go_congruent)": "(stop_failure_incongruent-go_incongruent)-(stop_failure_congruent-go_congruent)",
+            "go_incongruent-go_congruent": "go_incongruent-go_congruent",
+            "go_congruent": "go_congruent",
+            "go_incongruent": "go_incongruent",
+            "stop_success_congruent": "stop_success_congruent",
+            "stop_success_incongruent": "stop_success_incongruent",
+            "stop_failure_congruent": "stop_failure_incongruent",
+            "stop_failure_incongruent": "stop_failure_incongruent",
+            "task-baseline": "1/6*(go_congruent+go_incongruent+stop_success_congruent+stop_success_incongruent+stop_failure_congruent+stop_failure_incongruent)",
+        },
+    },
+}
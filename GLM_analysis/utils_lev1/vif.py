@@ -0,0 +1,223 @@
+import numpy as np
+
+
+def _pinv_diag(gram, rcond=1e-12):
+    """
+    Diagonal of the pseudo-inverse of a symmetric positive semi-definite matrix
+    (one eigendecomposition) and a flag per column that is set when the column
+    is (numerically) a linear combination of the others
+    """
+    eigvals, eigvecs = np.linalg.eigh(gram)
+    keep = eigvals > rcond * max(eigvals.max(), 0)
+    inv_diag = np.sum(eigvecs[:, keep] ** 2 / eigvals[keep], axis=1)
+    collinear = np.sum(eigvecs[:, ~keep] ** 2, axis=1) > 1e-8
+    return inv_diag, collinear
+
+
+def get_vifs(design):
+    """
+    Variance inflation factors of all columns of a design, from a single
+    decomposition instead of one regression per column.  For a column x_i the VIF
+    is tss_i / ssr_i, where ssr_i = 1 / [(X'X)^-1]_ii is the residual sum of
+    squares of x_i regressed on the other columns; with a constant among the
+    other columns (the usual case) this is the diagonal of the inverse
+    correlation matrix.  As statsmodels' variance_inflation_factor (called per
+    column), tss_i is centered if the other columns span a constant and
+    uncentered otherwise.  All zero columns get nan and columns that are linear
+    combinations of the others inf.
+    input:
+        design: (time points x regressors) array or data frame
+    output:
+        vifs: array with the VIF of each column
+    """
+    X = np.asarray(design, dtype=float)
+    n_rows, n_cols = X.shape
+    vifs = np.full(n_cols, np.nan)
+    nonzero = np.any(X != 0, axis=0)
+    X = X[:, nonzero]
+    # columns are scaled to unit norm so the decomposition is well conditioned
+    norms = np.linalg.norm(X, axis=0)
+    Z = X / norms
+    inv_diag, collinear = _pinv_diag(Z.T @ Z)
+    ssr = 1 / inv_diag
+
+    # a constant is in the span of the other columns if it is in the span of the
+    # design and does not need column i
+    ones = np.ones(n_rows)
+    coef, *_ = np.linalg.lstsq(Z, ones, rcond=None)
+    design_has_const = np.linalg.norm(Z @ coef - ones) < 1e-8 * np.sqrt(n_rows)
+    others_have_const = design_has_const & (np.abs(coef) < 1e-8 * np.sqrt(n_rows))
+    uncentered_tss = np.ones(X.shape[1])
+    centered_tss = 1 - (Z.sum(axis=0) ** 2) / n_rows
+    tss = np.where(others_have_const, centered_tss, uncentered_tss)
+    vifs[nonzero] = np.where(collinear, np.inf, tss / ssr)
+    return vifs
+
+
+def add_intercept(design):
+    """design (data frame) with an intercept column of ones (replaced if present)"""
+    design_with_intercept = design.copy()
+    design_with_intercept["intercept"] = 1
+    return design_with_intercept
+
+
+def factorize_design(design):
+    """
+    Pivoted QR factorization of a design (columns scaled to unit norm), computed
+    once and shared by all contrast computations on the design
+    output:
+        dictionary with R, the column permutation (perm), the numerical rank,
+        the column norms, the Gram matrix X'X and the column sums of the design
+    """
+    from scipy.linalg import qr
+
+    X = np.asarray(design, dtype=float)
+    norms = np.linalg.norm(X, axis=0)
+    # all zero columns stay zero, they end up in the null space
+    norms[norms == 0] = 1
+    R, perm = qr(X / norms, mode="r", pivoting=True)
+    R = R[: min(X.shape)]
+    r_diag = np.abs(np.diag(R))
+    rank = int(np.sum(r_diag > r_diag.max() * max(X.shape) * np.finfo(float).eps))
+    # X'X in the original column order and scale
+    R_unpivoted = R[:, np.argsort(perm)] * norms
+    return {
+        "R": R,
+        "perm": perm,
+        "rank": rank,
+        "norms": norms,
+        "gram": R_unpivoted.T @ R_unpivoted,
+        "col_sums": X.sum(axis=0),
+        "n_rows": X.shape[0],
+    }
+
+
+def get_contrast_efficiency(factorization, contrast_matrix):
+    """
+    Efficiency 1 / (c (X'X)^-1 c') and estimability of all contrasts from the
+    factorization of the design (two triangular solves for all contrasts).  A
+    contrast is estimable if it is orthogonal to the null space of the design,
+    inestimable contrasts get efficiency 0.
+    input:
+        factorization: output of factorize_design()
+        contrast_matrix: (contrasts x regressors) array
+    output:
+        efficiency: array with the efficiency of each contrast
+        estimable: boolean array
+    """
+    from scipy.linalg import solve_triangular
+
+    contrast_matrix = np.atleast_2d(np.asarray(contrast_matrix, dtype=float))
+    R, rank = factorization["R"], factorization["rank"]
+    # contrasts in the scaled, pivoted coordinates of R
+    contrast_pivoted = (contrast_matrix / factorization["norms"])[:, factorization["perm"]]
+    c1, c2 = contrast_pivoted[:, :rank], contrast_pivoted[:, rank:]
+    # w = c1 R11^-1, so c (X'X)^-1 c' = |w|^2
+    w = solve_triangular(R[:rank, :rank], c1.T, trans="T").T
+    contrast_variance = np.sum(w**2, axis=1)
+    # the null space is spanned by the columns of [-R11^-1 R12; I]
+    w_r12 = w @ R[:rank, rank:]
+    null_projection = np.linalg.norm(c2 - w_r12, axis=1)
+    # columns of R have unit norm, so |w R12| <= |w|
+    tolerance = 1e-8 * (np.linalg.norm(c2, axis=1) + np.linalg.norm(w, axis=1))
+    estimable = null_projection <= tolerance
+    with np.errstate(divide="ignore"):
+        efficiency = np.where(estimable, 1 / contrast_variance, 0)
+    return efficiency, estimable
+
+
+def get_effective_regressor_stats(design, contrast_matrix):
+    """
+    Effective regressor VIF (Smith et al, Meaningful design and contrast
+    estimability, NeuroImage 2007), efficiency and estimability of every
+    contrast, from a single factorization of the design.
+
+    The design is reparameterized so the contrast is the parameter of the
+    effective regressor e = x Q c' / (c Q c') (x: regressors in the contrast,
+    Q = (x'x)^-1), which makes the residual sum of squares of e regressed on the
+    rest of the reparameterized design 1 / (c (X'X)^-1 c'), the efficiency.  Its
+    VIF is therefore tss(e) / efficiency, and tss(e) only needs the x'x block of
+    X'X and the column sums of X.  Matches building the reparameterized design
+    and computing the VIF of e with statsmodels for each contrast.
+    input:
+        design: (time points x regressors) array, including the intercept
+        contrast_matrix: (contrasts x regressors) array
+    output:
+        dictionary with vif, efficiency and estimable arrays (one value per
+        contrast); inestimable contrasts have VIF inf and efficiency 0
+    """
+    contrast_matrix = np.atleast_2d(np.asarray(contrast_matrix, dtype=float))
+    factorization = factorize_design(design)
+    efficiency, estimable = get_contrast_efficiency(factorization, contrast_matrix)
+    gram, col_sums = factorization["gram"], factorization["col_sums"]
+    vifs = np.full(len(contrast_matrix), np.inf)
+    for idx in np.flatnonzero(estimable):
+        in_contrast = contrast_matrix[idx] != 0
+        c = contrast_matrix[idx, in_contrast]
+        q = np.linalg.pinv(gram[np.ix_(in_contrast, in_contrast)], hermitian=True)
+        cqc = c @ q @ c
+        # sum of squares and sum of the effective regressor
+        eff_ss = 1 / cqc
+        eff_sum = col_sums[in_contrast] @ q @ c / cqc
+        eff_tss = eff_ss - eff_sum**2 / factorization["n_rows"]
+        vifs[idx] = eff_tss / efficiency[idx]
+    return {"vif": vifs, "efficiency": efficiency, "estimable": estimable}
+
+
+def _statsmodels_contrast_vif(design, contrast):
+    """
+    VIF of the effective regressor of one contrast from the explicitly
+    reparameterized design (the statsmodels computation get_effective_regressor_stats
+    replaces)
+    """
+    from scipy.linalg import null_space
+    from statsmodels.stats.outliers_influence import variance_inflation_factor
+
+    in_contrast = contrast != 0
+    con = np.atleast_2d(contrast[in_contrast])
+    x = design[:, in_contrast]
+    q = np.linalg.pinv(x.T @ x)
+    f1 = np.linalg.pinv(con @ q @ con.T)
+    con2_t = null_space(con)
+    con3_t = con2_t - con.T @ f1 @ con @ q @ con2_t
+    f3 = np.linalg.pinv(con3_t.T @ q @ con3_t)
+    eff_reg = x @ q @ con.T @ f1
+    other_reg = x @ q @ con3_t @ f3
+    des_for_vif = np.hstack([eff_reg, other_reg, design[:, ~in_contrast]])
+    return variance_inflation_factor(des_for_vif, 0)
+
+
+if __name__ == "__main__":
+    # Checks get_vifs and the contrast VIFs against statsmodels (one regression
+    # per column / per reparameterized contrast design) on a few random designs.
+    # Requires statsmodels:  python -m utils_lev1.vif
+    import pandas as pd
+    from statsmodels.stats.outliers_influence import variance_inflation_factor
+
+    rng = np.random.default_rng(0)
+    n_rows = 200
+    for n_regressors, correlation in [(3, 0.0), (5, 0.5), (8, 0.9)]:
+        shared = rng.standard_normal((n_rows, 1))
+        regressors = (
+            correlation * shared + rng.standard_normal((n_rows, n_regressors))
+        ) + rng.uniform(0, 2, n_regressors)
+        design = pd.DataFrame(
+            regressors, columns=[f"reg{idx}" for idx in range(n_regressors)]
+        )
+        # without a constant (uncentered tss) and with the intercept (centered)
+        for X in [design.values, add_intercept(design).values]:
+            expected = [variance_inflation_factor(X, idx) for idx in range(X.shape[1])]
+            np.testing.assert_allclose(get_vifs(X), expected, rtol=1e-10)
+
+        X = add_intercept(design).values
+        contrast_matrix = np.zeros((3, X.shape[1]))
+        contrast_matrix[0, 0] = 1
+        contrast_matrix[1, :2] = [1, -1]
+        contrast_matrix[2, :3] = [1, 1, -2]
+        stats = get_effective_regressor_stats(X, contrast_matrix)
+        assert stats["estimable"].all()
+        expected = [
+            _statsmodels_contrast_vif(X, contrast) for contrast in contrast_matrix
+        ]
+        np.testing.assert_allclose(stats["vif"], expected, rtol=1e-10)
+        print(f"{n_regressors} regressors, correlation {correlation}: VIFs match")
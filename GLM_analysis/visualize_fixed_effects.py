@@ -52,7 +52,7 @@ for sub in subjects:
                 f.savefig(pdf)
         
         if sessions:
-            session_contrasts = sorted(glob.glob(bids+f'derivatives/output/{task}_*/*/contrast_estimates/sub-{sub}*ses-*z_score.nii.gz'))
+            session_contrasts = sorted(glob.glob(bids+f'derivatives/output/{task}_*/*/contrast_estimates/sub-{sub}*ses-*z_score.nii*'))
             f,  axes = plt.subplots(len(session_contrasts), 1, figsize = (20,len(session_contrasts)*5), squeeze=False)
             plt.suptitle(sub+'_'+task, fontsize=20)
             if threshold: